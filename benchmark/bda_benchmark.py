@@ -0,0 +1,349 @@
+##########################################################################################
+# Scaling benchmark of the BCC Defect Analysis
+#
+# Builds synthetic bcc crystals of the requested sizes with known defects, analyzes
+# them with ovitos_bcc-defect-analysis.py and reports the time, throughput and memory of
+# every stage together with the agreement of the defect types with the ground truth.
+# The defects are not relaxed, so their atoms do not always show the signatures of
+# relaxed defects that BDA looks for; the share of them that is found as any defect is
+# reported as well. The core of the screw dislocation looks like a twin without
+# relaxation and is not checked. The benchmark fails if these shares drop below the
+# limits below, and a change of any defect type is caught with --reference.
+#
+# Every crystal has free surfaces and contains
+#   - mono- and di-vacancies (about one of each per 100000 atoms),
+#   - a 1/2[111] screw dislocation along z and a 1/2[111] edge dislocation along x,
+#   - a (11-2) twin boundary and a planar fault on (-110) with a 1/6[111] shift, both
+#     opened by 0.1 lattice parameters,
+# in a crystal oriented x=[11-2], y=[-110], z=[111].
+#
+# Examples:
+#   python benchmark/bda_benchmark.py --sizes 1e4 1e5 1e6 --save-reference ref.json
+#   python benchmark/bda_benchmark.py --sizes 1e4 1e5 1e6 --reference ref.json -- --refinement batched
+#   python benchmark/bda_benchmark.py --sizes 1e4 1e5 -- --backend native
+# Arguments after -- are passed on to the analysis script.
+##########################################################################################
+
+import os, sys, subprocess, argparse, json, time, hashlib, importlib.util
+from numpy import *
+
+script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'ovitos_bcc-defect-analysis.py')
+spec=importlib.util.spec_from_file_location('bda',script)
+bda=importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bda)
+
+stages=['import','acna','coordination','csp','descriptors','slicing','deletion','neighbor_finder','export_ccc',
+        'neighbor_list','classification','refinement','output']
+checked=[bda.srf,bda.vcn,bda.dsl,bda.twn,bda.plf]
+
+# Smallest accepted shares of the core atoms of every defect identified as that defect
+# (recall) and as any defect (detected), and of the bulk atoms identified as bulk. Many
+# neighbors of an unrelaxed vacancy are identified as dislocation; the limits are set a
+# bit below the results for 1e4 to 1e6 atoms:
+minimum_recall={'srf':0.95,'vcn':0.3,'dsl':0.9,'twn':0.9,'plf':0.9}
+minimum_detected={'srf':0.95,'vcn':0.9,'dsl':0.95,'twn':0.95,'plf':0.95}
+minimum_bulk=0.99
+
+##########################################################################################
+# SYNTHETIC CRYSTALS
+##########################################################################################
+
+def oriented_basis(alat):
+  # Atoms of the bcc cell oriented x=[11-2], y=[-110], z=[111] and the edge lengths of the cell.
+  rot=array([[1,1,-2],[-1,1,0],[1,1,1]],dtype=float64)
+  rot/=linalg.norm(rot,axis=1)[:,None]
+  lengths=alat*array([sqrt(6),sqrt(2),sqrt(3)/2])
+  grid=indices((9,9,9)).reshape(3,-1).T-4
+  pos=concatenate([grid,grid+0.5])*alat@rot.T
+  frac=pos/lengths
+  inside=((frac > -1e-6) & (frac < 1-1e-6)).all(axis=1)
+  return pos[inside],lengths
+
+def bcc_crystal(nr_atoms, alat):
+  basis,lengths=oriented_basis(alat)
+  side=(nr_atoms/len(basis)*prod(lengths))**(1/3)
+  cells=maximum(rint(side/lengths),1).astype(int64)
+  corners=indices(cells).reshape(3,-1).T*lengths
+  return (corners[:,None,:]+basis[None,:,:]).reshape(-1,3),cells*lengths
+
+class CellList:
+  # Atoms within a cutoff of arbitrary points.
+  def __init__(self, pos, cutoff):
+    self.pos=pos
+    self.cutoff=cutoff
+    self.origin=pos.min(axis=0)
+    self.shape=(floor((pos.max(axis=0)-self.origin)/cutoff)+1).astype(int64)
+    key=self.key(floor((pos-self.origin)/cutoff).astype(int64))
+    self.order=argsort(key,kind='stable')
+    self.keys=key[self.order]
+
+  def key(self, cell):
+    return (cell[:,0]*self.shape[1]+cell[:,1])*self.shape[2]+cell[:,2]
+
+  def near(self, point):
+    cell=floor((point-self.origin)/self.cutoff).astype(int64)
+    found=[]
+    for shift in indices((3,3,3)).reshape(3,-1).T-1:
+      c=cell+shift
+      if (c < 0).any() or (c >= self.shape).any():
+        continue
+      k=self.key(c[None,:])[0]
+      found.append(self.order[searchsorted(self.keys,k):searchsorted(self.keys,k,side='right')])
+    found=concatenate(found)
+    return found[linalg.norm(self.pos[found]-point,axis=1) < self.cutoff]
+
+def build_fixture(nr_atoms, alat, seed=1):
+  # Crystal with all defects. Returns the positions, the box and the geometry of the defects.
+  rng=random.default_rng(seed)
+  pos,box=bcc_crystal(nr_atoms,alat)
+  layer=alat*array([sqrt(6)/6,sqrt(2)/2,sqrt(3)/6])
+  b=alat*sqrt(3)/2
+  # (an unrelaxed twin boundary or planar fault has too little room for the signatures of a
+  # relaxed one; a small excess volume gives them)
+  opening=0.1*alat
+  truth={}
+
+  # twin boundary: mirror the crystal at a (11-2) plane and open the boundary a bit
+  x_t=rint(0.75*box[0]/layer[0])*layer[0]
+  mirror=pos[pos[:,0] < x_t-1e-6].copy()
+  mirror[:,0]=2*x_t-mirror[:,0]+opening
+  pos=concatenate([pos[pos[:,0] <= x_t+1e-6],mirror[mirror[:,0] < box[0]]])
+  truth['twin']=x_t+opening/2
+
+  # planar fault: shift the crystal above a (-110) plane by 1/6[111] and open the fault a bit
+  y_f=(floor(0.75*box[1]/layer[1])+0.5)*layer[1]
+  pos[pos[:,1] > y_f,2]+=b/3
+  pos[pos[:,1] > y_f,1]+=opening
+  truth['fault']=y_f+opening/2
+
+  screw=array([(floor(0.3*box[0]/layer[0])+0.5)*layer[0],(floor(0.3*box[1]/layer[1])+0.5)*layer[1]])
+  edge=array([(floor(0.45*box[1]/layer[1])+0.5)*layer[1],(floor(0.5*box[2]/layer[2])+0.5)*layer[2]])
+  truth['screw']=screw.tolist()
+  truth['edge']=edge.tolist()
+
+  # vacancies and di-vacancies far away from the other defects and from each other:
+  clean=(abs(pos[:,0]-x_t) > 4*alat) & (abs(pos[:,1]-y_f) > 4*alat) & \
+        (linalg.norm(pos[:,:2]-screw,axis=1) > 6*alat) & (linalg.norm(pos[:,1:]-edge,axis=1) > 6*alat) & \
+        ((pos-pos.min(axis=0)).min(axis=1) > 4*alat) & ((pos.max(axis=0)-pos).min(axis=1) > 4*alat)
+  candidates=rng.permutation(flatnonzero(clean))
+  wanted=maximum(nr_atoms//100000,1)
+  cells=CellList(pos,0.9*alat)
+  removed=[]
+  mono=di=0
+  for i in candidates:
+    if di == wanted:
+      break
+    if removed and (linalg.norm(pos[removed]-pos[i],axis=1) < 5*alat).any():
+      continue
+    removed.append(i)
+    if mono < wanted:
+      mono+=1
+    else:
+      # di-vacancy: also remove a nearest neighbor
+      partner=cells.near(pos[i])
+      removed.append(partner[partner != i][0])
+      di+=1
+  vacancies=pos[removed]
+  pos=delete(pos,removed,axis=0)
+
+  # Volterra fields of the dislocations (isotropic, Poisson ratio 0.3):
+  nu=0.3
+  def displace(p):
+    p=p.copy()
+    dx=p[:,0]-screw[0]
+    dy=p[:,1]-screw[1]
+    p[:,2]+=b/(2*pi)*arctan2(dy,dx)
+    X=p[:,2]-edge[1]
+    Y=p[:,1]-edge[0]
+    r2=X**2+Y**2
+    p[:,2]+=b/(2*pi)*(arctan2(Y,X)+X*Y/(2*(1-nu)*r2))
+    p[:,1]-=b/(2*pi)*((1-2*nu)/(4*(1-nu))*log(r2/alat**2)+(X**2-Y**2)/(4*(1-nu)*r2))
+    return p
+  pos=displace(pos)
+  truth['vacancies']=displace(vacancies).tolist()
+  truth['mono_vacancies']=mono
+  truth['di_vacancies']=di
+
+  # free surfaces all around: leave some vacuum in the box
+  origin=pos.min(axis=0)-2*alat
+  pos-=origin
+  truth['origin']=origin.tolist()
+  return pos,pos.max(axis=0)+2*alat,truth
+
+def ground_truth(pos, alat, truth):
+  # Expected defect type of every atom. Atoms close to two defects or between the core
+  # of a defect and the bulk are not checked (-1).
+  origin=array(truth['origin'])
+  features=[]
+  depth=minimum((pos-pos.min(axis=0)).min(axis=1),(pos.max(axis=0)-pos).min(axis=1))
+  features.append((bda.srf,depth < 0.6*alat,depth < 2*alat))
+  near=zeros(len(pos),dtype=int8)
+  if truth['vacancies']:
+    cells=CellList(pos,2*alat)
+    for site in array(truth['vacancies'])-origin:
+      found=cells.near(site)
+      d=linalg.norm(pos[found]-site,axis=1)
+      near[found[d < 2*alat]]=maximum(near[found[d < 2*alat]],1)
+      near[found[d < 1.2*alat]]=2
+  features.append((bda.vcn,near == 2,near >= 1))
+  # (the unrelaxed core of the screw dislocation looks like a twin to BDA, so only the
+  # edge dislocation is checked)
+  d=linalg.norm(pos[:,:2]-(array(truth['screw'])-origin[:2]),axis=1)
+  features.append((-1,d < 3*alat,d < 3*alat))
+  d=linalg.norm(pos[:,1:]-(array(truth['edge'])-origin[1:]),axis=1)
+  features.append((bda.dsl,d < 0.8*alat,d < 3*alat))
+  d=abs(pos[:,0]-(truth['twin']-origin[0]))
+  features.append((bda.twn,d < 0.5*alat,d < 1.5*alat))
+  d=abs(pos[:,1]-(truth['fault']-origin[1]))
+  features.append((bda.plf,d < 0.75*alat,d < 1.5*alat))
+  zones=zeros(len(pos),dtype=int8)
+  for kind,core,zone in features:
+    zones+=zone
+  expected=where(zones == 0,bda.blk,-1).astype(int8)
+  for kind,core,zone in features:
+    expected[core & (zones == 1)]=kind
+  return expected
+
+def write_imd(filename, pos, box, chunk=1000000):
+  with open(filename,'w') as out:
+    out.write('#F A 1 1 1 3 0 0\n')
+    out.write('#C number type mass x y z\n')
+    out.write('#X %12.6f %12.6f %12.6f\n' % (box[0],0,0))
+    out.write('#Y %12.6f %12.6f %12.6f\n' % (0,box[1],0))
+    out.write('#Z %12.6f %12.6f %12.6f\n' % (0,0,box[2]))
+    out.write('#E\n')
+    for start in range(0,len(pos),chunk):
+      p=pos[start:start+chunk]
+      savetxt(out,column_stack([arange(start+1,start+len(p)+1),zeros(len(p)),full(len(p),55.845),p]),
+              fmt='%d %d %.3f %.6f %.6f %.6f')
+
+##########################################################################################
+# RUNNING AND CHECKING THE ANALYSIS
+##########################################################################################
+
+def run_case(nr_atoms, alat, potential, workdir, python, extra):
+  name='bcc_%s_%d' % (potential,nr_atoms)
+  file=os.path.join(workdir,name+'.chkpt')
+  print("Building %s..." % name, end="", flush=True)
+  clock=time.time()
+  pos,box,truth=build_fixture(nr_atoms,alat)
+  if not os.path.exists(file):
+    write_imd(file,pos,box)
+  print(" %d atoms in %.1f seconds" % (len(pos),time.time()-clock))
+
+  # (--out-of-core writes no binary files, the defect types are then read from the .bda file)
+  binary=[] if '--out-of-core' in extra else ['--binary','raw']
+  command=[python,script,'-c',file,'-a',str(alat),'-b','0','0','0','-r','0','--report']+binary+extra
+  print("Analyzing %s..." % name, end="", flush=True)
+  clock=time.time()
+  with open(file + ".bench.log",'w') as log:
+    subprocess.run(command,stdout=log,stderr=subprocess.STDOUT,check=True)
+  seconds=time.time()-clock
+  print(" done in %.1f seconds!" % seconds)
+
+  with open(file + ".bda.json") as inp:
+    report=json.load(inp)
+  if binary:
+    cell,columns=bda.read_binary(file + ".bda.raw",['number','defect'])
+  else:
+    compress=extra[extra.index('--compress')+1] if '--compress' in extra else None
+    columns,cell=bda.read_imd(file + ".bda" + ("." + compress if compress else ""))
+  defect=full(len(pos),bda.blk,dtype=int8)
+  defect[asarray(columns['number'])-1]=asarray(columns['defect']).astype(int8)
+  expected=ground_truth(pos,alat,truth)
+
+  result={'name':name,'atoms':len(pos),'seconds':seconds,'stages':{},
+          'digest':hashlib.blake2b(defect.tobytes(),digest_size=16).hexdigest(),
+          'counts':dict(zip(bda.defect_names,bincount(defect,minlength=bda.els+1).tolist())),'recall':{},'detected':{}}
+  for stage in report['stages']:
+    result['stages'][stage['name']]={'seconds':stage['wall_seconds'],'atoms_per_second':stage['atoms_per_second'],
+                                     'peak_rss_mb':stage['peak_rss_mb']}
+  result['peak_rss_mb']=max([stage['peak_rss_mb'] or 0 for stage in report['stages']])
+  for kind in checked:
+    core=expected == kind
+    result['recall'][bda.defect_names[kind]]=float((defect[core] == kind).mean()) if core.any() else None
+    result['detected'][bda.defect_names[kind]]=float((defect[core] != bda.blk).mean()) if core.any() else None
+  result['bulk_correct']=float((defect[expected == bda.blk] == bda.blk).mean())
+  return result
+
+def print_results(results):
+  print()
+  print("%-10s" % 'stage'+''.join(["%14d" % result['atoms'] for result in results]))
+  for stage in stages:
+    print("%-10.10s" % stage+''.join(["%14s" % ("%.2f s" % result['stages'][stage]['seconds'] if stage in result['stages'] else '-')
+                                      for result in results]))
+  print("%-10s" % 'total'+''.join(["%14s" % ("%.2f s" % result['seconds']) for result in results]))
+  print("%-10s" % 'atoms/s'+''.join(["%14.3g" % (result['atoms']/result['seconds']) for result in results]))
+  print("%-10s" % 'peak MB'+''.join(["%14.0f" % result['peak_rss_mb'] for result in results]))
+  # share of the atoms at a defect that are identified as that defect (ok) or as any defect (found)
+  for kind in checked:
+    name=bda.defect_names[kind]
+    for title,score in (('ok','recall'),('found','detected')):
+      print("%-10s" % (title+' '+name)+''.join(["%14s" % ('-' if result[score][name] is None else "%.1f %%" % (100*result[score][name]))
+                                                for result in results]))
+  print("%-10s" % 'ok blk'+''.join(["%14s" % ("%.2f %%" % (100*result['bulk_correct'])) for result in results]))
+
+def check_recall(results):
+  # The defects must still be found, e.g. after a change of the tests.
+  failed=0
+  for result in results:
+    low=[]
+    for kind in checked:
+      name=bda.defect_names[kind]
+      for score,limits in (('recall',minimum_recall),('detected',minimum_detected)):
+        if result[score][name] is not None and result[score][name] < limits[name]:
+          low.append("%s %s %.1f %% < %.1f %%" % (score,name,100*result[score][name],100*limits[name]))
+    if result['bulk_correct'] < minimum_bulk:
+      low.append("bulk %.2f %% < %.2f %%" % (100*result['bulk_correct'],100*minimum_bulk))
+    if low:
+      failed+=1
+      print("LOW RECALL: %s: %s" % (result['name'],', '.join(low)))
+  return failed
+
+def compare_reference(results, filename):
+  # The defect types must not change at all, e.g. by an optimization.
+  with open(filename) as inp:
+    reference=json.load(inp)
+  failed=0
+  for result in results:
+    if result['name'] not in reference:
+      print("No reference for %s" % result['name'])
+    elif reference[result['name']]['digest'] != result['digest']:
+      failed+=1
+      print("CHANGED: %s %s (reference %s)" % (result['name'],result['counts'],reference[result['name']]['counts']))
+    else:
+      print("Unchanged: %s" % result['name'])
+  return failed
+
+def main():
+  p=argparse.ArgumentParser(description='Scaling benchmark of the BCC Defect Analysis with synthetic defect crystals')
+  p.add_argument('--sizes',nargs='+',type=float,default=[1e4,1e5,1e6],help='Approximate numbers of atoms (default: 1e4 1e5 1e6; up to 5e7)')
+  p.add_argument('--potential',default='Men-II',choices=bda.known_potentials[0],help='Potential whose lattice parameter is used (default: Men-II)')
+  p.add_argument('--workdir',default='bda_benchmark',help='Directory for the crystals and the results (default: bda_benchmark)')
+  p.add_argument('--python',default=sys.executable,help='Python interpreter with OVITO, e.g. ovitos (default: this one)')
+  p.add_argument('--output',help='Write the results into this JSON file')
+  p.add_argument('--reference',help='Fail if the defect types differ from the ones in this JSON file')
+  p.add_argument('--save-reference',help='Save the defect types as reference into this JSON file')
+  p.add_argument('extra',nargs=argparse.REMAINDER,help='Arguments for the analysis script (after --)')
+  args=p.parse_args()
+  extra=[arg for arg in args.extra if arg != '--']
+
+  alat=bda.known_potentials[1][bda.known_potentials[0].index(args.potential)]
+  os.makedirs(args.workdir,exist_ok=True)
+  results=[run_case(int(size),alat,args.potential,args.workdir,args.python,extra) for size in args.sizes]
+  print_results(results)
+
+  if args.output:
+    with open(args.output,'w') as out:
+      json.dump(results,out,indent=1)
+  if args.save_reference:
+    with open(args.save_reference,'w') as out:
+      json.dump({result['name']:{'digest':result['digest'],'counts':result['counts']} for result in results},out,indent=1)
+  failed=check_recall(results)
+  if args.reference:
+    failed+=compare_reference(results,args.reference)
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
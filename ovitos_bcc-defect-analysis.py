@@ -25,16 +25,88 @@
 ##########################################################################################
 
 import os, sys, subprocess, argparse, platform
-import time
+import time, contextlib, traceback, json, cProfile, pstats, threading, queue, hashlib, shutil, csv, re, struct, socketserver, itertools
+import io, gzip, zlib, concurrent.futures, tempfile
 from numpy import *
-import ovito
-from ovito.io import *
-from ovito.data import *
-from ovito.modifiers import *
-# import threading
+try:
+  import ovito
+  from ovito.io import *
+  from ovito.data import *
+  from ovito.modifiers import *
+except ImportError:
+  # only --reclassify works without OVITO
+  ovito = None
 import multiprocessing
 from multiprocessing import Process, Value, Array, Pool
 #from array import array
+try:
+  import resource
+except ImportError:
+  resource = None
+try:
+  import zstandard
+except ImportError:
+  # only needed for .zst files
+  zstandard = None
+
+# Define numbers for defects:
+blk=0
+srf=1
+vcn=2
+dsl=3
+twn=4
+plf=5
+els=6
+defect_names=['blk','srf','vcn','dsl','twn','plf','els']
+
+# Thresholds of the tests (see --thresholds and --sweep). The inequalities of the tests are
+# parameters, while the exact neighbor counts are the signatures of the defect structures:
+default_thresholds={'csp_low':1.0,           # CSP bands of the vacancy and twin tests
+                    'csp_high':4.0,
+                    'csp_twin':4.5,
+                    'csp_screw':8.0,
+                    'surface_coord':11,       # surface atoms: coordination <= surface_coord
+                    'surface_neighbors':4,    # or at least this many surface neighbors
+                    'vacancy_perfect':7,      # perfect neighbors of 13-coordinated vacancy atoms (>)
+                    'twin_perfect_min':6,     # perfect neighbors of 14-coordinated twin atoms
+                    'twin_perfect_max':9,
+                    'twin_14':4,              # and their 14-coordinated non-bcc neighbors (>=)
+                    'twin_screw_perfect':8,   # perfect neighbors of twin atoms with a high CSP (<=)
+                    'dislocation_non14':4,    # non-14-coordinated neighbors of 14-coordinated dislocation atoms (>=)
+                    'dislocation_14':6,       # their 14-coordinated neighbors (<=)
+                    'dislocation_perfect':4,  # and their perfect neighbors (<=)
+                    'vote':3,                 # optimization loops: votes for the most common neighbor defect
+                    'converged':0.005}        # and the fraction of unidentified atoms to stop at
+thresholds=dict(default_thresholds)
+
+# Lattice parameters of known potentials:
+known_potentials = [['Chiesa','DD_CS3-33','Men-II','Chamati','Gordon','MPG20','Marinica11','Rosato'],[2.8665,2.8665,2.8553,2.8661,2.85516,2.85516,2.814767,2.86650]] 
+binary_chunks=None
+neighbor_queries=0
+writer_queue=None
+f=None
+previous_frame=None
+cache_dir=None
+descriptors=False
+reclassify=False
+backend='ovito'
+low_memory=False
+prefilter=False
+clusters=False
+summary_file=None
+compress=None
+serve_socket=None
+watch_dir=None
+sweep_sets=None
+sweep_labels=[]
+roi=None
+roi_halo=None
+atom_roi=None
+atom_source=None
+out_of_core=None
+memory_budget=1024
+memory_domains=1
+scratch_dir=None
 
 ##########################################################################################
 # TESTS FOR SURFACE ATOMS
@@ -45,7 +117,7 @@ def is_surface(i):
   coord=atom_coord[i]
   csp=atom_csp[i]
   cna=atom_cna[i]
-  if cna != 3 and (coord <= 11 or is_neighbor2surface(i)):
+  if cna != 3 and (coord <= thresholds['surface_coord'] or is_neighbor2surface(i)):
     atom_defect[i]=srf
     return True
   else: 
@@ -56,10 +128,10 @@ def is_neighbor2surface(i):
     count=0
     neighbors=get_neighbors(i)
     for n in neighbors:
-      if atom_cna[n] != 3 and (atom_defect[n]==srf or atom_coord[n]<=11):
+      if atom_cna[n] != 3 and (atom_defect[n]==srf or atom_coord[n]<=thresholds['surface_coord']):
         count+=1
         atom_defect[n]=srf # might be redundant
-    if count>=4:
+    if count>=thresholds['surface_neighbors']:
       atom_defect[i]=srf 
       return True
     else:
@@ -101,7 +173,7 @@ def is_dislo(i):
         nr_non14+=1
       if atom_coord[n]==14:
         nr_14+=1
-    if nr_non14 >=4 and nr_14 <= 6 and nr_perfect <= 4:
+    if nr_non14 >= thresholds['dislocation_non14'] and nr_14 <= thresholds['dislocation_14'] and nr_perfect <= thresholds['dislocation_perfect']:
       atom_defect[i]=dsl
       return True
     else:
@@ -120,7 +192,7 @@ def is_vac(i):
   ############################
   # Mono-vacancy
   ############################
-  if coord == 13 and csp < 1:
+  if coord == 13 and csp < thresholds['csp_low']:
     nr_perfect = 0
     nr_12_4 = 0 # for vacancy row
     nr_13 = 0
@@ -129,14 +201,14 @@ def is_vac(i):
     nr_perfect = coord - nr_nonperfect  
     # 
     for n in neighbors:
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > 4: 
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > thresholds['csp_high']: 
         nr_13+=1
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > thresholds['csp_high']:  
         nr_12_4+=1
     if (nr_13==4 and nr_perfect == 9) or (nr_13==2 and nr_12_4 == 2 and nr_perfect == 9):
       atom_defect[i]=vcn 
       return True
-  elif coord == 13 and csp > 4:
+  elif coord == 13 and csp > thresholds['csp_high']:
     nr_12_1 = 0 # for vacancy row
     nr_12_4 = 0 # for vacancy row
     nr_13_1 = 0
@@ -146,17 +218,17 @@ def is_vac(i):
     nr_nonperfect = len(neighbors)
     nr_perfect = coord - nr_nonperfect  
     for n in neighbors:
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] < 1:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] < thresholds['csp_low']:  
         nr_12_1+=1
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > thresholds['csp_high']:  
         nr_12_4+=1
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] < 1:  
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] < thresholds['csp_low']:  
         nr_13_1+=1
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > thresholds['csp_high']:  
         nr_13_4+=1
       if atom_cna[n] != 3 and atom_coord[n]==13:  
         nr_13+=1
-    if (nr_13_1 == 3 and nr_13_4 == 3 and nr_perfect == 7) or (nr_12_1 == 2 and nr_12_4 == 2 and nr_13_1 == 1 and nr_13_4 == 1 and nr_perfect == 7) or (nr_13 == 6 and nr_perfect == 7) or (nr_13_4 == 4 and nr_perfect > 7):
+    if (nr_13_1 == 3 and nr_13_4 == 3 and nr_perfect == 7) or (nr_12_1 == 2 and nr_12_4 == 2 and nr_13_1 == 1 and nr_13_4 == 1 and nr_perfect == 7) or (nr_13 == 6 and nr_perfect == 7) or (nr_13_4 == 4 and nr_perfect > thresholds['vacancy_perfect']):
       atom_defect[i]=vcn 
       return True
     else: 
@@ -164,7 +236,7 @@ def is_vac(i):
   ############################
   # Di-vacancy (= vacancy row)
   ############################
-  elif coord == 12 and csp > 4:       
+  elif coord == 12 and csp > thresholds['csp_high']:       
     nr_12_1 = 0
     nr_12_4 = 0
     nr_13_1 = 0
@@ -173,20 +245,20 @@ def is_vac(i):
     nr_nonperfect = len(neighbors)
     nr_perfect = coord - nr_nonperfect  
     for n in neighbors:
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] < 1:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] < thresholds['csp_low']:  
         nr_12_1+=1     
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > thresholds['csp_high']:  
         nr_12_4+=1     
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] < 1:  
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] < thresholds['csp_low']:  
         nr_13_1+=1
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > thresholds['csp_high']:  
         nr_13_4+=1
     if nr_12_1 == 2 and nr_12_4 == 1 and nr_13_1 == 2 and nr_13_4 == 4 and nr_perfect == 3:
       atom_defect[i]=vcn 
       return True
     else: 
       return False   
-  elif coord == 12 and csp < 1:  
+  elif coord == 12 and csp < thresholds['csp_low']:  
     nr_12_4 = 0     
     nr_13_1 = 0
     nr_13_4 = 0
@@ -194,9 +266,9 @@ def is_vac(i):
     nr_nonperfect = len(neighbors)
     nr_perfect = coord - nr_nonperfect  
     for n in neighbors:
-      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==12 and atom_csp[n] > thresholds['csp_high']:  
         nr_12_4+=1
-      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > 4:  
+      if atom_cna[n] != 3 and atom_coord[n]==13 and atom_csp[n] > thresholds['csp_high']:  
         nr_13_4+=1
     if nr_12_4 == 2 and nr_13_4 == 4 and nr_perfect == 6:
       atom_defect[i]=vcn 
@@ -217,7 +289,7 @@ def is_twin(i):
   coord=atom_coord[i]
   cna=atom_cna[i]
   csp=atom_csp[i]
-  if coord == 13 and csp > 4.5:
+  if coord == 13 and csp > thresholds['csp_twin']:
     nr_13 = 0
     nr_14 = 0
     neighbors=get_neighbors(i)
@@ -231,13 +303,13 @@ def is_twin(i):
     if nr_13 == 5 and nr_14 == 2 and nr_perfect == 6: 
       atom_defect[i]=twn
       return True
-  if coord == 14 and csp > 8:
+  if coord == 14 and csp > thresholds['csp_screw']:
     nr_14 = 0
     nr_non14 = 0
     neighbors=get_neighbors(i)
     nr_nonperfect = len(neighbors)
     nr_perfect = coord - nr_nonperfect  
-    if nr_perfect <= 8: 
+    if nr_perfect <= thresholds['twin_screw_perfect']: 
       atom_defect[i]=twn
       return True
   if coord == 14:
@@ -251,19 +323,19 @@ def is_twin(i):
         nr_13+=1
       if atom_cna[n]!=3 and atom_coord[n]==14: # ideally: 6
         nr_14+=1
-    if nr_perfect >= 6 and nr_perfect <= 9 and (nr_14 >= 4 or (nr_13 == 4 and nr_14 == 2)): 
+    if nr_perfect >= thresholds['twin_perfect_min'] and nr_perfect <= thresholds['twin_perfect_max'] and (nr_14 >= thresholds['twin_14'] or (nr_13 == 4 and nr_14 == 2)): 
       atom_defect[i]=twn
       return True
     else: 
       return False
-  elif coord == 13 and csp < 1:
+  elif coord == 13 and csp < thresholds['csp_low']:
     nr_14 = 0
     nr_non14 = 0
     neighbors=get_neighbors(i)
     nr_nonperfect = len(neighbors)
     nr_perfect = coord - nr_nonperfect  
     for n in neighbors:
-      if atom_cna[n]!=3 and atom_coord[n]==14 and atom_csp[n] > 8: # ideally: 6
+      if atom_cna[n]!=3 and atom_coord[n]==14 and atom_csp[n] > thresholds['csp_screw']: # ideally: 6
         nr_14+=1
     if nr_14 == 4: 
       atom_defect[i]=twn
@@ -364,10 +436,10 @@ def common_neighbor_defect(i):
   max_count=0
   most_common=[]
   for d in range(1,6):
-    if defect_count[d] > max_count and defect_count[d] >= 3:
+    if defect_count[d] > max_count and defect_count[d] >= thresholds['vote']:
       most_common=[d]
       max_count=defect_count[d]
-    elif defect_count[d] == max_count and defect_count[d] >= 3:
+    elif defect_count[d] == max_count and defect_count[d] >= thresholds['vote']:
       most_common.append(d)
 #  print(i,most_common,max_count)
   if len(most_common)==1:
@@ -376,53 +448,2095 @@ def common_neighbor_defect(i):
 #    return atom_defect[i]
     return els
 
+##########################################################################################
+# IDENTIFY DEFECTS ATOM BY ATOM
+##########################################################################################
+
+def identify_defects(nr_atoms):
+  global atom_cna,atom_coord,atom_defect
+  defect_atoms=0
+  for i in range(nr_atoms):
+
+    # first check if this atom has already been tested:
+    if atom_defect[i] == -1:
+      # check only those atoms that are non-bcc according to CNA and CN:
+      if atom_cna[i]!=3 or atom_coord[i]!=14:
+        defect_atoms+=1
+        if is_surface(i):
+          pass
+        elif is_vac(i):
+          pass
+        elif is_twin(i):
+          pass
+        elif is_planarfault(i):
+          pass
+        elif is_dislo(i):
+          pass
+        else:
+          # not yet identified defects
+          # can be twins or dislocations
+          atom_defect[i]=els
+      else:
+        # bulk atoms:
+        atom_defect[i]=blk
+  return defect_atoms
+
+##########################################################################################
+# VECTORIZED DEFECT IDENTIFICATION
+##########################################################################################
+
+def neighbor_histograms(cna, coord, csp, neighbors, offset, params=None):
+  # Count the non-bcc neighbors of all atoms at once, split by coordination, CSP band
+  # and CNA type. These are exactly the counters of the per-atom tests above.
+  # params are the thresholds (default: the global thresholds).
+  params=params or thresholds
+  nr_atoms=len(coord)
+  nr_nonperfect=diff(offset)
+  centers=repeat(arange(nr_atoms,dtype=neighbors.dtype),nr_nonperfect)
+  ncna=cna[neighbors]
+  ncoord=coord[neighbors]
+  ncsp=csp[neighbors]
+  def count(mask):
+    return bincount(centers[mask],minlength=nr_atoms)
+  defective=ncna != 3
+  hist={}
+  hist['nonperfect']=nr_nonperfect
+  hist['12']=count(ncoord == 12)
+  hist['13']=count(ncoord == 13)
+  hist['14']=count(ncoord == 14)
+  hist['12+_non14']=count((ncoord >= 12) & (ncoord != 14))
+  hist['cna_13']=count(defective & (ncoord == 13))
+  hist['cna_14']=count(defective & (ncoord == 14))
+  low,high=ncsp < params['csp_low'],ncsp > params['csp_high']
+  hist['cna_12_1']=count(defective & (ncoord == 12) & low)
+  hist['cna_12_4']=count(defective & (ncoord == 12) & high)
+  hist['cna_13_1']=count(defective & (ncoord == 13) & low)
+  hist['cna_13_4']=count(defective & (ncoord == 13) & high)
+  hist['cna_14_8']=count(defective & (ncoord == 14) & (ncsp > params['csp_screw']))
+  return hist
+
+def surface_mask(cna, coord, neighbors, offset, params=None):
+  # Two-phase equivalent of is_surface()/is_neighbor2surface():
+  # phase 1 marks all non-bcc atoms with a coordination <= 11,
+  # phase 2 marks 12- and 13-coordinated non-bcc atoms with >= 4 surface neighbors
+  # (with the default thresholds).
+  # In the per-atom loop, a phase-2 atom also counts phase-2 neighbors with a lower index
+  # (they were already marked when it is reached), so phase 2 is resolved in ascending
+  # index order. Each sweep fixes at least one more link of such chains and the
+  # iteration stops at the unique fixed point, which is the per-atom result.
+  params=params or thresholds
+  nr_atoms=len(coord)
+  seeds=(cna != 3) & (coord <= params['surface_coord'])
+  candidates=(cna != 3) & (coord > params['surface_coord']) & (coord < 14)
+  centers=repeat(arange(nr_atoms,dtype=neighbors.dtype),diff(offset))
+  seed_count=bincount(centers[seeds[neighbors]],minlength=nr_atoms)
+  lower=(neighbors < centers) & candidates[neighbors] & candidates[centers]
+  lower_centers=centers[lower]
+  lower_neighbors=neighbors[lower]
+  surface=seeds | (candidates & (seed_count >= params['surface_neighbors']))
+  while True:
+    earlier=bincount(lower_centers,weights=surface[lower_neighbors],minlength=nr_atoms)
+    new=seeds | (candidates & (seed_count+earlier >= params['surface_neighbors']))
+    if array_equal(new,surface):
+      break
+    surface=new
+  # is_neighbor2surface() marks surface neighbors before the main loop reaches them.
+  # Those are not counted as defect atoms:
+  presets=(centers < neighbors) & candidates[centers] & seeds[neighbors]
+  marked_early=zeros(nr_atoms,dtype=bool)
+  marked_early[neighbors[presets]]=True
+  return surface,marked_early
+
+def identify_defects_vectorized(cna, coord, csp, neighbors, offset, params=None):
+  # Whole-array version of the per-atom tests in the main loop. Returns the defect type of
+  # every atom (els for not yet identified ones) and the number of defect atoms.
+  cna=asarray(cna)
+  coord=asarray(coord)
+  surface,marked_early=surface_mask(cna,coord,neighbors,offset,params)
+  defect=classify_defects(cna,coord,csp,neighbors,offset,surface,params)
+  defect_atoms=int(count_nonzero((defect != blk) & ~marked_early))
+  return defect,defect_atoms
+
+def classify_defects(cna, coord, csp, neighbors, offset, surface, params=None, hist=None):
+  # Evaluate the vacancy, twin, planar fault and dislocation tests for all atoms and
+  # combine them with the given surface atoms. hist may be given if it is already known.
+  # the default CSP thresholds are exact in float32, so float32 values are compared as they are:
+  params=params or thresholds
+  csp=asarray(csp)
+  if hist is None:
+    hist=neighbor_histograms(cna,coord,csp,neighbors,offset,params)
+  csp_low,csp_high,csp_twin,csp_screw=params['csp_low'],params['csp_high'],params['csp_twin'],params['csp_screw']
+  nr_perfect=coord-hist['nonperfect']
+  c12,c13,c14=coord == 12,coord == 13,coord == 14
+
+  vacancy=(c13 & (csp < csp_low) & (nr_perfect == 9) &
+            ((hist['cna_13_4'] == 4) | ((hist['cna_13_4'] == 2) & (hist['cna_12_4'] == 2)))) | \
+          (c13 & (csp > csp_high) &
+            (((hist['cna_13_1'] == 3) & (hist['cna_13_4'] == 3) & (nr_perfect == 7)) |
+             ((hist['cna_12_1'] == 2) & (hist['cna_12_4'] == 2) & (hist['cna_13_1'] == 1) & (hist['cna_13_4'] == 1) & (nr_perfect == 7)) |
+             ((hist['cna_13'] == 6) & (nr_perfect == 7)) |
+             ((hist['cna_13_4'] == 4) & (nr_perfect > params['vacancy_perfect'])))) | \
+          (c12 & (csp > csp_high) & (hist['cna_12_1'] == 2) & (hist['cna_12_4'] == 1) &
+            (hist['cna_13_1'] == 2) & (hist['cna_13_4'] == 4) & (nr_perfect == 3)) | \
+          (c12 & (csp < csp_low) & (hist['cna_12_4'] == 2) & (hist['cna_13_4'] == 4) & (nr_perfect == 6))
+
+  twin=(c13 & (csp > csp_twin) & (hist['cna_13'] == 5) & (hist['cna_14'] == 2) & (nr_perfect == 6)) | \
+       (c14 & (csp > csp_screw) & (nr_perfect <= params['twin_screw_perfect'])) | \
+       (c14 & (nr_perfect >= params['twin_perfect_min']) & (nr_perfect <= params['twin_perfect_max']) &
+         ((hist['cna_14'] >= params['twin_14']) | ((hist['cna_13'] == 4) & (hist['cna_14'] == 2)))) | \
+       (c13 & (csp < csp_low) & (hist['cna_14_8'] == 4))
+
+  n12,n13=hist['12'],hist['13']
+  planarfault=((cna != 3) & c12 & (nr_perfect == 0) &
+                ((n12 >= 9) | ((n12 >= 3) & (n12 <= 6) & (n13 >= 7) & (n13 <= 9)) | ((n12 >= 6) & (n13 >= 3)))) | \
+              (c13 & (((n12+n13 == 9) & (n13 >= 7)) |
+                      ((n13 == 6) & (n12 == 3) & (nr_perfect == 4)) |
+                      ((n13 == 6) & (n12 <= 1) & (nr_perfect >= 6)) |
+                      ((n13 >= 7) & (n12 <= 4) & (nr_perfect <= 3))))
+
+  n14=hist['14']
+  dislo=((coord >= 12) & ~c14 & (hist['nonperfect']-n14 > n14)) | \
+        (c14 & (hist['12+_non14'] >= params['dislocation_non14']) & (n14 <= params['dislocation_14']) &
+         (nr_perfect <= params['dislocation_perfect']))
+
+  # Apply the tests in the order of the main loop: surface > vacancy > twin > planar fault > dislocation
+  perfect=(cna == 3) & c14
+  return select([perfect,surface,vacancy,twin,planarfault,dislo],[blk,srf,vcn,twn,plf,dsl],default=els).astype(intc)
+
+##########################################################################################
+# OPTIMIZATION LOOPS
+##########################################################################################
+
+def refine_defects(identified, unidentified, defect_atoms, keep_unidentified):
+  global atom_defect
+  # Check if an atom's defect is the most common one of its neighbors and occurs >= 3 times
+  # (thresholds['vote']) else throw it into the list of unidentified atoms.
+  confirmed=[]
+  for i in identified:
+    cd = common_neighbor_defect(i)
+    if atom_defect[i] == cd:
+      confirmed.append(i)
+    else:      
+      unidentified.append(i)
+      # defect type is not changed here, but later when all atoms have been checked. 
+      # Otherwise, the changing behavior could be cascade like.	 
+
+  print("Unidentified defect atoms after re-checking already identified atoms: ", len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
+
+  loop_count=0
+  unidentified_orig=unidentified
+  history=[len(unidentified)]
+  llen=0
+
+  for i in unidentified_orig:
+    atom_defect[i]=els
+
+  # Comment the following while loop for debugging purposes:
+  if not keep_unidentified:
+    while len(unidentified)/defect_atoms > thresholds['converged'] and len(unidentified) != llen:
+      loop_count+=1
+      print("Entering loop nr.",loop_count)
+      list=unidentified
+      llen=len(unidentified)
+      unidentified=[]
+      for i in list:
+        cd = common_neighbor_defect(i)
+        if atom_defect[i] != cd:
+          atom_defect[i] = cd 
+        else:
+          atom_defect[i]=els
+          unidentified.append(i)
+      history.append(len(unidentified))
+      print("Unidentified atoms after loop nr.",loop_count,": ",len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
+  return confirmed,unidentified_orig,history
+
+def gather_neighbors(neighbors, offset, atoms):
+  # Concatenated neighbor lists of the given atoms and the length of each list.
+  starts=offset[atoms]
+  lengths=offset[atoms+1]-starts
+  positions=arange(lengths.sum())+repeat(starts-(cumsum(lengths)-lengths),lengths)
+  return neighbors[positions],lengths
+
+def neighbor_votes(defect, neighbors, offset):
+  # Product of the non-bcc neighbor graph with the one-hot matrix of defect types:
+  # votes[i,d] is the number of neighbors of atom i with defect type d.
+  nr_atoms=len(offset)-1
+  centers=repeat(arange(nr_atoms),diff(offset))
+  return bincount(centers*(els+1)+defect[neighbors],minlength=nr_atoms*(els+1)).reshape(nr_atoms,els+1)
+
+def common_neighbor_defects(votes, params=None):
+  # Whole-array version of common_neighbor_defect() for rows of the vote matrix.
+  params=params or thresholds
+  counts=votes[:,srf:plf+1]
+  max_count=counts.max(axis=1)
+  unique=count_nonzero(counts == max_count[:,None],axis=1) == 1
+  return where((max_count >= params['vote']) & unique,argmax(counts,axis=1)+srf,els)
+
+def refine_defects_batched(defect, identified, unidentified, defect_atoms, neighbors, offset, keep_unidentified, decide=None, verbose=True,
+                           params=None, votes=None):
+  # Same rules as refine_defects(), but every loop updates all unidentified atoms at once
+  # from the vote matrix of the previous loop. An atom is only re-evaluated if one of its
+  # neighbors changed, since otherwise its votes and thus its result stay the same.
+  # decide(atoms) may replace the vote matrix, e.g. to evaluate the atoms in parallel.
+  # votes may be given if the vote matrix of defect is already known (it is changed).
+  # Only the arguments are changed, so it can run in several threads at once.
+  params=params or thresholds
+  nr_atoms=len(defect)
+  identified=asarray(identified,dtype=int64)
+  if decide is None:
+    if votes is None:
+      votes=neighbor_votes(defect,neighbors,offset)
+    def decide(atoms):
+      return common_neighbor_defects(votes[atoms],params)
+  else:
+    votes=None
+  keep=defect[identified] == decide(identified)
+  confirmed=identified[keep]
+  unidentified_orig=concatenate([asarray(unidentified,dtype=int64),identified[~keep]])
+
+  if verbose:
+    print("Unidentified defect atoms after re-checking already identified atoms: ", len(unidentified_orig),"(",len(unidentified_orig)/defect_atoms*100,"% )")
+
+  def relabel(atoms, types):
+    # change the defect types and the votes of all neighbors accordingly
+    rows,lengths=gather_neighbors(neighbors,offset,atoms)
+    if votes is not None:
+      subtract.at(votes,(rows,repeat(defect[atoms],lengths)),1)
+      add.at(votes,(rows,repeat(types,lengths)),1)
+    defect[atoms]=types
+    return rows
+
+  relabel(identified[~keep],full(count_nonzero(~keep),els))
+
+  loop_count=0
+  unidentified=unidentified_orig
+  history=[len(unidentified)]
+  evaluate=unidentified
+  llen=0
+  if not keep_unidentified:
+    while len(unidentified)/defect_atoms > params['converged'] and len(unidentified) != llen:
+      loop_count+=1
+      if verbose:
+        print("Entering loop nr.",loop_count)
+      llen=len(unidentified)
+      cd=decide(evaluate)
+      changed=cd != els
+      rows=relabel(evaluate[changed],cd[changed])
+      unidentified=unidentified[defect[unidentified] == els]
+      touched=zeros(nr_atoms,dtype=bool)
+      touched[rows]=True
+      evaluate=unidentified[touched[unidentified]]
+      history.append(len(unidentified))
+      if verbose:
+        print("Unidentified atoms after loop nr.",loop_count,": ",len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
+  return confirmed,unidentified_orig,history
+
+def refine_defects_sequential(defect, identified, unidentified, defect_atoms, neighbors, offset, keep_unidentified, params=None, votes=None):
+  # refine_defects() on the given arrays and thresholds instead of the global ones: the
+  # atoms of a loop are visited one after the other and every change is seen by the atoms
+  # after it. The vote matrix is kept up to date instead of counting the neighbors again.
+  params=params or thresholds
+  if votes is None:
+    votes=neighbor_votes(defect,neighbors,offset)
+  def decide(i):
+    return common_neighbor_defects(votes[i:i+1],params)[0]
+  def relabel(i, kind):
+    rows=neighbors[offset[i]:offset[i+1]]
+    votes[rows,defect[i]]-=1
+    votes[rows,kind]+=1
+    defect[i]=kind
+  identified=asarray(identified,dtype=int64)
+  keep=array([defect[i] == decide(i) for i in identified],dtype=bool)
+  confirmed=identified[keep]
+  unidentified=concatenate([asarray(unidentified,dtype=int64),identified[~keep]])
+  unidentified_orig=unidentified
+  for i in identified[~keep]:
+    relabel(i,els)
+
+  history=[len(unidentified)]
+  llen=0
+  if not keep_unidentified:
+    while len(unidentified)/defect_atoms > params['converged'] and len(unidentified) != llen:
+      llen=len(unidentified)
+      left=[]
+      for i in unidentified:
+        cd=decide(i)
+        if cd != els:
+          relabel(i,cd)
+        else:
+          left.append(i)
+      unidentified=array(left,dtype=int64)
+      history.append(len(unidentified))
+  return confirmed,unidentified_orig,history
+
+##########################################################################################
+# SPATIAL DOMAIN DECOMPOSITION
+##########################################################################################
+
+def decompose_domains(positions, neighbors, offset, nr_domains, shells=2, directory=None):
+  # Split the atoms into slabs with equal numbers of atoms along the longest extent of the
+  # configuration and add a halo of the given number of neighbor shells to each slab.
+  # The halo follows the neighbor list, so it reaches across periodic boundaries exactly
+  # like the neighbor finder does and stops at free surfaces. With a directory, the arrays
+  # of the blocks are kept in memory-mapped files there (see --out-of-core).
+  positions=asarray(positions)
+  nr_atoms=len(positions)
+  axis=argmax(amax(positions,axis=0)-amin(positions,axis=0))
+  owner=zeros(nr_atoms,dtype=int64)
+  owner[argsort(positions[:,axis],kind='stable')]=arange(nr_atoms)*nr_domains//maximum(nr_atoms,1)
+  blocks=[]
+  for b in range(nr_domains):
+    owned=owner == b
+    atoms,block_neighbors,block_offset=extract_subgraph(neighbors,offset,expand_shells(neighbors,offset,owned,shells))
+    block={'atoms':atoms,'owned':owned[atoms],'neighbors':block_neighbors,'offset':block_offset}
+    if directory is not None:
+      block={name:mapped_copy(directory,'block%d_%s' % (b,name),values) for name,values in block.items()}
+    blocks.append(block)
+  return blocks
+
+def expand_shells(neighbors, offset, selected, shells):
+  # Add the given number of neighbor shells to the selected atoms.
+  selected=selected.copy()
+  shell=flatnonzero(selected)
+  for s in range(shells):
+    reached,lengths=gather_neighbors(neighbors,offset,shell)
+    shell=unique(reached[~selected[reached]])
+    selected[shell]=True
+  return selected
+
+def extract_subgraph(neighbors, offset, selected):
+  # Indices of the selected atoms and their neighbor list in local indices. Neighbors that
+  # are not selected are left out, so the rows of atoms at the border are incomplete.
+  atoms=flatnonzero(selected)
+  reached,lengths=gather_neighbors(neighbors,offset,atoms)
+  inside=selected[reached]
+  sub_offset=zeros(len(atoms)+1,dtype=int64)
+  cumsum(bincount(repeat(arange(len(atoms)),lengths)[inside],minlength=len(atoms)),out=sub_offset[1:])
+  return atoms,searchsorted(atoms,reached[inside]),sub_offset
+
+def identify_domain(b):
+  # Worker: identify the defects of the atoms owned by block b. The histograms of owned
+  # atoms only need their first neighbor shell, which is part of the halo.
+  global domain_blocks,domain_surface,atom_cna,atom_coord,atom_csp
+  block=domain_blocks[b]
+  atoms=block['atoms']
+  defect=classify_defects(ctypeslib.as_array(atom_cna.get_obj())[atoms],ctypeslib.as_array(atom_coord.get_obj())[atoms],
+                          ctypeslib.as_array(atom_csp.get_obj())[atoms],block['neighbors'],block['offset'],domain_surface[atoms])
+  return atoms[block['owned']],defect[block['owned']]
+
+def refine_domain(b):
+  # Worker: most common neighbor defect of the owned atoms of block b that are marked in
+  # the shared evaluation mask, based on the current shared defect types.
+  global domain_blocks,domain_evaluate,atom_defect
+  block=domain_blocks[b]
+  atoms=block['atoms']
+  rows=flatnonzero(block['owned'] & (ctypeslib.as_array(domain_evaluate)[atoms] != 0))
+  reached,lengths=gather_neighbors(block['neighbors'],block['offset'],rows)
+  labels=ctypeslib.as_array(atom_defect.get_obj())[atoms[reached]]
+  votes=bincount(repeat(arange(len(rows)),lengths)*(els+1)+labels,minlength=len(rows)*(els+1)).reshape(len(rows),els+1)
+  return atoms[rows],common_neighbor_defects(votes)
+
+def start_domains(nr_domains, neighbors, offset, processes=None, directory=None):
+  # Decompose the current configuration and start one worker process per domain (or the
+  # given number of processes, which take the domains one after the other).
+  # The workers inherit the blocks and the shared atom arrays when they are forked.
+  global domain_blocks,domain_surface,domain_evaluate,domain_pool,atom_pos,atom_cna,atom_coord
+  cna=ctypeslib.as_array(atom_cna.get_obj())
+  coord=ctypeslib.as_array(atom_coord.get_obj())
+  domain_blocks=decompose_domains(atom_pos,neighbors,offset,nr_domains,directory=directory)
+  # The surface test depends on the index order of the atoms (see surface_mask()).
+  # It is resolved once for the whole configuration:
+  domain_surface,marked_early=surface_mask(cna,coord,neighbors,offset)
+  domain_evaluate=Array('b',len(cna),lock=False)
+  domain_pool=Pool(processes=processes or nr_domains)
+  defect_atoms=int(count_nonzero(~((cna == 3) & (coord == 14)) & ~marked_early))
+  return defect_atoms
+
+def identify_defects_domains():
+  global domain_blocks,domain_pool,atom_defect
+  defect=ctypeslib.as_array(atom_defect.get_obj())
+  for atoms,block_defect in domain_pool.map(identify_domain,range(len(domain_blocks))):
+    defect[atoms]=block_defect
+
+def decide_domains(atoms):
+  # decide() of refine_defects_batched() evaluated by the domain workers
+  global domain_blocks,domain_evaluate,domain_pool,atom_defect
+  evaluate=ctypeslib.as_array(domain_evaluate)
+  evaluate[:]=0
+  evaluate[atoms]=1
+  cd=full(len(atom_defect),els)
+  for block_atoms,block_cd in domain_pool.map(refine_domain,range(len(domain_blocks))):
+    cd[block_atoms]=block_cd
+  return cd[atoms]
+
+def stop_domains():
+  global domain_pool,domain_blocks,domain_surface,domain_evaluate
+  domain_pool.close()
+  domain_pool.join()
+  domain_pool=domain_blocks=domain_surface=domain_evaluate=None
+
+##########################################################################################
+# INCREMENTAL ANALYSIS OF TRAJECTORIES
+##########################################################################################
+
+def csp_band(csp):
+  # The CSP ranges that the tests distinguish: <1, 1-4, 4-4.5, 4.5-8, >8 (with the default
+  # thresholds)
+  csp=asarray(csp,dtype=float64)
+  return (csp >= thresholds['csp_low']).astype(int8)+(csp > thresholds['csp_high'])+(csp > thresholds['csp_twin'])+(csp > thresholds['csp_screw'])
+
+def frame_state(ids, cna, coord, csp, offset, defect):
+  # Everything the next frame needs to find the atoms with a changed environment,
+  # sorted by atom identifier.
+  ids=asarray(ids)
+  order=argsort(ids,kind='stable')
+  return {'ids':ids[order],'cna':asarray(cna)[order],'coord':asarray(coord)[order],'band':csp_band(csp)[order],
+          'nonperfect':diff(offset)[order],'defect':asarray(defect)[order].copy()}
+
+def match_previous(previous, ids):
+  # Position of every atom in the previous frame and whether it was there at all.
+  position=searchsorted(previous['ids'],ids)
+  position[position == len(previous['ids'])]=0
+  if len(previous['ids']) == 0:
+    return position,zeros(len(ids),dtype=bool)
+  return position,previous['ids'][position] == ids
+
+def update_defects_incremental(previous, ids, cna, coord, csp, neighbors, offset, defect, keep_unidentified, refinement='sequential'):
+  # Identify the defects of a trajectory frame from the previous frame. Only atoms whose
+  # CNA type, coordination, CSP range or number of non-bcc neighbors changed (or that were
+  # perfect before) and their two neighbor shells are identified and optimized again
+  # (sequential or batched like the first frame), all other atoms keep their defect type.
+  # Returns the lists like the full analysis.
+  ids=asarray(ids)
+  cna=asarray(cna)
+  coord=asarray(coord)
+  position,known=match_previous(previous,ids)
+  changed=~known
+  changed[known]=(previous['cna'][position[known]] != cna[known]) | (previous['coord'][position[known]] != coord[known]) | \
+                 (previous['band'][position[known]] != csp_band(csp)[known]) | \
+                 (previous['nonperfect'][position[known]] != diff(offset)[known])
+  affected=expand_shells(neighbors,offset,changed,2)
+  print("Atoms with changed environment: ", count_nonzero(changed),"(", count_nonzero(affected),"including two neighbor shells )")
+
+  defect[known]=previous['defect'][position[known]]
+  # The surface test depends on the index order and is cheap, so it is done for all atoms:
+  surface,marked_early=surface_mask(cna,coord,neighbors,offset)
+  atoms,region_neighbors,region_offset=extract_subgraph(neighbors,offset,expand_shells(neighbors,offset,affected,1))
+  region_defect=classify_defects(cna[atoms],coord[atoms],csp[atoms],region_neighbors,region_offset,surface[atoms])
+  inside=affected[atoms]
+  defect[atoms[inside]]=region_defect[inside]
+
+  region=flatnonzero(affected)
+  defect_atoms=int(count_nonzero((defect[region] != blk) & ~marked_early[region]))
+  identified=region[(defect[region] >= vcn) & (defect[region] <= plf)]
+  unidentified=region[defect[region] == els]
+  if refinement == 'batched':
+    confirmed,unidentified_orig,history=refine_defects_batched(defect,identified,unidentified,maximum(defect_atoms,1),
+                                                               neighbors,offset,keep_unidentified)
+  else:
+    confirmed,unidentified_orig,history=refine_defects_sequential(defect,identified,unidentified,maximum(defect_atoms,1),
+                                                                  neighbors,offset,keep_unidentified)
+  # atoms outside of the region keep their place in the output:
+  kept=~affected
+  confirmed=union1d(confirmed,flatnonzero(kept & (defect >= vcn) & (defect <= plf)))
+  unidentified_orig=concatenate([unidentified_orig,flatnonzero(kept & (defect == els))])
+  return defect_atoms,confirmed,unidentified_orig,history
+
+def write_deltas(filename, previous, ids, defect):
+  # Atoms whose defect type changed since the previous frame. Atoms that are not in the
+  # non-bcc part of one of the frames count as bulk (blk) there.
+  ids=asarray(ids)
+  position,known=match_previous(previous,ids)
+  old=full(len(ids),blk)
+  old[known]=previous['defect'][position[known]]
+  gone=ones(len(previous['ids']),dtype=bool)
+  gone[position[known]]=False
+  gone&=previous['defect'] != blk
+  numbers=concatenate([ids,previous['ids'][gone]])
+  before=concatenate([old,previous['defect'][gone]])
+  after=concatenate([defect,full(count_nonzero(gone),blk)])
+  changed=before != after
+  with open(filename, 'w') as out:
+    out.write('#C number old_defect defect\n')
+    for number,b,a in zip(numbers[changed],before[changed],after[changed]):
+      out.write("%10d %d %d\n" % (number,b,a))
+  return count_nonzero(changed)
+
+##########################################################################################
+# THRESHOLD SWEEPS
+##########################################################################################
+
+# thresholds that the classification (and not only the optimization loops) depends on:
+classification_thresholds=[name for name in default_thresholds if name not in ('vote','converged')]
+
+def read_thresholds(text):
+  # Thresholds changed by --thresholds: a JSON object or the name of a file with one.
+  if os.path.isfile(text):
+    with open(text) as inp:
+      text=inp.read()
+  changed=json.loads(text)
+  if not isinstance(changed,dict):
+    raise ValueError('the thresholds must be a JSON object')
+  unknown=[name for name in changed if name not in default_thresholds]
+  if unknown:
+    raise ValueError('unknown thresholds: '+', '.join(unknown))
+  return changed
+
+def read_sweep(filename, base):
+  # Parameter sets of --sweep from a JSON file: a list of objects, each changing some of
+  # the base thresholds, or one object whose lists are combined into a grid, e.g.
+  # {"csp_high": [3.5, 4, 4.5], "vote": [2, 3]} for six sets.
+  with open(filename) as inp:
+    content=json.load(inp)
+  if isinstance(content,dict):
+    names=list(content)
+    values=[content[name] if isinstance(content[name],list) else [content[name]] for name in names]
+    content=[dict(zip(names,combination)) for combination in itertools.product(*values)]
+  sets=[]
+  for changed in content:
+    unknown=[name for name in changed if name not in default_thresholds]
+    if unknown:
+      raise ValueError('unknown thresholds: '+', '.join(unknown))
+    sets.append(dict(base,**changed))
+  return sets
+
+def sweep_thresholds(sets, cna, coord, csp, neighbors, offset, keep_unidentified, refinement='sequential'):
+  # Defect types of the same atoms for all parameter sets: the descriptors and the neighbor
+  # list are shared, and everything that depends on only some thresholds is computed once
+  # for consecutive sets with the same values of these (the sets are evaluated in this
+  # order): the neighbor histograms (CSP bands), the surface atoms, the classification and
+  # its vote matrix. The refinement is 'sequential' (refine_defects()) or 'batched'.
+  # Returns the defect types, the number of defect atoms and the history of the
+  # optimization loops of every set.
+  cna=asarray(cna)
+  coord=asarray(coord)
+  csp=asarray(csp)
+  def key(params, names):
+    return tuple([params[name] for name in names])
+  order=sorted(range(len(sets)),key=lambda s: [repr(key(sets[s],names)) for names in
+                                               (('csp_low','csp_high','csp_screw'),('surface_coord','surface_neighbors'),classification_thresholds)])
+  results=[None]*len(sets)
+  hist_key=surface_key=class_key=None
+  for s in order:
+    params=sets[s]
+    if key(params,('csp_low','csp_high','csp_screw')) != hist_key:
+      hist_key=key(params,('csp_low','csp_high','csp_screw'))
+      hist=neighbor_histograms(cna,coord,csp,neighbors,offset,params)
+      class_key=None
+    if key(params,('surface_coord','surface_neighbors')) != surface_key:
+      surface_key=key(params,('surface_coord','surface_neighbors'))
+      surface,marked_early=surface_mask(cna,coord,neighbors,offset,params)
+      class_key=None
+    if key(params,classification_thresholds) != class_key:
+      class_key=key(params,classification_thresholds)
+      classified=classify_defects(cna,coord,csp,neighbors,offset,surface,params,hist)
+      defect_atoms=int(count_nonzero((classified != blk) & ~marked_early))
+      votes=neighbor_votes(classified,neighbors,offset)
+    defect=classified.copy()
+    history=[0]
+    if defect_atoms > 0:
+      if refinement == 'batched':
+        confirmed,unidentified_orig,history=refine_defects_batched(defect,flatnonzero((defect >= vcn) & (defect <= plf)),flatnonzero(defect == els),
+                                                                   defect_atoms,neighbors,offset,keep_unidentified,verbose=False,
+                                                                   params=params,votes=votes.copy())
+      else:
+        confirmed,unidentified_orig,history=refine_defects_sequential(defect,flatnonzero((defect >= vcn) & (defect <= plf)),flatnonzero(defect == els),
+                                                                      defect_atoms,neighbors,offset,keep_unidentified,params=params,votes=votes.copy())
+    results[s]=(defect,defect_atoms,history)
+  return results
+
+def write_sweep(filename, sets, counts, results):
+  # One row per parameter set with its thresholds, the defect counts and the number of
+  # loops and finally unidentified atoms.
+  with open(filename, 'w') as out:
+    out.write('#C set '+' '.join(default_thresholds)+' '+' '.join(defect_names)+' defect_atoms loops unidentified\n')
+    for s,params in enumerate(sets):
+      defect,defect_atoms,history=results[s]
+      out.write("%d " % s+" ".join(["%g" % params[name] for name in default_thresholds])+" "+
+                " ".join(["%d" % c for c in counts[s]])+" %d %d %d\n" % (defect_atoms,len(history)-1,history[-1]))
+
+def sweep_file(filename, nr_perfect):
+  # --sweep for the remaining atoms of the current configuration (with --roi only the atoms
+  # in the region of interest are counted and labeled).
+  global atom_nrs,atom_cna,atom_coord,atom_csp,atom_neighbors,atom_neighbors_offset,atom_roi,keep_unidentified,refinement,report
+  nr_atoms=len(atom_neighbors_offset)-1
+  start_stage("Identifying defects with %d parameter sets..." % len(sweep_sets))
+  results=sweep_thresholds(sweep_sets,ctypeslib.as_array(atom_cna.get_obj()),ctypeslib.as_array(atom_coord.get_obj()),
+                           ctypeslib.as_array(atom_csp.get_obj()),atom_neighbors,atom_neighbors_offset,keep_unidentified,refinement)
+  counts=[]
+  for defect,defect_atoms,history in results:
+    count=bincount(defect[atom_roi] if atom_roi is not None else defect,minlength=els+1)
+    count[blk]+=nr_perfect
+    counts.append(count)
+  end_stage('sweep',nr_atoms*len(sweep_sets))
+  write_sweep(filename + ".sweep",sweep_sets,counts,results)
+  print("Defect counts of %d parameter sets written into file: " % len(sweep_sets), filename + ".sweep")
+  if sweep_labels:
+    selected=atom_roi if atom_roi is not None else slice(None)
+    number=asarray(atom_nrs)[selected] if atom_nrs is not None else arange(nr_atoms)[selected]
+    savez(filename + ".sweep.npz",number=number,sets=array(sweep_labels),
+          defect=array([results[label][0][selected] for label in sweep_labels],dtype=int8).reshape(len(sweep_labels),-1))
+    print("Defect types of parameter sets %s written into file: " % " ".join(map(str,sweep_labels)), filename + ".sweep.npz")
+  report['sweep']={'sets':len(sweep_sets),'counts':[dict(zip(defect_names,count.tolist())) for count in counts]}
+
+##########################################################################################
+# DEFECT CLUSTERS
+##########################################################################################
+
+def cluster_roots(centers, neighbors, nr_atoms):
+  # Union-find over the given pairs, with all unions of a sweep at once: every root is
+  # hooked under the smallest root it is linked to and the paths are compressed until
+  # every atom points to its root. Roots are the smallest atom index of each cluster.
+  parent=arange(nr_atoms)
+  while True:
+    first=parent[centers]
+    second=parent[neighbors]
+    linked=first != second
+    if not linked.any():
+      return parent
+    minimum.at(parent,maximum(first[linked],second[linked]),minimum(first[linked],second[linked]))
+    while True:
+      grandparent=parent[parent]
+      if array_equal(grandparent,parent):
+        break
+      parent=grandparent
+
+def defect_clusters(defect, neighbors, offset, positions, cell, pbc, selected=None):
+  # Connected clusters of non-bulk atoms with the same defect type in the non-bcc neighbor
+  # list (optionally only of the selected atoms). Returns one row per cluster, ordered by
+  # defect type and size: id, defect type, number of atoms, centroid, bounding box, radii of
+  # gyration along the principal axes (largest first) and these axes. Clusters are unwrapped
+  # around one of their atoms along periodic directions, so the centroid and the box of a
+  # cluster that spans a periodic cell are those of one image.
+  defect=asarray(defect)
+  nr_atoms=len(defect)
+  member=defect != blk
+  if selected is not None:
+    member&=selected
+  centers=repeat(arange(nr_atoms,dtype=neighbors.dtype),diff(offset))
+  same=member[centers] & member[neighbors] & (defect[centers] == defect[neighbors])
+  roots=cluster_roots(centers[same],neighbors[same],nr_atoms)
+  atoms=flatnonzero(member)
+  labels,cluster=unique(roots[atoms],return_inverse=True)
+  nr_clusters=len(labels)
+  if nr_clusters == 0:
+    return zeros((0,24))
+  pos=asarray(positions,dtype=float64)
+  pos=pos[labels][cluster]+periodic_offsets(pos[atoms],cell,pbc,pos[labels][cluster])
+  count=bincount(cluster,minlength=nr_clusters)
+  centroid=column_stack([bincount(cluster,weights=pos[:,k],minlength=nr_clusters) for k in range(3)])/count[:,None]
+  order=argsort(cluster,kind='stable')
+  starts=concatenate([[0],cumsum(count)[:-1]])
+  low=minimum.reduceat(pos[order],starts,axis=0)
+  high=maximum.reduceat(pos[order],starts,axis=0)
+  d=pos-centroid[cluster]
+  gyration=stack([column_stack([bincount(cluster,weights=d[:,k]*d[:,l],minlength=nr_clusters) for l in range(3)]) for k in range(3)],axis=1)/count[:,None,None]
+  values,axes=linalg.eigh(gyration)
+  radii=sqrt(maximum(values[:,::-1],0))
+  axes=axes[:,:,::-1]
+  # the largest component of every axis is positive:
+  axes*=sign(take_along_axis(axes,argmax(abs(axes),axis=1)[:,None,:],axis=1))
+  types=defect[labels]
+  rank=lexsort((labels,-count,types))
+  table=column_stack([arange(1,nr_clusters+1),types[rank],count[rank],centroid[rank],low[rank],high[rank],radii[rank],
+                      axes[rank].transpose(0,2,1).reshape(-1,9)])
+  return table
+
+def write_clusters(filename, table):
+  with open(filename, 'w') as out:
+    out.write('#C id defect atoms x y z xmin ymin zmin xmax ymax zmax r1 r2 r3 '
+              'axis1_x axis1_y axis1_z axis2_x axis2_y axis2_z axis3_x axis3_y axis3_z\n')
+    for row in table:
+      out.write("%d %d %d " % tuple(row[:3])+" ".join(["%.6f" % value for value in row[3:]])+"\n")
+
 ##########################################################################################
 # OUTPUT ATOMS
 ##########################################################################################
 
-def write_atom(i):
+def format_atom(i):
   global atom_nrs,atom_types,atom_masses,atom_pos,atom_cna,atom_coord,atom_csp,atom_defect
-
-  # write line to outfile:
-  outstr="%10d %3d %12.10f %12.6f %12.6f %12.6f %2d %2d %10.6f %d\n" % \
+  return "%10d %3d %12.10f %12.6f %12.6f %12.6f %2d %2d %10.6f %d\n" % \
          (atom_nrs[i],atom_types[i],atom_masses[i],\
           atom_pos[i][0],atom_pos[i][1],atom_pos[i][2],\
           atom_cna[i],atom_coord[i],atom_csp[i],atom_defect[i])
-  f.write(outstr)
+
+def write_atom(i):
+  # write line to outfile:
+  f.write(format_atom(i))
+
+# (width, decimals) of the columns of format_atom(); decimals=0 is an integer column:
+atom_line_format=[(10,0),(3,0),(12,10),(12,6),(12,6),(12,6),(2,0),(2,0),(10,6),(1,0)]
+
+def atom_columns(atoms):
+  # The output columns of the given atoms as arrays.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_cna,atom_coord,atom_csp,atom_defect
+  atoms=asarray(atoms,dtype=int64)
+  pos=asarray(atom_pos)[atoms]
+  return [asarray(atom_nrs)[atoms],asarray(atom_types)[atoms],asarray(atom_masses)[atoms],pos[:,0],pos[:,1],pos[:,2],
+          ctypeslib.as_array(atom_cna.get_obj())[atoms],ctypeslib.as_array(atom_coord.get_obj())[atoms],
+          ctypeslib.as_array(atom_csp.get_obj())[atoms],ctypeslib.as_array(atom_defect.get_obj())[atoms]]
+
+def fixed_digits(values, width, decimals):
+  # The characters of "%{width}.{decimals}f" (or "%{width}d" for decimals=0) of all values
+  # as a byte matrix, built from integer digits. Values longer than width widen the field
+  # like in printf; the matrix has the most common field width. Also returns the rows for
+  # which this is exactly what printf writes: values of another field width and values
+  # too close to a rounding tie are left to printf.
+  values=asarray(values)
+  if decimals == 0 and values.dtype.kind in 'iub':
+    scaled=values.astype(int64)
+    ok=ones(len(values),dtype=bool)
+    negative=scaled < 0
+  else:
+    x=values.astype(float64)
+    scaled=x*10.0**decimals
+    ok=isfinite(scaled) & (abs(scaled) < 1e15)
+    scaled=where(ok,scaled,0)
+    rounded=rint(scaled)
+    # x*10**decimals is off by at most one rounding error of the product:
+    ok&=abs(abs(scaled-rounded)-0.5) > 4e-16*abs(scaled)+1e-300
+    if decimals == 0:
+      ok&=scaled == rounded
+    negative=signbit(x) & ok
+    scaled=rounded.astype(int64)
+  digits=abs(scaled)
+  integer=digits//10**decimals
+  nr_integer=ones(len(values),dtype=int64)
+  k=1
+  while k < 19 and (integer >= 10**k).any():
+    nr_integer+=integer >= 10**k
+    k+=1
+  point=decimals+1 if decimals else 0
+  length=maximum(nr_integer+point+negative,width)
+  if ok.any():
+    width=int(argmax(bincount(length[ok])))
+  ok&=length == width
+  # fill the characters from the right, one digit per step:
+  chars=empty((len(values),width),dtype=uint8)
+  sign=negative.copy()
+  for j in range(width):
+    column=width-1-j
+    if decimals and j == decimals:
+      chars[:,column]=ord('.')
+      continue
+    visible=digits > 0
+    digits,digit=divmod(digits,10)
+    digit=(digit+ord('0')).astype(uint8)
+    if j <= point:
+      chars[:,column]=digit
+    else:
+      chars[:,column]=where(visible,digit,where(sign,ord('-'),ord(' ')))
+      sign&=visible
+  return chars,ok
+
+def format_atoms(atoms):
+  # The lines of format_atom() for all given atoms at once.
+  if atom_source is not None:
+    # (LAMMPS dumps and extended XYZ files keep their original columns)
+    return format_source(atom_source,atoms,atom_columns(atoms)[6:],source_bda_columns)
+  columns=[fixed_digits(values,width,decimals) for values,(width,decimals) in zip(atom_columns(atoms),atom_line_format)]
+  lines=full((len(atoms),sum([chars.shape[1]+1 for chars,exact in columns])),ord(' '),dtype=uint8)
+  ok=ones(len(atoms),dtype=bool)
+  start=0
+  for chars,exact in columns:
+    lines[:,start:start+chars.shape[1]]=chars
+    ok&=exact
+    start+=chars.shape[1]+1
+  lines[:,-1]=ord('\n')
+  # the few other lines are formatted one by one:
+  text=[]
+  start=0
+  for row in flatnonzero(~ok):
+    text.append(lines[start:row].tobytes().decode('ascii'))
+    text.append(format_atom(atoms[row]))
+    start=row+1
+  text.append(lines[start:].tobytes().decode('ascii'))
+  return ''.join(text)
+
+def write_atoms(atoms):
+  # Write the given atoms to the .bda file and keep their columns for the binary output.
+  # The lines are formatted in large blocks, which are handed over to the background
+  # writer if there is one.
+  global binary_chunks,writer_queue
+  for start in range(0,len(atoms),writer_block):
+    text=format_atoms(atoms[start:start+writer_block])
+    if writer_queue is not None:
+      writer_queue.put(text)
+    else:
+      f.write(text)
+  if binary_chunks is not None:
+    binary_chunks.append([value.astype(kind) for value,(name,kind) in zip(atom_columns(atoms),binary_columns)])
+
+##########################################################################################
+# COMPRESSED FILES
+##########################################################################################
+
+compress_block=1<<22 # bytes of text compressed at once by one thread
+
+def open_input(filename):
+  # Binary stream of a configuration, decompressed on the fly if it ends with .gz or .zst.
+  if filename.endswith('.gz'):
+    return gzip.open(filename,'rb')
+  if filename.endswith('.zst'):
+    if zstandard is None:
+      raise RuntimeError('reading .zst files needs the zstandard module: '+filename)
+    # (files of pzstd and of --compress zst consist of several frames)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename,'rb'),read_across_frames=True,closefd=True),
+                             buffer_size=1<<20)
+  return open(filename,'rb')
+
+def compressed_name(filename):
+  # Name of an output file with --compress:
+  return filename + "." + compress if compress else filename
+
+def compress_gz(data):
+  # One complete gzip member; concatenated members are a valid gzip file.
+  compressor=zlib.compressobj(6,zlib.DEFLATED,31)
+  return compressor.compress(data)+compressor.flush()
+
+def compress_zst(data):
+  # One complete zstd frame; concatenated frames are a valid zstd file.
+  return zstandard.ZstdCompressor(level=3).compress(data)
+
+class BlockCompressor:
+  # Text file whose content is compressed in independent blocks by a pool of threads
+  # (zlib and zstandard release the GIL) and written in the original order.
+
+  def __init__(self, filename, method):
+    self.out=open(filename,'wb')
+    self.method=compress_gz if method == 'gz' else compress_zst
+    self.threads=os.cpu_count() or 1
+    self.pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+    self.pending=[]
+    self.text=[]
+    self.size=0
+
+  def write(self, text):
+    self.text.append(text)
+    self.size+=len(text)
+    if self.size >= compress_block:
+      self.submit()
+
+  def submit(self):
+    if self.text:
+      self.pending.append(self.pool.submit(self.method,''.join(self.text).encode()))
+      self.text=[]
+      self.size=0
+    # write the finished blocks in order and keep at most two blocks per thread in memory:
+    while self.pending and (self.pending[0].done() or len(self.pending) > 2*self.threads):
+      self.out.write(self.pending.pop(0).result())
+
+  def close(self):
+    try:
+      self.submit()
+      for block in self.pending:
+        self.out.write(block.result())
+    finally:
+      self.pending=[]
+      self.pool.shutdown()
+      self.out.close()
+
+  @property
+  def closed(self):
+    return self.out.closed
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def open_output(filename, buffering=-1):
+  # Text file for writing, compressed with --compress (the name gets the extension).
+  if compress:
+    if compress == 'zst' and zstandard is None:
+      raise RuntimeError('--compress zst needs the zstandard module')
+    return BlockCompressor(compressed_name(filename),compress)
+  return open(filename, 'w', buffering=buffering)
+
+def compress_file(filename):
+  # Compress a file that was written by OVITO and remove the uncompressed file.
+  with open(filename, 'rb') as inp, open_output(filename) as out:
+    for chunk in iter(lambda: inp.read(compress_block), b''):
+      out.write(chunk.decode())
+  os.remove(filename)
+
+##########################################################################################
+# OVERLAPPING FILE ACCESS WITH THE ANALYSIS
+##########################################################################################
+
+writer_block=100000 # atoms per block formatted at once and handed to the background writer
+
+def start_writer(out):
+  # Write the blocks of write_atoms() in a background thread, so that the analysis does
+  # not wait for the (network) file system.
+  global writer_queue,writer_thread,writer_error
+  writer_queue=queue.Queue(maxsize=16)
+  writer_error=None
+  def write_blocks():
+    global writer_error
+    while True:
+      text=writer_queue.get()
+      if text is None:
+        break
+      if writer_error is None:
+        try:
+          out.write(text)
+        except Exception as error:
+          writer_error=error
+  writer_thread=threading.Thread(target=write_blocks,daemon=True)
+  writer_thread.start()
+
+def stop_writer():
+  # Wait until all blocks are written and report a failed write.
+  global writer_queue,writer_thread,writer_error
+  writer_queue.put(None)
+  writer_thread.join()
+  writer_queue=writer_thread=None
+  if writer_error is not None:
+    raise writer_error
+
+def close_output():
+  # Stop the background writer and close the .bda file after a failed analysis (a
+  # successful one has done both already). Write errors are not raised over the first error.
+  global f,writer_queue,writer_thread
+  if writer_queue is not None:
+    writer_queue.put(None)
+    writer_thread.join()
+    writer_queue=writer_thread=None
+  if f is not None and not f.closed:
+    f.close()
+
+def prefetch_file(file, chunk=1<<24):
+  # Read a configuration once, so that it is in the page cache when OVITO imports it.
+  # (OVITO pipelines cannot be built outside of the main thread, so the parsing itself
+  # stays in analyze_file().)
+  with open(file, 'rb', buffering=0) as raw:
+    if hasattr(os,'posix_fadvise'):
+      os.posix_fadvise(raw.fileno(),0,0,os.POSIX_FADV_WILLNEED)
+    buffer=bytearray(chunk)
+    while raw.readinto(buffer):
+      pass
+
+##########################################################################################
+# BINARY OUTPUT
+##########################################################################################
+
+# Columns of the binary output: the columns of the .bda file in the smallest exact types.
+binary_columns=[('number','<i8'),('type','<i4'),('mass','<f8'),('x','<f8'),('y','<f8'),('z','<f8'),
+                ('cna','u1'),('coord','u1'),('csp','<f4'),('defect','u1')]
+
+def write_binary(filename, box, chunks, format):
+  # Write the collected columns either as .npz archive or in the raw layout:
+  #   8 bytes  magic 'BDARAW01'
+  #   8 bytes  length of the header (little-endian unsigned integer)
+  #   JSON header with the atom count, the simulation cell (data.cell) and for every
+  #   column its name, NumPy dtype and byte offset from the start of the file
+  #   the columns one after another, each starting at a multiple of 64 bytes
+  columns={}
+  for c,(name,kind) in enumerate(binary_columns):
+    columns[name]=concatenate([chunk[c] for chunk in chunks]) if chunks else zeros(0,dtype=kind)
+  if format == 'npz':
+    savez(filename,cell=asarray(box,dtype=float64),**columns)
+    return
+  write_raw(filename,{'count':len(columns['number']),'cell':asarray(box,dtype=float64).tolist()},
+            [(name,columns[name]) for name,kind in binary_columns])
+
+def write_raw(filename, header, columns):
+  # Write (name, array) columns in the raw layout. Columns whose length differs from
+  # the atom count record their own count.
+  header=dict(header,columns=[])
+  # reserve space for the header including the (not yet known) column offsets:
+  offset=-(-(16+len(json.dumps(header))+96*len(columns))//64)*64
+  for name,values in columns:
+    column={'name':name,'dtype':values.dtype.str,'offset':offset}
+    if len(values) != header['count']:
+      column['count']=len(values)
+    header['columns'].append(column)
+    offset+=-(-values.nbytes//64)*64
+  text=json.dumps(header).encode()
+  with open(filename,'wb') as out:
+    out.write(b'BDARAW01')
+    out.write(len(text).to_bytes(8,'little'))
+    out.write(text)
+    for column,(name,values) in zip(header['columns'],columns):
+      out.seek(column['offset'])
+      out.write(values.tobytes())
+    out.truncate(offset)
+
+def read_binary(filename, columns=None):
+  # Map the requested columns of a binary .bda file without reading the others.
+  # Returns the simulation cell and a dictionary of arrays.
+  if filename.endswith('.npz'):
+    archive=load(filename)
+    return archive['cell'],{name:archive[name] for name in (columns or [name for name,kind in binary_columns])}
+  header,arrays=read_raw(filename,columns)
+  return asarray(header['cell']),arrays
+
+def read_raw(filename, columns=None):
+  # Header and memory-mapped columns of a file in the raw layout.
+  with open(filename,'rb') as raw:
+    if raw.read(8) != b'BDARAW01':
+      raise ValueError('not a raw binary .bda file: '+filename)
+    header=json.loads(raw.read(int.from_bytes(raw.read(8),'little')))
+  arrays={}
+  for column in header['columns']:
+    if columns is None or column['name'] in columns:
+      count=column.get('count',header['count'])
+      if count == 0:
+        arrays[column['name']]=zeros(0,dtype=column['dtype'])
+      else:
+        arrays[column['name']]=memmap(filename,dtype=column['dtype'],mode='r',offset=column['offset'],shape=(count,))
+  return header,arrays
+
+##########################################################################################
+# DESCRIPTOR FILES
+##########################################################################################
+
+def write_descriptors(filename, box, alat, nr_perfect):
+  # Keep everything the defect identification needs in the raw layout: the columns of
+  # the remaining (non-bcc) atoms and their non-bcc neighbor list.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_cna,atom_coord,atom_csp,atom_neighbors,atom_neighbors_offset,atom_roi
+  pos=asarray(atom_pos)
+  index='<i4' if len(atom_neighbors) < 2**31 else '<i8'
+  columns=[('number',asarray(atom_nrs).astype('<i8')),('type',asarray(atom_types).astype('<i4')),
+           ('mass',asarray(atom_masses).astype('<f8')),('x',pos[:,0].astype('<f8')),('y',pos[:,1].astype('<f8')),
+           ('z',pos[:,2].astype('<f8')),('cna',ctypeslib.as_array(atom_cna.get_obj()).astype('u1')),
+           ('coord',ctypeslib.as_array(atom_coord.get_obj()).astype('u1')),('csp',ctypeslib.as_array(atom_csp.get_obj()).astype('<f4')),
+           ('neighbors',asarray(atom_neighbors).astype(index)),('offset',asarray(atom_neighbors_offset).astype('<i8'))]
+  if atom_roi is not None:
+    columns.append(('roi',asarray(atom_roi).astype('u1')))
+  write_raw(filename,{'count':len(columns[0][1]),'cell':asarray(box,dtype=float64).tolist(),'alat':alat,
+                      'nr_perfect':int(nr_perfect)},columns)
+
+def reclassify_file(file):
+  # Identify the defects again from the descriptor file written with --descriptors,
+  # without OVITO.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset
+  global report,trajectory,previous_frame,atom_roi,atom_source
+  # (the .bda file is an IMD file, also after a LAMMPS dump or XYZ file in the same process)
+  atom_source=None
+  print("Working on file: ", file)
+  report={'file':file,'ovito':None,'stages':[]}
+  start_stage("Reading descriptors...")
+  header,columns=read_raw(file + ".bda.desc")
+  nr_atoms=header['count']
+  atom_nrs=columns['number']
+  atom_types=columns['type']
+  atom_masses=columns['mass']
+  atom_pos=column_stack([columns['x'],columns['y'],columns['z']])
+  atom_cna,atom_coord,atom_csp,atom_defect=shared_descriptors(columns['cna'],columns['coord'],columns['csp'],full(nr_atoms,-1))
+  atom_neighbors=asarray(columns['neighbors'])
+  atom_neighbors_offset=asarray(columns['offset'])
+  # descriptors of a region of interest also mark the atoms inside it:
+  atom_roi=asarray(columns['roi']) != 0 if 'roi' in columns else None
+  stime=end_stage('import',nr_atoms)
+  print("Using lattice parameter %.4f Angstroms of the descriptor file" % header['alat'])
+  print("Numer of remaining atoms:", nr_atoms)
+
+  incremental=trajectory and previous_frame is not None
+  write_bda=not (incremental and trajectory == 'deltas') and not summary_file
+  if write_bda:
+    start_output(file + ".bda",header['cell'])
+  return identify_and_write(file,header['cell'],nr_atoms,header['nr_perfect'],stime,incremental,write_bda)
 
 ##########################################################################################
 # GET AN ATOMS NEIGHBORS
 ##########################################################################################
 
 def get_neighbors(i):
-  global neighbor_finder
-  global atom_coord
-  return [neigh.index for neigh in neighbor_finder.find(i) if atom_cna[neigh.index] != 3 or atom_coord[neigh.index] != 14]
-  
+  global atom_neighbors,atom_neighbors_offset,neighbor_queries
+  neighbor_queries+=1
+  return atom_neighbors[atom_neighbors_offset[i]:atom_neighbors_offset[i+1]]
+
+##########################################################################################
+# BUILD THE NON-BCC NEIGHBOR LIST (CSR LAYOUT)
+##########################################################################################
+
+def build_neighbor_list(finder, cna, coord):
+  # Query the neighbor finder once for all atoms and keep only the non-bcc neighbors.
+  # The result is stored as flat arrays: the neighbors of atom i are
+  # neighbors[offset[i]:offset[i+1]].
+  cna=asarray(cna)
+  coord=asarray(coord)
+  nr_atoms=len(cna)
+  if hasattr(finder,'find_all'):
+    # OVITO >= 3.4 returns all pairs at once:
+    pairs,vectors=finder.find_all()
+    pairs=asarray(pairs,dtype=int64).reshape(-1,2)
+    order=argsort(pairs[:,0],kind='stable')
+    centers=pairs[order,0]
+    neighbors=pairs[order,1]
+  else:
+    centers=[]
+    neighbors=[]
+    for i in range(nr_atoms):
+      for neigh in finder.find(i):
+        centers.append(i)
+        neighbors.append(neigh.index)
+    centers=asarray(centers,dtype=int64)
+    neighbors=asarray(neighbors,dtype=int64)
+  nonbcc=(cna[neighbors] != 3) | (coord[neighbors] != 14)
+  centers=centers[nonbcc]
+  neighbors=neighbors[nonbcc]
+  offset=zeros(nr_atoms+1,dtype=int64)
+  cumsum(bincount(centers,minlength=nr_atoms),out=offset[1:])
+  return neighbors,offset
+
+##########################################################################################
+# NATIVE DESCRIPTOR ENGINE
+##########################################################################################
+
+# Structure types of the adaptive common neighbor analysis (as in OVITO):
+cna_other=0
+cna_fcc=1
+cna_hcp=2
+cna_bcc=3
+cna_ico=4
+
+def read_imd(filename, chunk=1<<26):
+  # Columns (by the names of the #C line) and simulation cell (cell vectors as columns
+  # and the origin as fourth column, like data.cell) of an ASCII IMD configuration.
+  with open_input(filename) as inp:
+    names,cell=read_imd_header(inp,filename)
+    blocks=list(imd_blocks(inp,len(names),chunk))
+  values=concatenate(blocks) if blocks else zeros((0,len(names)))
+  columns={name:values[:,c] for c,name in enumerate(names)}
+  columns['number']=columns['number'].astype(int64)
+  columns['type']=columns['type'].astype(int32) if 'type' in columns else zeros(len(values),dtype=int32)
+  if 'mass' not in columns:
+    columns['mass']=ones(len(values))
+  return columns,cell
+
+def read_imd_header(inp, filename):
+  # Column names and simulation cell from the header of an ASCII IMD file (up to #E).
+  names=None
+  cell=zeros((3,4))
+  for line in inp:
+    words=line.decode().split()
+    if not words:
+      continue
+    if words[0] == '#F' and words[1] != 'A':
+      raise ValueError('only ASCII IMD files can be read without OVITO: '+filename)
+    elif words[0] == '#C':
+      names=words[1:]
+    elif words[0] in ('#X','#Y','#Z'):
+      cell[:,'#X#Y#Z'.index(words[0])//2]=[float(word) for word in words[1:4]]
+    elif words[0] == '#E':
+      break
+  if names is None:
+    raise ValueError('no #C line in IMD file: '+filename)
+  return names,cell
+
+def imd_blocks(inp, nr_columns, chunk):
+  # The atoms of an ASCII IMD file after its header, parsed in large blocks that end at a
+  # line break (one row per atom).
+  rest=b''
+  while True:
+    text=inp.read(chunk)
+    if not text:
+      break
+    text=rest+text
+    end=text.rfind(b'\n')+1
+    rest=text[end:]
+    yield fromstring(text[:end].decode(),sep=' ').reshape(-1,nr_columns)
+  if rest.strip():
+    yield fromstring(rest.decode(),sep=' ').reshape(-1,nr_columns)
+
+def write_imd(filename, cell, columns, names, formats):
+  # ASCII IMD file with the given columns, e.g. the .ccc file of the native backend.
+  with open_output(filename) as out:
+    out.write('#F A 1 1 1 3 0 %d\n' % (len(names)-6))
+    out.write('#C '+' '.join(names)+'\n')
+    for d,axis in enumerate('XYZ'):
+      out.write('#%s %12.6f %12.6f %12.6f\n' % (axis,cell[0][d],cell[1][d],cell[2][d]))
+    out.write('#E\n')
+    # (in blocks, so memory-mapped columns are not copied at once)
+    for start in range(0,len(columns[0]),writer_block):
+      savetxt(out,column_stack([values[start:start+writer_block] for values in columns]),fmt=formats)
+
+def find_pairs(pos, cell, pbc, cutoff, block=65536, index=int64):
+  # All pairs of atoms not farther apart than the cutoff, found with one cell list. Periodic
+  # images are used along the directions with pbc set (the cell may be triclinic).
+  # Returns the neighbor list (the neighbors of atom i are neighbors[offset[i]:offset[i+1]],
+  # nearest first) and the vectors to the neighbors. index is the dtype of the neighbor indices.
+  pos=asarray(pos,dtype=float64)
+  cell=asarray(cell,dtype=float64)
+  nr_atoms=len(pos)
+  frac=(pos-cell[:,3])@linalg.inv(cell[:,:3]).T
+  # widths of the cell perpendicular to its faces:
+  volume=abs(linalg.det(cell[:,:3]))
+  widths=array([volume/linalg.norm(cross(cell[:,(d+1)%3],cell[:,(d+2)%3])) for d in range(3)])
+  low=zeros(3)
+  span=ones(3)
+  for d in range(3):
+    if pbc[d]:
+      if widths[d] < cutoff:
+        raise ValueError('the periodic cell is thinner than the cutoff radius')
+      frac[:,d]-=floor(frac[:,d])
+    elif nr_atoms:
+      low[d]=frac[:,d].min()
+      span[d]=maximum(frac[:,d].max()-low[d],1e-12)
+  # bins are at least as wide as the cutoff:
+  bins=maximum(floor(span*widths/cutoff),1).astype(int64)
+  b=minimum(floor((frac-low)/span*bins),bins-1).astype(int64)
+  flat=(b[:,0]*bins[1]+b[:,1])*bins[2]+b[:,2]
+  order=argsort(flat,kind='stable')
+  counts=bincount(flat,minlength=prod(bins))
+  first=concatenate([[0],cumsum(counts)])
+
+  wrapped=frac@cell[:,:3].T
+  # Half of the bin stencil is enough, the other half gives the same pairs in reverse:
+  stencil=(indices((3,3,3)).reshape(3,-1).T-1)[13:]
+  centers=[zeros(0,dtype=index)]
+  neighbors=[zeros(0,dtype=index)]
+  vectors=[zeros((0,3))]
+  for start in range(0,nr_atoms,block):
+    atoms=order[start:start+block]
+    for shift in stencil:
+      nb=b[atoms]+shift
+      image=zeros(nb.shape,dtype=int64)
+      valid=ones(len(atoms),dtype=bool)
+      for d in range(3):
+        if pbc[d]:
+          image[:,d]=floor_divide(nb[:,d],bins[d])
+          nb[:,d]-=image[:,d]*bins[d]
+        else:
+          valid&=(nb[:,d] >= 0) & (nb[:,d] < bins[d])
+      i=atoms[valid]
+      nb=nb[valid]
+      other=(nb[:,0]*bins[1]+nb[:,1])*bins[2]+nb[:,2]
+      n=counts[other]
+      # all atoms of the neighboring bin for every atom:
+      j=order[repeat(first[other]-cumsum(n)+n,n)+arange(n.sum())]
+      vector=wrapped[j]-repeat(wrapped[i]-image[valid]@cell[:,:3].T,n,axis=0)
+      i=repeat(i,n)
+      near=(vector**2).sum(axis=1) <= cutoff**2
+      if not shift.any():
+        # pairs within the same bin only once
+        near&=i < j
+      centers.append(i[near].astype(index))
+      neighbors.append(j[near].astype(index))
+      vectors.append(vector[near])
+  half=concatenate(centers)
+  centers=concatenate([half,concatenate(neighbors)])
+  neighbors=concatenate([concatenate(neighbors),half])
+  half=None
+  # the vectors of the reversed pairs are only created in the sorted result:
+  vectors=concatenate(vectors)
+  length=(vectors**2).sum(axis=1)
+  nearest=lexsort((concatenate([length,length]),centers))
+  length=None
+  offset=zeros(nr_atoms+1,dtype=int64)
+  cumsum(bincount(centers,minlength=nr_atoms),out=offset[1:])
+  centers=None
+  reverse=nearest >= len(vectors)
+  sorted_vectors=vectors[where(reverse,nearest-len(vectors),nearest)]
+  sorted_vectors[reverse]*=-1
+  return neighbors[nearest],offset,sorted_vectors
+
+def nearest_vectors(offset, vectors, k):
+  # The vectors to the k nearest neighbors of every atom (NaN where there are fewer).
+  nr_atoms=len(offset)-1
+  lengths=diff(offset)
+  rank=arange(len(vectors))-repeat(offset[:-1],lengths)
+  take=rank < k
+  near=full((nr_atoms,k,3),nan)
+  near[repeat(arange(nr_atoms),lengths)[take],rank[take]]=vectors[take]
+  return near
+
+def centrosymmetry(near):
+  # Centrosymmetry parameter from the vectors to the nearest neighbors: the sum of the
+  # N/2 smallest |r_i+r_j|^2 of all neighbor pairs.
+  first,second=triu_indices(near.shape[1],1)
+  sums=sort(((near[:,first]+near[:,second])**2).sum(axis=2),axis=1)
+  pairs=count_nonzero(~isnan(near[:,:,0]),axis=1)//2
+  return where(arange(near.shape[1]//2)[None,:] < pairs[:,None],sums[:,:near.shape[1]//2],0).sum(axis=1)
+
+def acna_cutoffs(distance, atoms):
+  # Local cutoffs of the 12-neighbor (fcc, hcp, ico) and of the 14-neighbor (bcc) test of
+  # the given atoms from the distances to their nearest neighbors.
+  return (1+sqrt(2))/2*distance[atoms,:12].mean(axis=1), \
+         (1+sqrt(2))/2*(distance[atoms,:8].sum(axis=1)*2/sqrt(3)+distance[atoms,8:14].sum(axis=1))/14
+
+def bonded_neighbors(near, cutoff):
+  # Two neighbors are bonded if closer than the local cutoff.
+  k=near.shape[1]
+  norms=(near**2).sum(axis=2)
+  bonded=norms[:,:,None]+norms[:,None,:]-2*(near@near.transpose(0,2,1)) <= cutoff[:,None,None]**2
+  bonded[:,arange(k),arange(k)]=False
+  return bonded
+
+def cna_signatures(near, cutoff):
+  # Common neighbor signatures of the bonds to the given neighbors. Returns the numbers of
+  # common neighbors and of bonds between them. The longest bond chain is only determined
+  # as far as needed to tell fcc (4,2,1), hcp (4,2,2), bcc (6,6,6)/(4,4,4) and ico (5,5,5)
+  # apart.
+  k=near.shape[1]
+  bonded=bonded_neighbors(near,cutoff)
+  adjacency=bonded.astype(float32)
+  # degree of neighbor l among the common neighbors of j:
+  degree=bonded*(adjacency@adjacency)
+  common=bonded.sum(axis=2)
+  bonds=degree.sum(axis=2)//2
+  chain=bonds.copy()
+  # (4,2): the two bonds either share an atom (chain 2) or not (chain 1)
+  pairs=(common == 4) & (bonds == 2)
+  chain[pairs]=where(degree[pairs].max(axis=1) == 2,2,1)
+  # (6,6): only a connected set of bonds is a chain of 6
+  rings=flatnonzero((common == 6) & (bonds == 6))
+  if len(rings):
+    atoms,neighbor=divmod(rings,k)
+    members=argsort(~bonded[atoms,neighbor],axis=1,kind='stable')[:,:6]
+    reach=bonded[atoms[:,None,None],members[:,:,None],members[:,None,:]] | eye(6,dtype=bool)
+    for step in range(3):
+      reach=(reach.astype(float32)@reach.astype(float32)) > 0
+    chain.reshape(-1)[rings]=where(reach.all(axis=(1,2)),6,0)
+  return common,bonds,chain
+
+def adaptive_cna(near):
+  # Adaptive common neighbor analysis (Stukowski 2012) from the vectors to the 14 nearest
+  # neighbors of every atom.
+  distance=sqrt((near**2).sum(axis=2))
+  structure=full(len(near),cna_other,dtype=int32)
+  # fcc, hcp and ico from the 12 nearest neighbors:
+  has=~isnan(distance[:,11])
+  if has.any():
+    common,bonds,chain=cna_signatures(near[has,:12],acna_cutoffs(distance,has)[0])
+    f421=((common == 4) & (bonds == 2) & (chain == 1)).sum(axis=1)
+    f422=((common == 4) & (bonds == 2) & (chain == 2)).sum(axis=1)
+    f555=((common == 5) & (bonds == 5) & (chain == 5)).sum(axis=1)
+    found=full(len(f421),cna_other,dtype=int32)
+    found[f421 == 12]=cna_fcc
+    found[(f421 == 6) & (f422 == 6)]=cna_hcp
+    found[f555 == 12]=cna_ico
+    structure[has]=found
+  # bcc from the 14 nearest neighbors:
+  has=~isnan(distance[:,13]) & (structure == cna_other)
+  if has.any():
+    common,bonds,chain=cna_signatures(near[has,:14],acna_cutoffs(distance,has)[1])
+    f666=((common == 6) & (bonds == 6) & (chain == 6)).sum(axis=1)
+    f444=((common == 4) & (bonds == 4) & (chain == 4)).sum(axis=1)
+    structure[flatnonzero(has)[(f666 == 8) & (f444 == 6)]]=cna_bcc
+  return structure
+
+def bcc_sites(near):
+  # Atoms whose 14 nearest neighbors have the ACNA bonds of a bcc crystal, found without
+  # the common neighbor signatures: the neighbors are assigned to the sites of an ideal bcc
+  # neighborhood in a local frame (any orientation), and the bonds of both ACNA tests must
+  # be those between the assigned sites. adaptive_cna() finds bcc for exactly these atoms
+  # (and maybe a few more), because the signatures only depend on the bonds.
+  found=zeros(len(near),dtype=bool)
+  complete=flatnonzero(isfinite(near[:,13,0]))
+  distance=sqrt((near**2).sum(axis=2))
+  cutoff12,cutoff14=acna_cutoffs(distance,complete)
+  near=near[complete]
+  # local frame from the nearest second neighbor and the one most perpendicular to it:
+  second=near[:,8:14]
+  e1=second[:,0]/distance[complete,8,None]
+  other=second[arange(len(near)),argmin(abs((second*e1[:,None,:]).sum(axis=2))/distance[complete,8:14],axis=1)]
+  e2=other-(other*e1).sum(axis=1)[:,None]*e1
+  e2/=sqrt((e2**2).sum(axis=1))[:,None]
+  local=near@stack([e1,e2,cross(e1,e2)],axis=2)/(cutoff14[:,None,None]*2/(1+sqrt(2)))
+  # sites of the first neighbors (0-7) by their octant and of the second neighbors (8-13)
+  # by their axis, each taken once:
+  first=((local[:,:8] > 0)*array([1,2,4])).sum(axis=2)
+  axis=argmax(abs(local[:,8:]),axis=2)
+  second=8+2*axis+(take_along_axis(local[:,8:],axis[:,:,None],axis=2)[:,:,0] > 0)
+  sites=concatenate([first,second],axis=1)
+  ok=(sort(sites,axis=1) == arange(14)).all(axis=1)
+  bonds=bcc_site_bonds[sites[:,:,None],sites[:,None,:]]
+  ok&=(bonded_neighbors(near[:,:12],cutoff12) == bonds[:,:12,:12]).reshape(len(near),-1).all(axis=1)
+  ok&=(bonded_neighbors(near,cutoff14) == bonds).reshape(len(near),-1).all(axis=1)
+  found[complete]=ok
+  return found
+
+# Sites of the 14 nearest neighbors in bcc (in units of a) and the ACNA bonds between them:
+# first-second (0.87a) and first-first (1a) neighbors, but not 1.41a and more.
+bcc_site_positions=array([[(i&1)-0.5,(i>>1&1)-0.5,(i>>2&1)-0.5] for i in range(8)]+
+                         [[(2*(i%2)-1)*(i//2 == d) for d in range(3)] for i in range(6)])
+bcc_site_bonds=((bcc_site_positions[:,None,:]-bcc_site_positions[None,:,:])**2).sum(axis=2) <= 1.01
+bcc_site_bonds[arange(14),arange(14)]=False
+
+def native_descriptors(pos, cell, pbc, cutoff, block=16384, index=int64, prefilter=False, perfect_csp=True):
+  # ACNA, coordination and 8-neighbor CSP of all atoms from one neighbor search within the
+  # cutoff. Neighbors beyond the cutoff are not considered (OVITO uses the nearest ones
+  # regardless of distance for ACNA and CSP, which only matters for strongly expanded
+  # or isolated atoms). Returns them together with the neighbor list of find_pairs().
+  # With prefilter, the common neighbor signatures are only computed for atoms other than
+  # the 14-coordinated bcc_sites() (with the same result), and without perfect_csp the
+  # CSP of those is left at 0.
+  neighbors,offset,vectors=find_pairs(pos,cell,pbc,cutoff,block=4*block,index=index)
+  coord=diff(offset).astype(int32)
+  csp=zeros(len(coord),dtype=float32)
+  cna=zeros(len(coord),dtype=int32)
+  for start in range(0,len(coord),block):
+    near=nearest_vectors(offset[start:start+block+1]-offset[start],vectors[offset[start]:offset[minimum(start+block,len(coord))]],14)
+    if prefilter:
+      candidates=flatnonzero(~((coord[start:start+block] == 14) & bcc_sites(near)))
+      cna[start:start+block]=cna_bcc
+      cna[start+candidates]=adaptive_cna(near[candidates])
+      if perfect_csp:
+        csp[start:start+block]=centrosymmetry(near[:,:8])
+      else:
+        csp[start+candidates]=centrosymmetry(near[candidates,:8])
+    else:
+      csp[start:start+block]=centrosymmetry(near[:,:8])
+      cna[start:start+block]=adaptive_cna(near)
+  return cna,coord,csp,neighbors,offset
+
+##########################################################################################
+# LAMMPS DUMP AND EXTENDED XYZ FILES
+##########################################################################################
+
+# The columns added to the original columns in the .bda file of a LAMMPS dump or an
+# extended XYZ configuration:
+source_bda_columns=[('cna','%d'),('coord','%d'),('csp','%.6f'),('defect','%d')]
+source_ccc_columns=[('StructureType','%d'),('Coordination','%d'),('Centrosymmetry','%.6f')]
+# LAMMPS boundary flags of the binary dump header:
+lammps_boundaries='pfsm'
+
+def config_format(filename):
+  # Format of a configuration from its first bytes: imd, lammps (text dump),
+  # lammps_binary or xyz (extended XYZ).
+  with open_input(filename) as inp:
+    head=inp.read(64)
+  if head.startswith(b'ITEM:'):
+    return 'lammps'
+  if head.startswith(b'#'):
+    return 'imd'
+  # binary dumps start with the timestep (or the negative length of their magic string):
+  if len(head) >= 12 and (head[8:12] == b'DUMP' or not all([32 <= c < 127 or c in (9,10,13) for c in head[:8]])):
+    return 'lammps_binary'
+  if head.split(b'\n')[0].strip().isdigit():
+    return 'xyz'
+  return 'imd'
+
+def read_configuration(filename):
+  # Columns (number, type, mass and the N x 3 positions pos), simulation cell and the
+  # original columns (None for IMD files) of a configuration of any supported format.
+  format=config_format(filename)
+  if format == 'imd':
+    columns,cell=read_imd(filename)
+    columns['pos']=column_stack([columns.pop('x'),columns.pop('y'),columns.pop('z')])
+    return columns,cell,None
+  if format == 'lammps':
+    names,table,cell,header=read_lammps_dump(filename)
+  elif format == 'lammps_binary':
+    names,table,cell,header=read_lammps_binary(filename)
+  else:
+    return read_extxyz(filename)
+  # all numeric columns of a dump are written with %.12g (like %g of LAMMPS, but exact):
+  source={'format':'lammps','names':names,'columns':table,'header':header,
+          'formats':['%s' if column.dtype.kind in 'US' else '%.12g' for column in table]}
+  count=len(table[0]) if table else 0
+  columns={'number':table[names.index('id')].astype(int64) if 'id' in names else arange(1,count+1,dtype=int64),
+           'type':table[names.index('type')].astype(int32) if 'type' in names else ones(count,dtype=int32),
+           'mass':table[names.index('mass')].astype(float64) if 'mass' in names else ones(count)}
+  for x,y,z in [('x','y','z'),('xu','yu','zu'),('xs','ys','zs'),('xsu','ysu','zsu')]:
+    if x in names and y in names and z in names:
+      break
+  else:
+    raise ValueError('no atom positions in LAMMPS dump: '+filename)
+  ix=names.index(x)
+  if names[ix:ix+3] == [x,y,z] and header.get('table') is not None:
+    # the positions of a memory-mapped binary dump are used in place:
+    pos=header.pop('table')[:,ix:ix+3]
+  else:
+    pos=column_stack([table[names.index(x)],table[names.index(y)],table[names.index(z)]])
+  header.pop('table',None)
+  if x.startswith(x[0]+'s'):
+    pos=pos@cell[:,:3].T+cell[:,3]
+  columns['pos']=pos
+  return columns,cell,source
+
+def read_lines(inp, count, chunk=1<<26):
+  # The next count lines of a binary stream (without reading further).
+  blocks=[]
+  while count > 0:
+    text=inp.read(chunk)
+    if not text:
+      break
+    ends=flatnonzero(frombuffer(text,dtype=uint8) == 10)
+    if len(ends) >= count:
+      text=text[:ends[count-1]+1]
+    count-=len(ends)
+    blocks.append(text)
+  return b''.join(blocks)
+
+def read_table(text, kinds):
+  # Columns of whitespace separated text with the given kinds: f (float), i (integer)
+  # or s (string).
+  if 's' not in kinds:
+    values=fromstring(text.decode(),sep=' ').reshape(-1,len(kinds))
+    return [values[:,c].astype(int64) if kind == 'i' else values[:,c] for c,kind in enumerate(kinds)]
+  words=array(text.decode().split()).reshape(-1,len(kinds))
+  return [words[:,c].astype(int64) if kind == 'i' else words[:,c].astype(float64) if kind == 'f' else words[:,c]
+          for c,kind in enumerate(kinds)]
+
+def lammps_cell(bounds):
+  # Cell (like data.cell) of the BOX BOUNDS of a LAMMPS dump; for triclinic boxes these
+  # are the bounds of the tilted box and the tilt factors xy, xz and yz.
+  bounds=asarray(bounds,dtype=float64)
+  lo=bounds[:,0].copy()
+  hi=bounds[:,1].copy()
+  xy,xz,yz=bounds[:,2] if bounds.shape[1] > 2 else zeros(3)
+  lo[0]-=amin([0,xy,xz,xy+xz])
+  hi[0]-=amax([0,xy,xz,xy+xz])
+  lo[1]-=amin([0,yz])
+  hi[1]-=amax([0,yz])
+  return array([[hi[0]-lo[0],xy,xz,lo[0]],[0,hi[1]-lo[1],yz,lo[1]],[0,0,hi[2]-lo[2],lo[2]]])
+
+def read_lammps_dump(filename):
+  # Column names, columns, cell and header of the first snapshot of a LAMMPS text dump.
+  header={'timestep':'0'}
+  names=count=None
+  with open_input(filename) as inp:
+    for line in inp:
+      line=line.decode()
+      if line.startswith('ITEM: TIMESTEP'):
+        header['timestep']=inp.readline().decode().strip()
+      elif line.startswith('ITEM: NUMBER OF ATOMS'):
+        count=int(inp.readline())
+      elif line.startswith('ITEM: BOX BOUNDS'):
+        header['box']=line+''.join([inp.readline().decode() for d in range(3)])
+      elif line.startswith('ITEM: ATOMS'):
+        names=line.split()[2:]
+        break
+    if names is None or count is None or 'box' not in header:
+      raise ValueError('no complete snapshot (ITEM: NUMBER OF ATOMS, BOX BOUNDS and ATOMS) in LAMMPS dump: '+filename)
+    text=read_lines(inp,count)
+  # the kinds of the columns are those of the first atom:
+  kinds=[]
+  for word in text[:text.find(b'\n')].split():
+    try:
+      float(word)
+      kinds.append('f')
+    except ValueError:
+      kinds.append('s')
+  cell=lammps_cell([line.split() for line in header['box'].splitlines()[1:4]])
+  return names,read_table(text,kinds) if count else [zeros(0) for name in names],cell,header
+
+def read_lammps_binary(filename):
+  # Column names, columns, cell and header of the first snapshot of a binary LAMMPS dump
+  # (see tools/binary2txt.cpp of LAMMPS). Compressed files are read as a stream, the atoms
+  # of uncompressed ones are memory-mapped and, if all atoms are in one chunk, the columns
+  # are views of the file.
+  compressed=filename.endswith(('.gz','.zst'))
+  with open_input(filename) as inp:
+    def read(size):
+      data=inp.read(size)
+      if len(data) != size:
+        raise ValueError('incomplete snapshot in binary LAMMPS dump: '+filename)
+      return data
+    def unpack(format):
+      return struct.unpack('<'+format,read(struct.calcsize('<'+format)))
+    timestep,=unpack('q')
+    revision=0
+    if timestep < 0:
+      magic=read(-timestep)
+      endian,revision=unpack('ii')
+      if endian != 1:
+        raise ValueError('only little-endian binary LAMMPS dumps can be read: '+filename)
+      timestep,=unpack('q')
+    count,triclinic=unpack('qi')
+    boundary=unpack('6i')
+    bounds=array(unpack('6d')).reshape(3,2)
+    if triclinic > 1:
+      raise ValueError('binary LAMMPS dumps of general triclinic boxes are not supported: '+filename)
+    if triclinic:
+      bounds=column_stack([bounds,unpack('3d')])
+    size_one,=unpack('i')
+    names=None
+    if revision > 1:
+      length,=unpack('i')
+      read(length)              # unit style
+      time_flag,=unpack('b')
+      if time_flag:
+        read(8)
+      length,=unpack('i')
+      names=read(length).decode().split()
+    if names is None:
+      if size_one != 5:
+        raise ValueError('binary LAMMPS dump without column names (written by dump custom before LAMMPS 2021): '+filename)
+      names=['id','type','xs','ys','zs']
+    chunks=[]
+    nr_chunks,=unpack('i')
+    for chunk in range(nr_chunks):
+      n,=unpack('i')
+      if compressed or n == 0:
+        chunks.append(frombuffer(read(8*n),dtype='<f8').reshape(-1,size_one))
+      else:
+        chunks.append(memmap(filename,dtype='<f8',mode='r',offset=inp.tell(),shape=(n//size_one,size_one)))
+        inp.seek(8*n,io.SEEK_CUR)
+  table=chunks[0] if len(chunks) == 1 else concatenate(chunks) if chunks else zeros((0,size_one))
+  if len(table) != count:
+    raise ValueError('incomplete snapshot in binary LAMMPS dump: '+filename)
+  flags=[lammps_boundaries[b] for b in boundary]
+  box='ITEM: BOX BOUNDS '+('xy xz yz ' if triclinic else '')+' '.join([flags[2*d]+flags[2*d+1] for d in range(3)])+'\n'
+  for row in bounds:
+    box+=' '.join(['%-1.16e' % value for value in row])+'\n'
+  return names,[table[:,c] for c in range(size_one)],lammps_cell(bounds),{'timestep':str(timestep),'box':box,'table':table}
+
+def read_extxyz(filename):
+  # Columns, cell and original columns of an extended XYZ file (its first frame).
+  with open_input(filename) as inp:
+    count=int(inp.readline())
+    comment=inp.readline().decode().rstrip('\r\n')
+    text=read_lines(inp,count)
+  info={key:value.strip('"') for key,value in re.findall(r'(\w+)=("[^"]*"|\S+)',comment)}
+  fields=info.get('Properties','species:S:1:pos:R:3').split(':')
+  names=[]
+  kinds=[]
+  for name,kind,width in zip(fields[0::3],fields[1::3],fields[2::3]):
+    for k in range(int(width)):
+      names.append(name if int(width) == 1 else '%s_%d' % (name,k))
+      kinds.append({'I':'i','R':'f'}.get(kind,'s'))
+  table=read_table(text,kinds) if count else [zeros(0) for name in names]
+  source={'format':'xyz','names':names,'columns':table,'header':{'comment':comment,'properties':':'.join(fields)},
+          'formats':['%d' if kind == 'i' else '%.12g' if kind == 'f' else '%s' for kind in kinds]}
+  if 'pos_0' not in names:
+    raise ValueError('no pos property in extended XYZ file: '+filename)
+  pos=column_stack([table[names.index('pos_%d' % d)] for d in range(3)])
+  if 'id' in names:
+    number=table[names.index('id')].astype(int64)
+  else:
+    number=arange(1,count+1,dtype=int64)
+  if 'type' in names:
+    type=table[names.index('type')].astype(int32)
+  elif 'species' in names:
+    type=(unique(table[names.index('species')],return_inverse=True)[1].reshape(-1)+1).astype(int32)
+  else:
+    type=ones(count,dtype=int32)
+  mass=table[names.index('mass')] if 'mass' in names else table[names.index('masses')] if 'masses' in names else ones(count)
+  cell=zeros((3,4))
+  if 'Lattice' in info:
+    cell[:,:3]=array(info['Lattice'].split(),dtype=float64).reshape(3,3).T
+    if 'Origin' in info:
+      cell[:,3]=array(info['Origin'].split(),dtype=float64)
+  elif count:
+    cell[:,:3]=diag(amax(pos,axis=0)-amin(pos,axis=0))
+    cell[:,3]=amin(pos,axis=0)
+  return {'number':number,'type':type,'mass':asarray(mass,dtype=float64),'pos':pos},cell,source
+
+def source_subset(source, atoms):
+  # The original columns of the given atoms (index array or mask).
+  if source is None:
+    return None
+  return dict(source,columns=[column[atoms] for column in source['columns']])
+
+def source_header(source, count, added):
+  # Header of a file in the format of the configuration with count atoms and the
+  # original columns followed by the added (name, format) columns.
+  if source['format'] == 'xyz':
+    properties=source['header']['properties']+''.join([':%s:%s:1' % (name,'I' if format == '%d' else 'R') for name,format in added])
+    comment=source['header']['comment']
+    if re.search(r'Properties=\S+',comment):
+      comment=re.sub(r'Properties=\S+',lambda match: 'Properties='+properties,comment)
+    else:
+      comment+=' Properties='+properties
+    return '%d\n%s\n' % (count,comment)
+  return ('ITEM: TIMESTEP\n%s\nITEM: NUMBER OF ATOMS\n%d\n%sITEM: ATOMS %s\n' %
+          (source['header']['timestep'],count,source['header']['box'],' '.join(source['names']+[name for name,format in added])))
+
+def write_source(filename, source, values, added):
+  # All atoms of source with the added values in the format of the configuration.
+  with open_output(filename) as out:
+    out.write(source_header(source,len(values[0]),added))
+    for start in range(0,len(values[0]),writer_block):
+      out.write(format_source(source,slice(start,start+writer_block),[column[start:start+writer_block] for column in values],added))
+
+def format_source(source, atoms, values, added):
+  # Lines of the given atoms with their original columns followed by the added values.
+  line=' '.join(source['formats']+[format for name,format in added])+'\n'
+  columns=[column[atoms].tolist() for column in source['columns']]+[asarray(column).tolist() for column in values]
+  return ''.join([line % row for row in zip(*columns)])
+
+##########################################################################################
+# REGION OF INTEREST
+##########################################################################################
+
+def periodic_offsets(pos, cell, pbc, center):
+  # Vectors from the center(s) to the atoms, as short as possible along the periodic directions.
+  d=asarray(pos,dtype=float64)-center
+  if any(pbc) and len(d):
+    h=asarray(cell,dtype=float64)[:,:3]
+    frac=d@linalg.inv(h).T
+    for k in range(3):
+      if pbc[k]:
+        frac[:,k]-=rint(frac[:,k])
+    d=frac@h.T
+  return d
+
+def roi_distance(pos, cell, pbc, roi):
+  # Distance of the atoms from the region of interest (0 inside).
+  if roi['shape'] == 'box':
+    low=array(roi['low'])
+    high=array(roi['high'])
+    d=periodic_offsets(pos,cell,pbc,(low+high)/2)
+    return linalg.norm(maximum(abs(d)-(high-low)/2,0),axis=1)
+  d=periodic_offsets(pos,cell,pbc,array(roi['center']))
+  if roi['shape'] == 'cylinder':
+    d[:,roi['axis']]=0
+  return maximum(linalg.norm(d,axis=1)-roi['radius'],0)
+
+def roi_expression(roi, distance, pbc):
+  # OVITO expression selecting the atoms farther than distance from the region of interest
+  # (the same as roi_distance() > distance for orthogonal cells).
+  distance=float(distance)
+  if roi['shape'] == 'box':
+    center=(array(roi['low'])+array(roi['high']))/2
+  else:
+    center=array(roi['center'])
+  d=[]
+  for k,axis in enumerate('XYZ'):
+    offset="(Position.%s-%r)" % (axis,float(center[k]))
+    if pbc[k]:
+      offset="(%s-CellSize.%s*rint(%s/CellSize.%s))" % (offset,axis,offset,axis)
+    d.append(offset)
+  if roi['shape'] == 'box':
+    half=(array(roi['high'])-array(roi['low']))/2
+    return "+".join(["max(abs(%s)-%r,0)^2" % (d[k],float(half[k])) for k in range(3)])+" > %r" % (distance**2)
+  if roi['shape'] == 'cylinder':
+    d=[d[k] for k in range(3) if k != roi['axis']]
+  return "+".join(["%s^2" % offset for offset in d])+" > %r" % ((roi['radius']+distance)**2)
+
+def parse_roi(values):
+  # --roi box XLO XHI YLO YHI ZLO ZHI | sphere X Y Z R | cylinder x|y|z A B R
+  shape=values[0]
+  try:
+    if shape == 'box' and len(values) == 7:
+      bounds=[float(value) for value in values[1:]]
+      if all([bounds[2*k] < bounds[2*k+1] for k in range(3)]):
+        return {'shape':'box','low':bounds[0::2],'high':bounds[1::2]}
+    elif shape == 'sphere' and len(values) == 5:
+      return {'shape':'sphere','center':[float(value) for value in values[1:4]],'radius':float(values[4])}
+    elif shape == 'cylinder' and len(values) == 5 and values[1] in ('x','y','z'):
+      # along the axis through A and B in the other two coordinates:
+      axis='xyz'.index(values[1])
+      others=[k for k in range(3) if k != axis]
+      center=[0.0,0.0,0.0]
+      center[others[0]]=float(values[2])
+      center[others[1]]=float(values[3])
+      return {'shape':'cylinder','axis':axis,'center':center,'radius':float(values[4])}
+  except ValueError:
+    pass
+  return None
+
+def roi_halo_width(cutoff):
+  # The atoms within the halo have complete neighborhoods for the descriptors, except for
+  # its outermost layer of one cutoff, and leave some shells for the neighbor tests and
+  # the optimization loops:
+  return roi_halo if roi_halo is not None else 4*cutoff
+
+def roi_atoms(atoms):
+  # The given atoms that are inside the region of interest (all of them without --roi).
+  if atom_roi is None:
+    return atoms
+  atoms=asarray(atoms,dtype=int64)
+  return atoms[atom_roi[atoms]]
+
+##########################################################################################
+# OUT-OF-CORE ANALYSIS
+##########################################################################################
+
+# With --out-of-core, the columns, descriptors, non-bcc neighbor list and defect types of a
+# configuration live in memory-mapped files of a scratch directory. The descriptors are
+# computed slab by slab along one cell vector (the atoms of every slab are stored next to
+# each other, so each slab only touches its own pages) and the defects are identified in
+# domains. The numbers of slabs and domains follow from --memory-budget and the memory
+# needed per atom of a slab (with its halo) and per remaining atom of a domain:
+slab_atom_bytes=1536
+domain_atom_bytes=2048
+
+class MappedArray:
+  # A memory-mapped array in place of a shared Array: get_obj() returns the array itself,
+  # so ctypeslib.as_array(x.get_obj()) works for both. Worker processes forked later write
+  # into the same pages of the file.
+  def __init__(self, values):
+    self.values=values
+
+  def get_obj(self):
+    return self.values
+
+  def __len__(self):
+    return len(self.values)
+
+  def __getitem__(self, i):
+    return self.values[i]
+
+  def __setitem__(self, i, value):
+    self.values[i]=value
+
+def mapped_array(directory, name, dtype, shape):
+  # New memory-mapped array (of zeros) in the given directory (empty ones stay in memory):
+  if prod(shape) == 0:
+    return zeros(shape,dtype=dtype)
+  return memmap(os.path.join(directory,name),dtype=dtype,mode='w+',shape=shape)
+
+def mapped_copy(directory, name, values, block=1<<20):
+  # Copy of an array as memory-mapped array in the given directory, written block by block.
+  copy=mapped_array(directory,name,asarray(values).dtype,shape(values))
+  for start in range(0,len(copy),block):
+    copy[start:start+block]=values[start:start+block]
+  return copy
+
+def mapped_take(directory, name, values, atoms, block):
+  # values[atoms] as memory-mapped array in the given directory, copied block by block.
+  taken=mapped_array(directory,name,values.dtype,(len(atoms),)+values.shape[1:])
+  for start in range(0,len(atoms),block):
+    taken[start:start+block]=values[atoms[start:start+block]]
+  return taken
+
+def spill_imd(filename, directory, chunk):
+  # Number, type, mass and positions of the atoms of an ASCII IMD configuration as
+  # read-only memory-mapped arrays, parsed block by block (see read_imd()), and its cell.
+  with open_input(filename) as inp:
+    names,cell=read_imd_header(inp,filename)
+    files={name:open(os.path.join(directory,name),'wb') for name in ('number','type','mass','pos')}
+    count=0
+    try:
+      for values in imd_blocks(inp,len(names),chunk):
+        values[:,names.index('number')].astype(int64).tofile(files['number'])
+        (values[:,names.index('type')].astype(int32) if 'type' in names else zeros(len(values),dtype=int32)).tofile(files['type'])
+        (values[:,names.index('mass')] if 'mass' in names else ones(len(values))).tofile(files['mass'])
+        values[:,[names.index('x'),names.index('y'),names.index('z')]].tofile(files['pos'])
+        count+=len(values)
+    finally:
+      for out in files.values():
+        out.close()
+  if count == 0:
+    raise ValueError('no atoms in IMD file: '+filename)
+  columns={name:memmap(os.path.join(directory,name),dtype=kind,mode='r',shape=size) for name,kind,size in
+           [('number',int64,(count,)),('type',int32,(count,)),('mass',float64,(count,)),('pos',float64,(count,3))]}
+  return columns,cell
+
+def slab_coordinate(pos, cell, axis, periodic):
+  # Fractional coordinate of the positions along the given cell vector (wrapped into [0,1)
+  # if it is periodic) and the number of cell vectors they were wrapped by.
+  s=(pos-cell[:,3])@linalg.inv(cell[:,:3])[axis]
+  images=floor(s) if periodic else zeros(len(s))
+  return s-images,images
+
+def slab_order(pos, cell, pbc, nr_slabs, halo, block, directory):
+  # Split the atoms into slabs with about equal numbers of atoms along the longest cell
+  # vector (from a histogram of their fractional coordinates). The slabs are at least two
+  # halos wide, so the halo of a slab only reaches into its two adjacent slabs. Returns
+  # the axis, the bounds of the slabs (in fractional coordinates), the atoms ordered by
+  # slab (in their original order within a slab, memory-mapped in the given directory) and
+  # the start of every slab in them.
+  cell=asarray(cell,dtype=float64)
+  nr_atoms=len(pos)
+  axis=int(argmax(linalg.norm(cell[:,:3],axis=0)))
+  # the halo in fractional coordinates:
+  halo*=linalg.norm(linalg.inv(cell[:,:3])[axis])
+  low,high=(0.0,1.0) if pbc[axis] else (inf,-inf)
+  if not pbc[axis]:
+    for start in range(0,nr_atoms,block):
+      s,images=slab_coordinate(pos[start:start+block],cell,axis,False)
+      low,high=minimum(low,amin(s)),maximum(high,amax(s))
+  nr_slabs=int(maximum(minimum(nr_slabs,floor((high-low)/(2*halo))),1))
+  bins=4096*nr_slabs
+  width=maximum(high-low,1e-12)/bins
+  histogram=zeros(bins,dtype=int64)
+  for start in range(0,nr_atoms,block):
+    s,images=slab_coordinate(pos[start:start+block],cell,axis,pbc[axis])
+    histogram+=bincount(minimum(maximum(((s-low)/width).astype(int64),0),bins-1),minlength=bins)
+  inner=low+(searchsorted(cumsum(histogram),arange(1,nr_slabs)*nr_atoms/nr_slabs)+1)*width
+  bounds=concatenate([[low if pbc[axis] else -inf],inner,[high if pbc[axis] else inf]])
+  # counting sort of the atoms by slab:
+  counts=zeros(nr_slabs,dtype=int64)
+  for start in range(0,nr_atoms,block):
+    s,images=slab_coordinate(pos[start:start+block],cell,axis,pbc[axis])
+    counts+=bincount(searchsorted(inner,s,side='right'),minlength=nr_slabs)
+  starts=concatenate([[0],cumsum(counts)])
+  filled=starts[:-1].copy()
+  order=mapped_array(directory,'order',int64,(nr_atoms,))
+  for start in range(0,nr_atoms,block):
+    s,images=slab_coordinate(pos[start:start+block],cell,axis,pbc[axis])
+    slab=searchsorted(inner,s,side='right')
+    for k in unique(slab):
+      atoms=start+flatnonzero(slab == k)
+      order[filled[k]:filled[k]+len(atoms)]=atoms
+      filled[k]+=len(atoms)
+  return axis,bounds,order,starts
+
+def slab_atoms(pos, cell, pbc, axis, bounds, order, starts, k, halo):
+  # The atoms of slab k followed by the atoms of the adjacent slabs (or their periodic
+  # images) within the halo: their indices and positions (with the periodic images along
+  # the axis of the slabs shifted next to slab k).
+  cell=asarray(cell,dtype=float64)
+  halo*=linalg.norm(linalg.inv(cell[:,:3])[axis])
+  atoms=[order[starts[k]:starts[k+1]]]
+  positions=[pos[atoms[0]]]
+  nr_slabs=len(starts)-1
+  if nr_slabs > 1:
+    # (the positions along the axis are not periodic anymore)
+    s,images=slab_coordinate(positions[0],cell,axis,pbc[axis])
+    positions[0]=positions[0]-images[:,None]*cell[:,axis]
+    for other in range(nr_slabs):
+      for shift in ((-1,0,1) if pbc[axis] else (0,)):
+        if (other == k and shift == 0) or bounds[other+1]+shift <= bounds[k]-halo or bounds[other]+shift >= bounds[k+1]+halo:
+          continue
+        candidates=order[starts[other]:starts[other+1]]
+        s,images=slab_coordinate(pos[candidates],cell,axis,pbc[axis])
+        near=(s+shift >= bounds[k]-halo) & (s+shift < bounds[k+1]+halo)
+        atoms.append(candidates[near])
+        positions.append(pos[candidates[near]]+(shift-images[near])[:,None]*cell[:,axis])
+  return concatenate(atoms),concatenate(positions)
+
+##########################################################################################
+# BDA ANALYZER FOR OTHER SCRIPTS AND OVITO PIPELINES
+##########################################################################################
+
+class BDAAnalyzer:
+  # The BDA without files and module globals, e.g. after importing this script with
+  # importlib (its file name is no valid module name):
+  #
+  #   analyzer=BDAAnalyzer(alat=2.8665)
+  #   defect=analyzer.analyze(positions,cell,pbc=(True,True,False))
+  #   defect=analyzer.analyze_data(data)       # OVITO DataCollection
+  #   pipeline.modifiers.append(analyzer)      # adds the particle property 'Defect'
+  #
+  # Everything an analysis needs is local to the call, so one analyzer can be used from
+  # several threads. Defects are identified with the vector engine and the batched
+  # optimization loops. Boundary regions are not cut away (use a SliceModifier before).
+  # With backend='native', analyze() works without OVITO. thresholds may change some of
+  # the default_thresholds.
+
+  def __init__(self, alat, keep_unidentified=False, backend='ovito', thresholds=None):
+    self.alat=alat
+    self.keep_unidentified=keep_unidentified
+    self.backend=backend
+    self.thresholds=dict(default_thresholds,**(thresholds or {}))
+
+  def identify(self, cna, coord, csp, neighbors, offset):
+    # Defect types of the non-bcc atoms from their ACNA, CN and CSP values and their
+    # non-bcc neighbor list (see build_neighbor_list).
+    defect,defect_atoms=identify_defects_vectorized(cna,coord,csp,neighbors,offset,self.thresholds)
+    if defect_atoms > 0:
+      refine_defects_batched(defect,flatnonzero((defect >= vcn) & (defect <= plf)),flatnonzero(defect == els),defect_atoms,
+                             neighbors,offset,self.keep_unidentified,verbose=False,params=self.thresholds)
+    return defect
+
+  def analyze_data(self, data):
+    # Defect types of all particles of a DataCollection (blk for perfect bcc atoms).
+    # The ACNA, CN and CSP properties are added to data on the way.
+    nn2_cutoff=(sqrt(2)+1)/2*self.alat
+    data.apply(CommonNeighborAnalysisModifier(mode = CommonNeighborAnalysisModifier.Mode.AdaptiveCutoff))
+    data.apply(CoordinationNumberModifier(cutoff = nn2_cutoff))
+    data.apply(CentroSymmetryModifier(num_neighbors = 8))
+    cna=asarray(data.particles.structure_types)
+    coord=asarray(data.particles['Coordination'])
+    remaining=flatnonzero((cna != 3) | (coord != 14))
+    # the neighbor finder only needs to know the remaining atoms:
+    nonbcc=data.clone()
+    nonbcc.apply(SelectExpressionModifier(expression = 'StructureType==3&&Coordination==14'))
+    nonbcc.apply(DeleteSelectedModifier())
+    neighbors,offset=build_neighbor_list(CutoffNeighborFinder(nn2_cutoff,nonbcc),cna[remaining],coord[remaining])
+    defect=full(len(cna),blk,dtype=int32)
+    defect[remaining]=self.identify(cna[remaining],coord[remaining],asarray(data.particles['Centrosymmetry'])[remaining],neighbors,offset)
+    return defect
+
+  def analyze(self, positions, cell, pbc=(True,True,True)):
+    # positions: N x 3 array; cell: the cell vectors as columns (3 x 3), optionally
+    # followed by the cell origin (3 x 4 like data.cell).
+    cell=asarray(cell,dtype=float64)
+    if cell.shape == (3,3):
+      cell=column_stack([cell,zeros(3)])
+    if self.backend == 'native':
+      cna,coord,csp,neighbors,offset=native_descriptors(positions,cell,pbc,(sqrt(2)+1)/2*self.alat)
+      remaining,neighbors,offset=extract_subgraph(neighbors,offset,(cna != 3) | (coord != 14))
+      defect=full(len(cna),blk,dtype=int32)
+      defect[remaining]=self.identify(cna[remaining],coord[remaining],csp[remaining],neighbors,offset)
+      return defect
+    data=DataCollection()
+    data.create_cell(cell,pbc=tuple(pbc))
+    particles=data.create_particles(count=len(positions))
+    particles.create_property('Position',data=positions)
+    return self.analyze_data(data)
+
+  def modify(self, frame, data):
+    # Python function modifier interface of OVITO
+    data.particles_.create_property('Defect',data=self.analyze_data(data))
+
+  __call__=modify
+
 ##########################################################################################
 # Function to control option parsing in Python
 ##########################################################################################
 
-def controller():
-  global VERBOSE,bc,br,alats,filenames,include_perfect,keep_unidentified
+def reset_state():
+  # Set the module globals of the options and of the analysis of a configuration back to
+  # their defaults, so that every job of a server starts like a new run (previous_frame
+  # is kept for --trajectory, see run_job()).
+  global roi,roi_halo,atom_roi,atom_source,binary_chunks,neighbor_queries,memory_domains,scratch_dir,report,neighbor_finder
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset
+  roi=roi_halo=atom_roi=atom_source=None
+  atom_nrs=atom_types=atom_masses=atom_pos=atom_coord=atom_csp=atom_cna=atom_defect=atom_neighbors=atom_neighbors_offset=None
+  binary_chunks=report=neighbor_finder=scratch_dir=None
+  neighbor_queries=0
+  memory_domains=1
+
+def controller(argv=None):
+  # Parse the command line (or the arguments of a server job) into the module globals.
+  global VERBOSE,bc,br,alats,filenames,include_perfect,keep_unidentified,engine,refinement,jobs,domains,binary,report_file,profile,pipeline,trajectory
+  global cache_dir,cache_size,force,descriptors,reclassify,backend,low_memory,roi,roi_halo,prefilter,clusters,summary_file,compress
+  global serve_socket,watch_dir,thresholds,sweep_sets,sweep_labels,out_of_core,memory_budget
 
 
   p = argparse.ArgumentParser(description='BDA (BCC Defect Analysis) - A novel method for identifying defects in body-centered cubic crystals. Developed and written by Johannes J. Moeller, johannes.moeller@fau.de. Please visit http://jomoeller.github.io/bda/ for further information.',
                                      prog='ovitos_bcc-defect-analysis_v2.py',
                                     usage= '%(prog)s [options]')
-  p.add_argument('-c','--config',nargs='+',help='Atomistic configuration(s) in IMD format',required=True)
+  p.add_argument('-c','--config',nargs='+',help='Atomistic configuration(s) in IMD format or, with --backend native, as LAMMPS text or binary dumps or extended XYZ files (whose .bda and .ccc files keep their format and columns), optionally compressed (.gz, or .zst with --backend native)')
   p.add_argument('-b','--boundary-conditions',nargs=3,help='Boundary conditions (0:free|1:periodic)',type=int,default=[0,0,0],metavar=('X','Y','Z'))
   p.add_argument('-a','--lattice-parameter',nargs=1,help='BCC Lattice parameter',type=float)
   p.add_argument('-p','--potential',nargs=1,help='Potential',type=str)
   p.add_argument('-r','--boundary-region',nargs=1,help='Regions to cut away from non-periodic boundaries (default: 5)',type=float,default=[5])
   p.add_argument('-i','--include-perfect',help='Include perfect lattice atoms in exported files',action='store_true')
   p.add_argument('-k','--keep-unidentified',help='Keep unidentified and do no optimization loops',action='store_true')
+  p.add_argument('--backend',help='Compute ACNA, CN and CSP with OVITO or with the built-in engine, which needs neither OVITO nor ovitos and reads ASCII IMD files (default: ovito)',choices=['ovito','native'],default='ovito')
+  p.add_argument('--prefilter',help='With --backend native, compute the common neighbor signatures only for atoms whose neighbors do not have the bonds of a perfect bcc crystal (same results, faster for mostly perfect crystals)',action='store_true')
+  p.add_argument('-e','--engine',help='Defect identification on whole arrays (vector) or atom by atom (scalar) (default: vector)',choices=['vector','scalar'],default='vector')
+  p.add_argument('--refinement',help='Optimization loops atom by atom (sequential) or as one update of all unidentified atoms per loop (batched) (default: sequential)',choices=['sequential','batched'],default='sequential')
+  p.add_argument('-j','--jobs',help='Number of configurations analyzed in parallel worker processes (default: 1)',type=int,default=1)
+  p.add_argument('-d','--domains',help='Number of spatial domains of one configuration identified in parallel worker processes; implies --refinement batched (default: 1)',type=int,default=1)
+  p.add_argument('--binary',help='Also write the columns of the .bda file as typed arrays into a .bda.npz archive or a memory-mappable .bda.raw file',choices=['npz','raw'])
+  p.add_argument('--compress',help='Write the .bda and .ccc files compressed (.bda.gz or .bda.zst) by several threads',choices=['gz','zst'])
+  p.add_argument('--clusters',help='Also write the connected clusters of atoms with the same defect type with their size, centroid, bounding box and principal axes into a .bda.clusters file',action='store_true')
+  p.add_argument('--summary-only',help='Write no .ccc and .bda files, only append the defect counts and fractions and the convergence of the optimization loops of every configuration as one row to this file (JSON lines if it ends with .json or .jsonl, otherwise CSV)',metavar='SUMMARY')
+  p.add_argument('--thresholds',help='Change thresholds of the tests, given as JSON object or file with one, e.g. \'{"csp_high": 4.2, "vote": 2}\' (names and defaults: '+', '.join(['%s=%g' % item for item in default_thresholds.items()])+')',metavar='JSON')
+  p.add_argument('--sweep',help='Also identify the defects with every parameter set of this JSON file (a list of objects with thresholds or one object whose lists are combined into a grid) from the same descriptors, refined like --refinement, and write the defect counts of every set into a .bda.sweep file',metavar='FILE')
+  p.add_argument('--sweep-labels',nargs='+',help='Write the defect types of the atoms for these parameter sets (numbers in the .bda.sweep file) into a .bda.sweep.npz file',type=int,default=[],metavar='SET')
+  p.add_argument('--report',help='Write timings, throughput, memory and classification statistics of every stage into a .bda.json file',action='store_true')
+  p.add_argument('--pipeline',help='Read the next configuration ahead and write the output in a background thread',action='store_true')
+  p.add_argument('--profile',help='Profile the defect identification with cProfile (statistics are printed and saved in a .bda.prof file)',action='store_true')
+  p.add_argument('--descriptors',help='Also write the ACNA, CN and CSP values and the non-bcc neighbor list into a .bda.desc file for --reclassify',action='store_true')
+  p.add_argument('--reclassify',help='Identify the defects again from the .bda.desc files of the configurations, without OVITO',action='store_true')
+  p.add_argument('--cache-dir',help='Keep the results in this directory and reuse them for unchanged configurations and parameters')
+  p.add_argument('--cache-size',help='Size limit of the result cache in MB; the least recently used results are removed first (default: 10240)',type=float,default=10240)
+  p.add_argument('--force',help='Analyze the configurations even if the result cache holds their results',action='store_true')
+  p.add_argument('--roi',nargs='+',help='Analyze and write only the atoms in this region of interest (box XLO XHI YLO YHI ZLO ZHI | sphere X Y Z R | cylinder x|y|z A B R, the cylinder axis is parallel to x, y or z and goes through A and B in the other two coordinates)',metavar='SHAPE')
+  p.add_argument('--roi-halo',help='Width of the halo around the region of interest whose atoms are analyzed as well (default: 4 times the cutoff for coordination analysis)',type=float)
+  p.add_argument('--low-memory',help='Keep ACNA, CN, CSP and defect types in the smallest dtypes, use int32 neighbor indices and release the perfect atoms as soon as they are counted',action='store_true')
+  p.add_argument('--out-of-core',help='With --backend native, keep the columns, descriptors, non-bcc neighbor list and defect types of an IMD configuration in memory-mapped files of a scratch directory in this directory and compute them in slabs and domains that fit into --memory-budget; implies --refinement batched (perfect atoms of -i are written slab by slab)',metavar='DIR')
+  p.add_argument('--memory-budget',help='Memory in MB for the slabs and domains of --out-of-core (default: 1024)',type=float,default=1024,metavar='MB')
+  p.add_argument('--serve',help='Keep running and analyze the jobs sent to this Unix socket (one JSON line {"args": [command line arguments]} per job, answered by one JSON line with the results and output files)',metavar='SOCKET')
+  p.add_argument('--watch',help='Keep running and analyze the jobs of the .job files (JSON like for --serve) put into this spool directory; the answers are written into .result files',metavar='DIR')
+  p.add_argument('--trajectory',help='Treat the configurations as consecutive frames and identify only atoms with a changed environment again (refined like --refinement); write the defect types of every frame (labels) or only the changes into a .bda.delta file (deltas)',choices=['labels','deltas'])
 
-  args=p.parse_args()
+  args=p.parse_args(argv)
+  reset_state()
 #  print(args.config,args.boundary_conditions,args.lattice_parameter,args.potential)
 
-  if args.config:
-    filenames = args.config
+  serve_socket = args.serve
+  watch_dir = args.watch
+  if not args.config and not (serve_socket or watch_dir):
+    p.error('the following arguments are required: -c/--config')
+  if serve_socket and watch_dir:
+    p.error('--serve and --watch cannot be combined')
+
+  filenames = args.config or []
 
   if args.boundary_conditions:
     bc = args.boundary_conditions
@@ -440,8 +2554,79 @@ def controller():
   else:
     keep_unidentified = False
 
-  known_potentials = [['Chiesa','DD_CS3-33','Men-II','Chamati','Gordon','MPG20','Marinica11','Rosato'],[2.8665,2.8665,2.8553,2.8661,2.85516,2.85516,2.814767,2.86650]] 
-  
+  engine = args.engine
+  backend = args.backend
+  refinement = args.refinement
+  jobs = args.jobs
+  domains = args.domains
+  binary = args.binary
+  report_file = args.report
+  profile = args.profile
+  pipeline = args.pipeline
+  trajectory = args.trajectory
+  cache_dir = args.cache_dir
+  cache_size = args.cache_size
+  force = args.force
+  descriptors = args.descriptors
+  reclassify = args.reclassify
+  low_memory = args.low_memory
+  prefilter = args.prefilter
+  clusters = args.clusters
+  summary_file = args.summary_only
+  try:
+    thresholds = dict(default_thresholds,**read_thresholds(args.thresholds)) if args.thresholds else dict(default_thresholds)
+    sweep_sets = read_sweep(args.sweep,thresholds) if args.sweep else None
+  except (OSError,ValueError) as error:
+    p.error(str(error))
+  sweep_labels = args.sweep_labels
+  if sweep_labels and not sweep_sets:
+    p.error('--sweep-labels needs --sweep')
+  if [label for label in sweep_labels if not 0 <= label < len(sweep_sets)]:
+    p.error('--sweep-labels must be numbers of parameter sets between 0 and %d' % (len(sweep_sets)-1))
+  compress = args.compress
+  if (compress == 'zst' or any([file.endswith('.zst') for file in filenames])) and zstandard is None:
+    p.error('.zst files need the zstandard module')
+  if backend == 'ovito' and not reclassify and any([file.endswith('.zst') for file in filenames]):
+    p.error('.zst configurations can only be read with --backend native (OVITO reads .gz files itself)')
+  if summary_file and (include_perfect or binary or trajectory == 'deltas'):
+    p.error('--summary-only cannot be used with --include-perfect, --binary or --trajectory deltas')
+  if prefilter and backend != 'native':
+    p.error('--prefilter needs --backend native')
+  if args.roi:
+    roi = parse_roi(args.roi)
+    if roi is None:
+      p.error('--roi expects box XLO XHI YLO YHI ZLO ZHI, sphere X Y Z R or cylinder x|y|z A B R')
+  roi_halo = args.roi_halo
+  if reclassify and roi:
+    p.error('--roi cannot be used with --reclassify (the region of interest of the .bda.desc file is used)')
+  if reclassify and include_perfect:
+    p.error('--include-perfect cannot be used with --reclassify (the .bda.desc file holds no perfect atoms)')
+  if trajectory and jobs > 1:
+    p.error('--trajectory and --jobs cannot be combined')
+  out_of_core = args.out_of_core
+  memory_budget = args.memory_budget
+  if out_of_core:
+    if backend != 'native':
+      p.error('--out-of-core needs --backend native')
+    if roi or trajectory or binary or reclassify or jobs > 1:
+      p.error('--out-of-core cannot be used with --roi, --trajectory, --binary, --reclassify or --jobs')
+    if memory_budget <= 0:
+      p.error('--memory-budget must be positive')
+    if not os.path.isdir(out_of_core):
+      p.error('--out-of-core needs an existing directory: '+out_of_core)
+    # the defects are identified in domains (like -d):
+    if refinement != 'batched':
+      print("Warning: --out-of-core uses --refinement batched, its results can differ from the default sequential refinement",file=sys.stderr)
+    refinement = 'batched'
+  if domains > 1:
+    # The optimization loops of the domains are synchronized after every loop,
+    # which gives the same result as --refinement batched (not the sequential one):
+    if refinement != 'batched':
+      print("Warning: -d/--domains uses --refinement batched, its results can differ from the default sequential refinement",file=sys.stderr)
+    refinement = 'batched'
+    if jobs > 1:
+      p.error('--jobs and --domains cannot be combined')
+
   alats=[]
   if args.lattice_parameter:
     for file in filenames:
@@ -450,32 +2635,81 @@ def controller():
   elif args.potential:
     for pot in known_potentials[0]:
       if pot in args.potential:
-        alats.append(known_potentials[1][known_potentials[0].index(pot)])
+        for file in filenames:
+          alats.append(known_potentials[1][known_potentials[0].index(pot)])
 #        print("Lattice parameter of ",pot," potential for all configurations: ",alats[0])
+        break
   else:
-    for pot in known_potentials[0]:
-      for file in filenames:
+    for file in filenames:
+      for pot in known_potentials[0]:
         if pot in file:
           alats.append(known_potentials[1][known_potentials[0].index(pot)])
   #        print("Lattice parameter of ",pot," potential for",file," : ",alats[-1])
-    if alats == []:
+          break
+    if len(alats) != len(filenames) and not reclassify:
       errstr=[str(pot) for pot in known_potentials[0]]
       p.error('Either --lattice-parameter or --potential is required or the filename must contain one of the recognizable potential names: '+str(errstr))
 
 
 ##########################################################################################
-# MAIN PART
+# ANALYSIS OF ONE CONFIGURATION
 ##########################################################################################
 
-def main():
-  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,neighbor_finder
-  global lasti,max_neighbors,blk,srf,vcn,dsl,twn,plf,els,include_perfect,keep_unidentified
-  global f,filenames,alats,bc,br
-  # Handle arguments passed to the script:
-  controller()
+def start_output(filename, box, count=0):
+  # Open the .bda file and write its header (count is the number of atoms that will be
+  # written, which only the header of LAMMPS dumps and XYZ files holds).
+  global f,binary,binary_chunks,pipeline
+  if pipeline:
+    f = open_output(filename, buffering=1<<24)
+  else:
+    f = open_output(filename)
+  binary_chunks=[] if binary else None
+  if atom_source is not None:
+    f.write(source_header(atom_source,count,source_bda_columns))
+  else:
+    f.write('#F A 1 1 1 3 0 4 \n')
+    f.write('#C number type mass x y z cna coord csp defect\n')
+    f.write('#X           '+str.format("{0:" ">12.6f}",box[0][0])+' '+str.format("{0:" ">12.6f}",box[0][1])+' '+str.format("{0:" ">12.6f}",box[0][2])+'\n')
+    f.write('#Y           '+str.format("{0:" ">12.6f}",box[1][0])+' '+str.format("{0:" ">12.6f}",box[1][1])+' '+str.format("{0:" ">12.6f}",box[1][2])+'\n')
+    f.write('#Z           '+str.format("{0:" ">12.6f}",box[2][0])+' '+str.format("{0:" ">12.6f}",box[2][1])+' '+str.format("{0:" ">12.6f}",box[2][2])+'\n')
+    f.write('##\n')
+    f.write('##\n')
+    f.write('#E\n')
+  if pipeline:
+    start_writer(f)
 
-  # checking for current Ovito version:
-  print("This is the BCC Defect Analysis working with OVITO", ovito.version_string)
+def shared_array(kind, values):
+  # Shared array (of the worker processes) filled with the given values:
+  shared=Array(kind,len(values))
+  ctypeslib.as_array(shared.get_obj())[:]=values
+  return shared
+
+def shared_descriptors(cna, coord, csp, defect):
+  # ACNA, CN, CSP and defect types as shared arrays. With --low-memory they are kept in the
+  # smallest dtypes: uint8 for ACNA and CN, float32 for CSP and int8 for the defect types
+  # (-1 marks atoms that are not identified yet). CN values above 255 behave like any
+  # other CN > 14 in all tests.
+  if low_memory:
+    return shared_array('B',cna),shared_array('B',minimum(coord,255)),shared_array('f',csp),shared_array('b',defect)
+  return shared_array('i',cna),shared_array('i',coord),shared_array('f',csp),shared_array('i',defect)
+
+def compact_neighbors(neighbors, offset):
+  # int32 neighbor indices with --low-memory (the offsets stay int64):
+  if low_memory and len(offset) <= 2**31:
+    return asarray(neighbors).astype(int32,copy=False)
+  return neighbors
+
+def analyze_file(file):
+  if out_of_core:
+    return analyze_file_out_of_core(file)
+  if backend == 'native':
+    return analyze_file_native(file)
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset,neighbor_finder
+  global include_perfect,keep_unidentified,engine,refinement,domains
+  global f,filenames,alats,bc,br,binary,binary_chunks,report,report_file,profile,pipeline,trajectory,previous_frame,neighbor_queries,low_memory,atom_roi
+  global atom_source
+  # (the .bda file is an IMD file, also after a LAMMPS dump or XYZ file in the same process)
+  atom_source=None
 
   # Handle non-periodic boundary conditions:
   if bc[0] == 0: xtrafo=1.1
@@ -485,271 +2719,981 @@ def main():
   if bc[2] == 0: ztrafo=1.1
   else: ztrafo=1
 
-  # Define numbers for defects:
-  blk=0
-  srf=1
-  vcn=2
-  dsl=3
-  twn=4
-  plf=5
-  els=6
-
-  for file in filenames:
-    stime=0
-    node = None
-    print("Working on file: ", file)
-#    print(include_perfect)
-    # Get the corresponding lattice parameter and cutoff radius:
-    alat=alats[filenames.index(file)]
-    nearest_neighbors=8
-    nn_cutoff=(sqrt(3)/2+1)/2*alat
-    nn2_cutoff=(sqrt(2)+1)/2*alat
-    print("Using lattice parameter %.4f Angstroms (cutoff for coordination analyis: %.4f Angstroms)" % (alat,nn2_cutoff))
-
-    # Import the file to OVITO and immediately remove it from the viewport (to possibly save memory)  
-    print("Importing file...", end="",flush=True)
-    time1=time.time()
-    node = import_file(file)
-    data = node.compute()
-    box = asarray(data.cell)
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    # Get the min and max values of the imported configuration:
-    pos_min=amin(data.particles.positions, axis=0)
-    pos_max=amax(data.particles.positions, axis=0)
-    dist=[0,0,0]
-    slice=[0,0,0]
-    for i in range(3):
-      dist[i]=(pos_max[i]+pos_min[i])/2
-      slice[i]=(pos_max[i]-pos_min[i])-2*br[0]
-
-    # define the modifiers to be applied:
-    trafo=AffineTransformationModifier(operate_on = {'cell'},transformation=[[xtrafo,0,0,0],[0,ytrafo,0,0],[0,0,ztrafo,0]])
-    trafo2=AffineTransformationModifier(operate_on = {'cell'},transformation=[[1/xtrafo,0,0,0],[0,1/ytrafo,0,0],[0,0,1/ztrafo,0]])
-    csp=CentroSymmetryModifier(num_neighbors = nearest_neighbors)
-    cna=CommonNeighborAnalysisModifier(mode = CommonNeighborAnalysisModifier.Mode.AdaptiveCutoff)
-    coord=CoordinationNumberModifier(cutoff = nn2_cutoff)
-
-    # append the modifiers to the node:
-    node.modifiers.append(trafo)
-    node.modifiers.append(cna)
-    print("Computing adaptive common neighbor analysis...", end="",flush=True)
-    time1=time.time()
-    node.compute() 
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    node.modifiers.append(coord)
-    print("Computing coordination analysis...", end="",flush=True)
-    time1=time.time()
-    node.compute() 
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    print("Computing centrosymmetry parameter...", end="",flush=True)
-    time1=time.time()
-    node.modifiers.append(csp)
-    node.compute() 
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    node.modifiers.append(trafo2)
-
-    # cut away the non-periodic boundary regions if desired:
-    if br != 0:
-      if bc[0] == 0 and br[0] != 0: 
-        slice1=SliceModifier(normal=(1,0,0),slice_width=slice[0]) 
-        node.modifiers.append(slice1)
-        slice1.distance=dist[0]
-      if bc[1] == 0 and br[0] != 0:     
-        slice2=SliceModifier(normal=(0,1,0),slice_width=slice[1]) 
-        node.modifiers.append(slice2)
-        slice2.distance=dist[1]
-      if bc[2] == 0 and br[0] != 0: 
-        slice3=SliceModifier(normal=(0,0,1),slice_width=slice[2]) 
-        node.modifiers.append(slice3)
-        slice3.distance=dist[2]
-    
-    print("Cutting away atoms at non-periodic boundaries...", end="",flush=True)
-    time1=time.time()
-    data = node.compute()
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    # We start here with the output in case also perfect atoms should be included in the output:
-    nr_atoms=data.particles.count	# will be overwritten later on
-    filename=file + ".bda"
-    f = open(filename, 'w')
-    f.write('#F A 1 1 1 3 0 4 \n')
-    f.write('#C number type mass x y z cna coord csp defect\n')
-    f.write('#X           '+str.format("{0:" ">12.6f}",box[0][0])+' '+str.format("{0:" ">12.6f}",box[0][1])+' '+str.format("{0:" ">12.6f}",box[0][2])+'\n')
-    f.write('#Y           '+str.format("{0:" ">12.6f}",box[1][0])+' '+str.format("{0:" ">12.6f}",box[1][1])+' '+str.format("{0:" ">12.6f}",box[1][2])+'\n')
-    f.write('#Z           '+str.format("{0:" ">12.6f}",box[2][0])+' '+str.format("{0:" ">12.6f}",box[2][1])+' '+str.format("{0:" ">12.6f}",box[2][2])+'\n')
-    f.write('##\n')
-    f.write('##\n')
-    f.write('#E\n')
+  stime=0
+  node = None
+  print("Working on file: ", file)
+  report={'file':file,'ovito':ovito.version_string,'stages':[]}
+#  print(include_perfect)
+  # Get the corresponding lattice parameter and cutoff radius:
+  alat=alats[filenames.index(file)]
+  nearest_neighbors=8
+  nn_cutoff=(sqrt(3)/2+1)/2*alat
+  nn2_cutoff=(sqrt(2)+1)/2*alat
+  print("Using lattice parameter %.4f Angstroms (cutoff for coordination analyis: %.4f Angstroms)" % (alat,nn2_cutoff))
 
-    if include_perfect:
-    
-      print("Writing %d atoms in perfect bcc environment..." % nr_atoms, end="", flush=True)
-      atom_nrs=data.particles.identifiers
-      atom_types=data.particles.particle_types
-      atom_masses=data.particles.masses
-      atom_pos=data.particles.positions
-      atom_cna=Array('i',data.particles.structure_types)
-      atom_coord=Array('i',data.particles['Coordination'])
-      atom_csp=Array('f',data.particles['Centrosymmetry'])
-      atom_defect=Array('i',[-1]*len(atom_nrs))
-
-      for i in range(nr_atoms):
-        if atom_cna[i]==3 and atom_coord[i]==14:
-          atom_defect[i]=0
-          write_atom(i)
-        
-    select_perfect=SelectExpressionModifier(expression = 'StructureType==3&&Coordination==14')
-    delete_selected=DeleteSelectedModifier()
-    node.modifiers.append(select_perfect)
-    node.modifiers.append(delete_selected)
-    print("Deleting atoms in perfect bcc environment...", end="",flush=True)
-    time1=time.time()
-    data = node.compute()    
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    print("Preparing non-bcc neighbor finder...", end="",flush=True) 
-    time1=time.time()
-    neighbor_finder = CutoffNeighborFinder(nn2_cutoff, data)
-    time2=time.time()
-    ntime=(time2-time1)
-    stime+=ntime
-    print(" done in %.1f seconds!" % ntime)
-
-    # exporting the node to the file:
-    print("Exporting values of ACNA, CN, and CSP to file: ", file + ".ccc")
-    export_file(node, file + ".ccc", "imd")
+  # Import the file to OVITO and immediately remove it from the viewport (to possibly save memory)  
+  start_stage("Importing file...")
+  node = import_file(file)
+  data = node.compute()
+  box = asarray(data.cell)
+  stime+=end_stage('import',data.particles.count)
+
+  # Get the min and max values of the imported configuration:
+  pos_min=amin(data.particles.positions, axis=0)
+  pos_max=amax(data.particles.positions, axis=0)
+  dist=[0,0,0]
+  slice=[0,0,0]
+  for i in range(3):
+    dist[i]=(pos_max[i]+pos_min[i])/2
+    slice[i]=(pos_max[i]-pos_min[i])-2*br[0]
+
+  # define the modifiers to be applied:
+  trafo=AffineTransformationModifier(operate_on = {'cell'},transformation=[[xtrafo,0,0,0],[0,ytrafo,0,0],[0,0,ztrafo,0]])
+  trafo2=AffineTransformationModifier(operate_on = {'cell'},transformation=[[1/xtrafo,0,0,0],[0,1/ytrafo,0,0],[0,0,1/ztrafo,0]])
+  csp=CentroSymmetryModifier(num_neighbors = nearest_neighbors)
+  cna=CommonNeighborAnalysisModifier(mode = CommonNeighborAnalysisModifier.Mode.AdaptiveCutoff)
+  coord=CoordinationNumberModifier(cutoff = nn2_cutoff)
+
+  # only the atoms in the region of interest and its halo are analyzed:
+  if roi:
+    halo=roi_halo_width(nn2_cutoff)
+    node.modifiers.append(SelectExpressionModifier(expression = roi_expression(roi,halo,bc)))
+    node.modifiers.append(DeleteSelectedModifier())
+
+  # append the modifiers to the node:
+  node.modifiers.append(trafo)
+  node.modifiers.append(cna)
+  start_stage("Computing adaptive common neighbor analysis...")
+  node.compute() 
+  stime+=end_stage('acna',data.particles.count)
+
+  node.modifiers.append(coord)
+  start_stage("Computing coordination analysis...")
+  node.compute() 
+  stime+=end_stage('coordination',data.particles.count)
+
+  start_stage("Computing centrosymmetry parameter...")
+  node.modifiers.append(csp)
+  node.compute() 
+  stime+=end_stage('csp',data.particles.count)
 
-    # We continue to work on the remaining atoms:
+  node.modifiers.append(trafo2)
 
-    # Oh my god, this is sooo advanced:
-    max_neighbors=max(data.particles['Coordination'])
-    nr_atoms=data.particles.count
-    print("Numer of remaining atoms:", nr_atoms)
+  # cut away the non-periodic boundary regions if desired:
+  if br != 0:
+    if bc[0] == 0 and br[0] != 0: 
+      slice1=SliceModifier(normal=(1,0,0),slice_width=slice[0]) 
+      node.modifiers.append(slice1)
+      slice1.distance=dist[0]
+    if bc[1] == 0 and br[0] != 0:     
+      slice2=SliceModifier(normal=(0,1,0),slice_width=slice[1]) 
+      node.modifiers.append(slice2)
+      slice2.distance=dist[1]
+    if bc[2] == 0 and br[0] != 0: 
+      slice3=SliceModifier(normal=(0,0,1),slice_width=slice[2]) 
+      node.modifiers.append(slice3)
+      slice3.distance=dist[2]
+  
+  start_stage("Cutting away atoms at non-periodic boundaries...")
+  data = node.compute()
+  stime+=end_stage('slicing',data.particles.count)
+
+  # Later frames of a trajectory start from the defects of the previous frame:
+  incremental=trajectory and previous_frame is not None
+  # With --trajectory deltas only the first frame is written completely:
+  write_bda=not (incremental and trajectory == 'deltas') and not summary_file
 
-    print("Identifying defects...") 
+  # We start here with the output in case also perfect atoms should be included in the output:
+  nr_atoms=data.particles.count	# will be overwritten later on
+  filename=file + ".bda"
+  if write_bda:
+    start_output(filename,box)
+  if roi:
+    inside=roi_distance(data.particles.positions,box,bc,roi) <= 0
+    nr_perfect=count_nonzero(inside & (asarray(data.particles.structure_types) == 3) & (asarray(data.particles['Coordination']) == 14))
 
+  if include_perfect and write_bda:
+  
+    start_stage("Writing %d atoms in perfect bcc environment..." % nr_atoms)
     atom_nrs=data.particles.identifiers
     atom_types=data.particles.particle_types
     atom_masses=data.particles.masses
     atom_pos=data.particles.positions
-    atom_cna=Array('i',data.particles.structure_types)
-    atom_coord=Array('i',data.particles['Coordination'])
-    atom_csp=Array('f',data.particles['Centrosymmetry'])
-    atom_defect=Array('i',[-1]*len(atom_nrs))
-#    atom_neighbors=Array('i',[-1]*len(atom_nrs))
-    atom_neighbors=full((len(atom_nrs),max_neighbors), -1,dtype=int)
-#    print(atom_neighbors)
-    
-    identified=[]
-    unidentified=[]
-    time1=time.time()
-    defect_atoms=0
+    perfect=(asarray(data.particles.structure_types) == 3) & (asarray(data.particles['Coordination']) == 14)
+    atom_cna,atom_coord,atom_csp,atom_defect=shared_descriptors(data.particles.structure_types,data.particles['Coordination'],
+                                                                data.particles['Centrosymmetry'],where(perfect,blk,-1))
+    write_atoms(flatnonzero(perfect & inside) if roi else flatnonzero(perfect))
+    stime+=end_stage('output_perfect',nr_atoms)
+    # the perfect atoms are not needed anymore:
+    atom_nrs=atom_types=atom_masses=atom_pos=atom_cna=atom_coord=atom_csp=atom_defect=perfect=None
+      
+  select_perfect=SelectExpressionModifier(expression = 'StructureType==3&&Coordination==14')
+  if roi:
+    # the outermost layer of the halo misses neighbors and is taken as perfect bcc:
+    select_perfect.expression='(StructureType==3&&Coordination==14)||('+roi_expression(roi,maximum(halo-nn2_cutoff,0),bc)+')'
+  delete_selected=DeleteSelectedModifier()
+  node.modifiers.append(select_perfect)
+  node.modifiers.append(delete_selected)
+  start_stage("Deleting atoms in perfect bcc environment...")
+  data = node.compute()    
+  stime+=end_stage('deletion',nr_atoms)
+
+  start_stage("Preparing non-bcc neighbor finder...")
+  neighbor_finder = CutoffNeighborFinder(nn2_cutoff, data)
+  stime+=end_stage('neighbor_finder',data.particles.count)
+
+  # exporting the node to the file:
+  if not summary_file:
+    print("Exporting values of ACNA, CN, and CSP to file: ", compressed_name(file + ".ccc"))
+    start_stage(None)
+    export_file(node, file + ".ccc", "imd")
+    if compress:
+      compress_file(file + ".ccc")
+    stime+=end_stage('export_ccc',data.particles.count,quiet=True)
+
+  # We continue to work on the remaining atoms:
+  if not roi:
+    nr_perfect=nr_atoms-data.particles.count
+  nr_atoms=data.particles.count
+  print("Numer of remaining atoms:", nr_atoms)
+
+  atom_nrs=data.particles.identifiers
+  atom_types=data.particles.particle_types
+  atom_masses=data.particles.masses
+  atom_pos=data.particles.positions
+  atom_cna,atom_coord,atom_csp,atom_defect=shared_descriptors(data.particles.structure_types,data.particles['Coordination'],
+                                                              data.particles['Centrosymmetry'],full(nr_atoms,-1))
+  atom_roi=roi_distance(atom_pos,box,bc,roi) <= 0 if roi else None
+
+  # The non-bcc neighbors of all atoms are queried only once and then shared by all
+  # classifiers and the optimization loops:
+  start_stage("Building non-bcc neighbor list...")
+  atom_neighbors,atom_neighbors_offset=build_neighbor_list(neighbor_finder,data.particles.structure_types,data.particles['Coordination'])
+  atom_neighbors=compact_neighbors(atom_neighbors,atom_neighbors_offset)
+  neighbor_finder=None
+  neighbor_queries+=nr_atoms
+  ntime=end_stage('neighbor_list',nr_atoms,quiet=True)
+  stime+=ntime
+  print(" done in %.1f seconds! (%d neighbor pairs)" % (ntime,len(atom_neighbors)))
+
+  if descriptors:
+    start_stage(None)
+    write_descriptors(file + ".bda.desc",box,alat,nr_perfect)
+    stime+=end_stage('export_descriptors',nr_atoms,quiet=True)
+    print("Descriptors and non-bcc neighbor list written into file: ", file + ".bda.desc")
+
+  if low_memory:
+    # Copy the columns of the remaining atoms out of OVITO and release the pipeline with
+    # all (also the perfect) atoms before the identification:
+    atom_nrs=array(atom_nrs)
+    atom_types=array(atom_types)
+    atom_masses=array(atom_masses)
+    atom_pos=array(atom_pos)
+    data=node=None
+
+  return identify_and_write(file,box,nr_atoms,nr_perfect,stime,incremental,write_bda)
+
+def analyze_file_native(file):
+  # Same analysis as analyze_file() with the native descriptor engine instead of OVITO.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset
+  global include_perfect,filenames,alats,bc,br,report,trajectory,previous_frame,neighbor_queries,atom_roi,atom_source
+
+  # (set again below for LAMMPS dumps and XYZ files)
+  atom_source=None
+  stime=0
+  print("Working on file: ", file)
+  report={'file':file,'ovito':None,'backend':'native','stages':[]}
+  alat=alats[filenames.index(file)]
+  nn2_cutoff=(sqrt(2)+1)/2*alat
+  print("Using lattice parameter %.4f Angstroms (cutoff for coordination analyis: %.4f Angstroms)" % (alat,nn2_cutoff))
+
+  start_stage("Importing file...")
+  # (LAMMPS dumps and extended XYZ files are written back in their format with all columns)
+  columns,box,source=read_configuration(file)
+  pos=columns.pop('pos')
+  nr_atoms=len(pos)
+  stime+=end_stage('import',nr_atoms)
+  if nr_atoms:
+    pos_min=amin(pos,axis=0)
+    pos_max=amax(pos,axis=0)
+
+  if roi:
+    # Only the atoms in the region of interest and its halo are analyzed:
+    halo=roi_halo_width(nn2_cutoff)
+    start_stage("Selecting the region of interest and a halo of %.2f Angstroms..." % halo)
+    distance=roi_distance(pos,box,[c != 0 for c in bc],roi)
+    selected=flatnonzero(distance <= halo)
+    columns={name:values[selected] for name,values in columns.items()}
+    source=source_subset(source,selected)
+    pos=pos[selected]
+    distance=distance[selected]
+    nr_atoms=len(pos)
+    stime+=end_stage('roi',nr_atoms)
+
+  start_stage("Computing adaptive common neighbor analysis, coordination and centrosymmetry parameter...")
+  # the CSP of perfect atoms is only written with -i:
+  if low_memory:
+    # smaller blocks and int32 neighbor indices:
+    cna,coord,csp,neighbors,offset=native_descriptors(pos,box,[c != 0 for c in bc],nn2_cutoff,block=4096,
+                                                      index=int32 if nr_atoms < 2**31 else int64,
+                                                      prefilter=prefilter,perfect_csp=include_perfect)
+  else:
+    cna,coord,csp,neighbors,offset=native_descriptors(pos,box,[c != 0 for c in bc],nn2_cutoff,
+                                                      prefilter=prefilter,perfect_csp=include_perfect)
+  neighbor_queries+=nr_atoms
+  stime+=end_stage('descriptors',nr_atoms)
+  if roi:
+    # the outermost layer of the halo misses neighbors and is taken as perfect bcc:
+    frame=distance > maximum(halo-nn2_cutoff,0)
+    cna[frame]=3
+    coord[frame]=14
+
+  # cut away the non-periodic boundary regions if desired:
+  start_stage("Cutting away atoms at non-periodic boundaries...")
+  kept=ones(nr_atoms,dtype=bool)
+  if nr_atoms:
+    for i in range(3):
+      if bc[i] == 0 and br[0] != 0:
+        kept&=abs(pos[:,i]-(pos_max[i]+pos_min[i])/2) <= (pos_max[i]-pos_min[i])/2-br[0]
+  stime+=end_stage('slicing',count_nonzero(kept))
+
+  incremental=trajectory and previous_frame is not None
+  write_bda=not (incremental and trajectory == 'deltas') and not summary_file
+  filename=file + ".bda"
+  perfect=kept & (cna == 3) & (coord == 14)
+  inside=distance <= 0 if roi else kept
+  atom_source=source
+  if write_bda:
+    # the header of LAMMPS dumps and XYZ files needs the number of atoms written:
+    start_output(filename,box,count_nonzero(kept & inside & (~perfect | include_perfect)))
+
+  if include_perfect and write_bda:
+    start_stage("Writing %d atoms in perfect bcc environment..." % count_nonzero(kept & inside))
+    atom_nrs=columns['number']
+    atom_types=columns['type']
+    atom_masses=columns['mass']
+    atom_pos=pos
+    atom_cna,atom_coord,atom_csp,atom_defect=shared_descriptors(cna,coord,csp,where(perfect,blk,-1))
+    write_atoms(flatnonzero(perfect & inside))
+    stime+=end_stage('output_perfect',count_nonzero(kept & inside))
+    atom_nrs=atom_types=atom_masses=atom_pos=atom_cna=atom_coord=atom_csp=atom_defect=None
+
+  # The neighbor list of the remaining atoms is the one of the descriptors without the
+  # perfect and the cut away atoms:
+  start_stage(None)
+  remaining,atom_neighbors,atom_neighbors_offset=extract_subgraph(neighbors,offset,kept & ~perfect)
+  atom_neighbors=compact_neighbors(atom_neighbors,atom_neighbors_offset)
+  # the neighbor list of all atoms is not needed anymore:
+  neighbors=offset=None
+  nr_perfect=count_nonzero(perfect & inside)
+  atom_roi=inside[remaining] if roi else None
+  nr_atoms=len(remaining)
+  stime+=end_stage('neighbor_list',nr_atoms,quiet=True)
+
+  atom_nrs=columns['number'][remaining]
+  atom_types=columns['type'][remaining]
+  atom_masses=columns['mass'][remaining]
+  atom_pos=pos[remaining]
+  atom_cna,atom_coord,atom_csp,atom_defect=shared_descriptors(cna[remaining],coord[remaining],csp[remaining],full(nr_atoms,-1))
+  atom_source=source_subset(source,remaining)
+
+  if not summary_file:
+    print("Exporting values of ACNA, CN, and CSP to file: ", compressed_name(file + ".ccc"))
+    start_stage(None)
+    if atom_source is not None:
+      write_source(file + ".ccc",atom_source,[cna[remaining],coord[remaining],csp[remaining]],source_ccc_columns)
+    else:
+      write_imd(file + ".ccc",box,[atom_nrs,atom_types,atom_masses,atom_pos[:,0],atom_pos[:,1],atom_pos[:,2],cna[remaining],coord[remaining],csp[remaining]],
+                ['number','type','mass','x','y','z','StructureType','Coordination','Centrosymmetry'],'%d %d %.6f %.6f %.6f %.6f %d %d %.6f')
+    stime+=end_stage('export_ccc',nr_atoms,quiet=True)
+  print("Numer of remaining atoms:", nr_atoms)
+  # release the columns of all atoms:
+  columns=pos=cna=coord=csp=kept=perfect=remaining=inside=distance=source=None
+
+  if descriptors:
+    start_stage(None)
+    write_descriptors(file + ".bda.desc",box,alat,nr_perfect)
+    stime+=end_stage('export_descriptors',nr_atoms,quiet=True)
+    print("Descriptors and non-bcc neighbor list written into file: ", file + ".bda.desc")
+
+  return identify_and_write(file,box,nr_atoms,nr_perfect,stime,incremental,write_bda)
+
+def analyze_file_out_of_core(file):
+  # Same analysis as analyze_file_native() with the columns, descriptors, neighbor list and
+  # defect types in memory-mapped files of a scratch directory (see OUT-OF-CORE ANALYSIS).
+  # Only the perfect atoms of -i are written in another order, slab by slab.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset
+  global include_perfect,filenames,alats,bc,br,report,neighbor_queries,atom_roi,atom_source,memory_domains,scratch_dir
+
+  atom_source=None
+  if config_format(file) != 'imd':
+    raise ValueError('--out-of-core only reads ASCII IMD files: '+file)
+  stime=0
+  print("Working on file: ", file)
+  report={'file':file,'ovito':None,'backend':'native','stages':[]}
+  alat=alats[filenames.index(file)]
+  nn2_cutoff=(sqrt(2)+1)/2*alat
+  print("Using lattice parameter %.4f Angstroms (cutoff for coordination analyis: %.4f Angstroms)" % (alat,nn2_cutoff))
+  budget=memory_budget*2**20
+  # atoms per block of the passes over the memory-mapped arrays:
+  block=int(maximum(budget/domain_atom_bytes/4,4096))
+  pbc=[c != 0 for c in bc]
+  scratch_dir=tempfile.mkdtemp(prefix='bda-',dir=out_of_core)
+  try:
+    start_stage("Importing file into %s..." % scratch_dir)
+    columns,box=spill_imd(file,scratch_dir,int(minimum(maximum(budget//8,1<<20),1<<26)))
+    pos=columns['pos']
+    nr_atoms=len(pos)
+    pos_min=full(3,inf)
+    pos_max=full(3,-inf)
+    for start in range(0,nr_atoms,block):
+      pos_min=minimum(pos_min,amin(pos[start:start+block],axis=0))
+      pos_max=maximum(pos_max,amax(pos[start:start+block],axis=0))
+    stime+=end_stage('import',nr_atoms)
+
+    # the halo holds the complete neighborhoods of the atoms of a slab:
+    halo=1.01*nn2_cutoff
+    axis,bounds,order,starts=slab_order(pos,box,pbc,int(ceil(nr_atoms*slab_atom_bytes/budget)),halo,block,scratch_dir)
+    nr_slabs=len(starts)-1
+    slab_pbc=[pbc[d] and (nr_slabs == 1 or d != axis) for d in range(3)]
+
+    write_bda=not summary_file
+    filename=file + ".bda"
+    if write_bda:
+      start_output(filename,box)
+
+    start_stage("Computing adaptive common neighbor analysis, coordination and centrosymmetry parameter in %d slabs..." % nr_slabs)
+    # the descriptors are kept in the order of the slabs:
+    cna=mapped_array(scratch_dir,'cna',int32,(nr_atoms,))
+    coord=mapped_array(scratch_dir,'coord',int32,(nr_atoms,))
+    csp=mapped_array(scratch_dir,'csp',float32,(nr_atoms,))
+    remaining=[zeros(0,dtype=int64)]
+    remaining_slab=[zeros(0,dtype=int64)]
+    lengths=[zeros(0,dtype=int64)]
+    nr_perfect=0
+    with open(os.path.join(scratch_dir,'pairs'),'wb') as pairs:
+      for k in range(nr_slabs):
+        atoms,positions=slab_atoms(pos,box,pbc,axis,bounds,order,starts,k,halo)
+        owned=starts[k+1]-starts[k]
+        if owned == 0:
+          continue
+        slab_cna,slab_coord,slab_csp,neighbors,offset=native_descriptors(positions,box,slab_pbc,nn2_cutoff,block=4096,
+                                                                         index=int32 if len(atoms) < 2**31 else int64,
+                                                                         prefilter=prefilter,perfect_csp=include_perfect)
+        neighbor_queries+=owned
+        slab_cna,slab_coord,slab_csp,own=slab_cna[:owned],slab_coord[:owned],slab_csp[:owned],atoms[:owned]
+        cna[starts[k]:starts[k+1]]=slab_cna
+        coord[starts[k]:starts[k+1]]=slab_coord
+        csp[starts[k]:starts[k+1]]=slab_csp
+        # cut away the non-periodic boundary regions if desired:
+        slab_pos=pos[own]
+        kept=ones(owned,dtype=bool)
+        for i in range(3):
+          if bc[i] == 0 and br[0] != 0:
+            kept&=abs(slab_pos[:,i]-(pos_max[i]+pos_min[i])/2) <= (pos_max[i]-pos_min[i])/2-br[0]
+        perfect=kept & (slab_cna == 3) & (slab_coord == 14)
+        nr_perfect+=count_nonzero(perfect)
+        if include_perfect and write_bda:
+          atom_nrs=columns['number'][own]
+          atom_types=columns['type'][own]
+          atom_masses=columns['mass'][own]
+          atom_pos=slab_pos
+          atom_cna,atom_coord,atom_csp,atom_defect=[MappedArray(values) for values in (slab_cna,slab_coord,slab_csp,where(perfect,blk,-1))]
+          write_atoms(flatnonzero(perfect))
+        # all neighbors of the remaining atoms (the remaining ones among them are selected below):
+        rows=flatnonzero(kept & ~perfect)
+        reached,row_lengths=gather_neighbors(neighbors,offset,rows)
+        atoms[reached].astype(int64).tofile(pairs)
+        remaining.append(own[rows])
+        remaining_slab.append(starts[k]+rows)
+        lengths.append(row_lengths.astype(int64))
+    atoms=positions=neighbors=offset=None
+    stime+=end_stage('descriptors',nr_atoms)
+
+    # The neighbor list of the remaining atoms in their original order:
+    start_stage(None)
+    remaining=concatenate(remaining)
+    sorting=argsort(remaining,kind='stable')
+    remaining=remaining[sorting]
+    remaining_slab=concatenate(remaining_slab)[sorting]
+    pair_offset=concatenate([[0],cumsum(concatenate(lengths))])
+    lengths=None
+    pair_atoms=memmap(os.path.join(scratch_dir,'pairs'),dtype=int64,mode='r') if pair_offset[-1] else zeros(0,dtype=int64)
+    nr_remaining=len(remaining)
+    index=int32 if nr_remaining < 2**31 else int64
+    atom_neighbors_offset=mapped_array(scratch_dir,'offset',int64,(nr_remaining+1,))
+    with open(os.path.join(scratch_dir,'neighbors'),'wb') as out:
+      for start in range(0,nr_remaining,block):
+        reached,row_lengths=gather_neighbors(pair_atoms,pair_offset,sorting[start:start+block])
+        ranks=minimum(searchsorted(remaining,reached),nr_remaining-1)
+        inside=remaining[ranks] == reached
+        ranks[inside].astype(index).tofile(out)
+        rows=repeat(arange(len(row_lengths)),row_lengths)[inside]
+        atom_neighbors_offset[start+1:start+1+len(row_lengths)]=atom_neighbors_offset[start]+cumsum(bincount(rows,minlength=len(row_lengths)))
+    if atom_neighbors_offset[-1]:
+      atom_neighbors=memmap(os.path.join(scratch_dir,'neighbors'),dtype=index,mode='r')
+    else:
+      atom_neighbors=zeros(0,dtype=index)
+    pair_atoms=pair_offset=sorting=None
+    stime+=end_stage('neighbor_list',nr_remaining,quiet=True)
+
+    atom_nrs=mapped_take(scratch_dir,'remaining_number',columns['number'],remaining,block)
+    atom_types=mapped_take(scratch_dir,'remaining_type',columns['type'],remaining,block)
+    atom_masses=mapped_take(scratch_dir,'remaining_mass',columns['mass'],remaining,block)
+    atom_pos=mapped_take(scratch_dir,'remaining_pos',pos,remaining,block)
+    atom_cna=MappedArray(mapped_take(scratch_dir,'remaining_cna',cna,remaining_slab,block))
+    atom_coord=MappedArray(mapped_take(scratch_dir,'remaining_coord',coord,remaining_slab,block))
+    atom_csp=MappedArray(mapped_take(scratch_dir,'remaining_csp',csp,remaining_slab,block))
+    atom_defect=MappedArray(mapped_array(scratch_dir,'remaining_defect',int32,(nr_remaining,)))
+    atom_defect.values[:]=-1
+    atom_roi=None
+
+    if not summary_file:
+      print("Exporting values of ACNA, CN, and CSP to file: ", compressed_name(file + ".ccc"))
+      start_stage(None)
+      write_imd(file + ".ccc",box,[atom_nrs,atom_types,atom_masses,atom_pos[:,0],atom_pos[:,1],atom_pos[:,2],atom_cna.values,atom_coord.values,atom_csp.values],
+                ['number','type','mass','x','y','z','StructureType','Coordination','Centrosymmetry'],'%d %d %.6f %.6f %.6f %.6f %d %d %.6f')
+      stime+=end_stage('export_ccc',nr_remaining,quiet=True)
+    print("Numer of remaining atoms:", nr_remaining)
+    # release the columns of all atoms:
+    columns=pos=order=cna=coord=csp=remaining=remaining_slab=None
+
+    if descriptors:
+      start_stage(None)
+      write_descriptors(file + ".bda.desc",box,alat,nr_perfect)
+      stime+=end_stage('export_descriptors',nr_remaining,quiet=True)
+      print("Descriptors and non-bcc neighbor list written into file: ", file + ".bda.desc")
+
+    # the defects are identified in as many domains as the memory budget needs:
+    memory_domains=int(ceil(nr_remaining*domain_atom_bytes/budget))
+    return identify_and_write(file,box,nr_remaining,nr_perfect,stime,False,write_bda)
+  finally:
+    atom_nrs=atom_types=atom_masses=atom_pos=atom_cna=atom_coord=atom_csp=atom_defect=atom_neighbors=atom_neighbors_offset=None
+    memory_domains=1
+    shutil.rmtree(scratch_dir,ignore_errors=True)
+    scratch_dir=None
+
+def identify_and_write(file, box, nr_atoms, nr_perfect, stime, incremental, write_bda):
+  # Identify the defects of the remaining atoms from their descriptors and non-bcc
+  # neighbor list and write the results. stime is the time spent before.
+  global atom_nrs,atom_types,atom_masses,atom_pos,atom_coord,atom_csp,atom_cna,atom_defect,atom_neighbors,atom_neighbors_offset
+  global include_perfect,keep_unidentified,engine,refinement,domains,memory_domains,scratch_dir
+  global f,binary,binary_chunks,report,report_file,profile,pipeline,trajectory,previous_frame,atom_roi,clusters,bc
+  filename=file + ".bda"
+  # (--out-of-core splits the identification into at least memory_domains domains)
+  nr_domains=maximum(domains,memory_domains)
+
+  print("Identifying defects...") 
   
-    for i in range(nr_atoms):
+  time1=time.time()
+  if profile:
+    profiler=cProfile.Profile()
+    profiler.enable()
+  if incremental:
+    if atom_nrs is None:
+      raise RuntimeError('--trajectory needs the atom numbers of every frame')
+    start_stage(None)
+    defect=ctypeslib.as_array(atom_defect.get_obj())
+    defect_atoms,confirmed,unidentified_orig,history=update_defects_incremental(previous_frame,atom_nrs,ctypeslib.as_array(atom_cna.get_obj()),
+                                                                                ctypeslib.as_array(atom_coord.get_obj()),ctypeslib.as_array(atom_csp.get_obj()),
+                                                                                atom_neighbors,atom_neighbors_offset,defect,keep_unidentified,refinement)
+    end_stage('refinement',nr_atoms,quiet=True)
+    written=flatnonzero((defect == srf) | (defect == blk))
+    loop_count=len(history)-1
+    report['refinement']={'mode':'incremental','loops':loop_count,'unidentified':history,
+                          'converged':bool(history[-1] <= thresholds['converged']*defect_atoms)}
+  else:
+    if nr_domains > 1:
+      start_stage("Decomposing into %d domains..." % nr_domains)
+      defect_atoms=start_domains(nr_domains,atom_neighbors,atom_neighbors_offset,domains,scratch_dir)
+      end_stage('decomposition',nr_atoms)
+      start_stage(None)
+      identify_defects_domains()
+    elif engine == 'scalar':
+      start_stage(None)
+      defect_atoms=identify_defects(nr_atoms)
+    else:
+      start_stage(None)
+      defect,defect_atoms=identify_defects_vectorized(ctypeslib.as_array(atom_cna.get_obj()),ctypeslib.as_array(atom_coord.get_obj()),
+                                                      ctypeslib.as_array(atom_csp.get_obj()),atom_neighbors,atom_neighbors_offset)
+      ctypeslib.as_array(atom_defect.get_obj())[:]=defect
+    defect=ctypeslib.as_array(atom_defect.get_obj())
+    end_stage('classification',nr_atoms,quiet=True)
+    report['accepted']=dict(zip(defect_names,bincount(defect,minlength=els+1).tolist()))
+
+    # surface and bulk atoms are written first:
+    written=flatnonzero((defect == srf) | (defect == blk))
+    identified=flatnonzero((defect >= vcn) & (defect <= plf))
+    unidentified=flatnonzero(defect == els)
 
-      # first check if this atom has already been tested:
-      if atom_defect[i] == -1:
-        # check only those atoms that are non-bcc according to CNA and CN:
-        if atom_cna[i]!=3 or atom_coord[i]!=14:
-          defect_atoms+=1
-          if is_surface(i):
-            write_atom(i)
-            pass
-          elif is_vac(i):
-            identified.append(i)
-            pass
-          elif is_twin(i):
-            identified.append(i)
-            pass
-          elif is_planarfault(i):
-            identified.append(i)
-            pass
-          elif is_dislo(i):
-            identified.append(i)
-            pass
-          else:
-            # not yet identified defects
-            # can be twins or dislocations
-            atom_defect[i]=els
-            unidentified.append(i)
-        else:
-          # write bulk atoms:
-          atom_defect[i]=blk
-          write_atom(i)
-      else:
-        write_atom(i)
- 
     print("Number of non-surface defect atoms: ", defect_atoms,"(",defect_atoms/nr_atoms*100,"% of all atoms)")
     print("Identified defect atoms after initial run: ", len(identified),"(",len(identified)/defect_atoms*100,"% )")
     print("Unidentified defect atoms after initial run: ", len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
 
     # Check if an atom's defect is the most common one of its neighbors and occurs >= 3 times
     # else throw it into the list of unidentified atoms.
-  
-    for i in identified:
-      cd = common_neighbor_defect(i)
-      if atom_defect[i] == cd:
-        write_atom(i)
-      else:      
-        unidentified.append(i)
-        # defect type is not changed here, but later when all atoms have been checked. 
-        # Otherwise, the changing behavior could be cascade like.	 
-  
-    print("Unidentified defect atoms after re-checking already identified atoms: ", len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
-
-    loop_count=0
-    unidentified_orig=unidentified
-    llen=0
- 
-    for i in unidentified_orig:
-      atom_defect[i]=els
- 
-    # Comment the following while loop for debugging purposes:
-    if not keep_unidentified:
-      while len(unidentified)/defect_atoms > 0.005 and len(unidentified) != llen:
-        loop_count+=1
-        print("Entering loop nr.",loop_count)
-        list=unidentified
-        llen=len(unidentified)
-        unidentified=[]
-        for i in list:
-          cd = common_neighbor_defect(i)
-          if atom_defect[i] != cd:
-            atom_defect[i] = cd 
-          else:
-            atom_defect[i]=els
-            unidentified.append(i)
-        print("Unidentified atoms after loop nr.",loop_count,": ",len(unidentified),"(",len(unidentified)/defect_atoms*100,"% )")
+    start_stage(None)
+    if nr_domains > 1:
+      confirmed,unidentified_orig,history=refine_defects_batched(defect,identified,unidentified,defect_atoms,
+                                                                 atom_neighbors,atom_neighbors_offset,keep_unidentified,decide_domains)
+      stop_domains()
+    elif refinement == 'batched':
+      confirmed,unidentified_orig,history=refine_defects_batched(defect,identified,unidentified,defect_atoms,
+                                                                 atom_neighbors,atom_neighbors_offset,keep_unidentified)
+    else:
+      confirmed,unidentified_orig,history=refine_defects(identified.tolist(),unidentified.tolist(),defect_atoms,keep_unidentified)
+    end_stage('refinement',len(unidentified_orig),quiet=True)
+    loop_count=len(history)-1
+    report['refinement']={'mode':refinement,'loops':loop_count,'unidentified':history,
+                          'converged':bool(history[-1] <= thresholds['converged']*defect_atoms)}
+  if profile:
+    profiler.disable()
+    profiler.dump_stats(file + ".bda.prof")
+    pstats.Stats(profiler,stream=sys.stdout).sort_stats('cumulative').print_stats(20)
 
-    for i in unidentified_orig:
-      write_atom(i)
-   
-    time2=time.time()      
+  start_stage(None)
+  if write_bda:
+    # with --roi only the atoms in the region of interest:
+    write_atoms(roi_atoms(written))
+    write_atoms(roi_atoms(confirmed))
+    write_atoms(roi_atoms(unidentified_orig))
+    if pipeline:
+      stop_writer()
     f.close()
-    print("All bulk and (un)identified atoms written into file: ", filename) 
-    print("Took %0.1f seconds" % (time2-time1))
+    print("All bulk and (un)identified atoms written into file: ", compressed_name(filename))
+    if binary:
+      write_binary(filename + "." + binary,box,binary_chunks,binary)
+      binary_chunks=None
+      print("Binary columns written into file: ", filename + "." + binary)
+  if incremental and trajectory == 'deltas':
+    changes=write_deltas(filename + ".delta",previous_frame,atom_nrs,defect)
+    print("%d changed defect types written into file: " % changes, filename + ".delta")
+  if clusters:
+    table=defect_clusters(defect,atom_neighbors,atom_neighbors_offset,atom_pos,box,bc,atom_roi)
+    write_clusters(filename + ".clusters",table)
+    report['clusters']=dict(zip(defect_names,bincount(table[:,1].astype(int64),minlength=els+1).tolist()))
+    print("%d defect clusters written into file: " % len(table), filename + ".clusters")
+  if sweep_sets:
+    sweep_file(filename,nr_perfect)
+  if trajectory:
+    if atom_nrs is None:
+      raise RuntimeError('--trajectory needs the atom numbers of every frame')
+    previous_frame=frame_state(atom_nrs,ctypeslib.as_array(atom_cna.get_obj()),ctypeslib.as_array(atom_coord.get_obj()),
+                               ctypeslib.as_array(atom_csp.get_obj()),atom_neighbors_offset,defect)
+  end_stage('output',nr_atoms,quiet=True)
+  time2=time.time()      
+  print("Took %0.1f seconds" % (time2-time1))
+
+  if atom_roi is not None:
+    # the atoms of the halo are not counted:
+    counts=bincount(defect[atom_roi],minlength=els+1)
+    report['halo_remaining_atoms']=int(nr_atoms-count_nonzero(atom_roi))
+  else:
+    counts=bincount(defect,minlength=els+1)
+  counts[blk]+=nr_perfect
+  report.update({'atoms':int(counts.sum()),'remaining_atoms':int(nr_atoms),'defect_atoms':defect_atoms,
+                 'counts':dict(zip(defect_names,counts.tolist())),'seconds':stime+time2-time1})
+  if report_file:
+    write_report(file + ".bda.json")
+    print("Performance report written into file: ", file + ".bda.json")
+  return {'file':file,'atoms':int(counts.sum()),'defect_atoms':defect_atoms,'loops':loop_count,
+          'converged':report['refinement']['converged'],'unidentified':int(history[-1]),
+          'counts':dict(zip(defect_names,counts.tolist())),'seconds':stime+time2-time1}
+
+##########################################################################################
+# PERFORMANCE INSTRUMENTATION
+##########################################################################################
+
+def peak_rss():
+  # Peak resident set size of this process in MB (None where it is not available):
+  if resource is None:
+    return None
+  rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return rss/1024**2
+  return rss/1024
+
+def start_stage(text):
+  global stage_clock
+  if text:
+    print(text, end="",flush=True)
+  stage_clock=(time.time(),time.process_time(),neighbor_queries)
+
+def end_stage(name, atoms, quiet=False):
+  # Record wall and CPU time, throughput, peak memory and neighbor queries of the stage
+  # started by the last start_stage() and return its wall time.
+  global stage_clock,report
+  wall=time.time()-stage_clock[0]
+  cpu=time.process_time()-stage_clock[1]
+  report['stages'].append({'name':name,'wall_seconds':wall,'cpu_seconds':cpu,'atoms':int(atoms),
+                           'atoms_per_second':atoms/wall if wall > 0 else None,
+                           'peak_rss_mb':peak_rss(),'neighbor_queries':neighbor_queries-stage_clock[2]})
+  if not quiet:
+    print(" done in %.1f seconds!" % wall)
+  return wall
+
+def write_report(filename):
+  global report
+  with open(filename, 'w') as out:
+    # (NumPy scalars are written as the corresponding Python values)
+    json.dump(report,out,indent=1,default=lambda value: value.item())
+
+##########################################################################################
+# BATCH MODE FOR MANY CONFIGURATIONS
+##########################################################################################
+
+def analyze_file_isolated(file):
+  # Worker of the batch mode: each worker process has its own copy of the module globals
+  # and builds its own OVITO pipeline. Its output goes to a log file next to the .bda file
+  # and errors are reported back instead of ending the whole batch.
+  with open(file + ".bda.log", 'w') as log:
+    with contextlib.redirect_stdout(log):
+      try:
+        return analyze_file_cached(file)
+      except Exception:
+        traceback.print_exc(file=log)
+        return {'file':file,'error':traceback.format_exc().strip().splitlines()[-1]}
+
+def analyze_batch(files, jobs):
+  # Schedule the largest files first, so that no worker is left with a large file at the end:
+  files=sorted(files,key=os.path.getsize,reverse=True)
+  results=[]
+  with Pool(processes=jobs,maxtasksperchild=1) as pool:
+    for result in pool.imap_unordered(analyze_file_isolated,files):
+      if 'error' in result:
+        print("Failed: %s (%s)" % (result['file'],result['error']))
+      else:
+        print("Finished: %s (%d defect atoms, %.1f seconds)" % (result['file'],result['defect_atoms'],result['seconds']))
+        if summary_file:
+          # only this process appends to the summary file:
+          append_summary(summary_file,result)
+      results.append(result)
+  return results
+
+def print_summary(results):
+  print("Summary of %d configurations:" % len(results))
+  print("%-40s %10s %10s " % ("file","atoms","seconds") + " ".join(["%10s" % name for name in defect_names]))
+  total=zeros(els+1,dtype=int64)
+  for result in sorted(results,key=lambda result: result['file']):
+    if 'error' in result:
+      print("%-40s FAILED: %s" % (result['file'],result['error']))
+      continue
+    counts=[result['counts'][name] for name in defect_names]
+    total+=counts
+    print("%-40s %10d %10.1f " % (result['file'],result['atoms'],result['seconds']) + " ".join(["%10d" % c for c in counts]))
+  print("%-40s %10s %10s " % ("total","","") + " ".join(["%10d" % c for c in total]))
+  failed=[result['file'] for result in results if 'error' in result]
+  if failed:
+    print("%d of %d configurations failed, see the .bda.log files of: %s" % (len(failed),len(results),", ".join(failed)))
+
+def append_summary(filename, result):
+  # One row per configuration for --summary-only: counts and fractions of all defect types
+  # and the convergence of the optimization loops.
+  fractions=[result['counts'][name]/result['atoms'] if result['atoms'] else 0.0 for name in defect_names]
+  if filename.endswith(('.json','.jsonl')):
+    row={'file':result['file'],'atoms':result['atoms'],'defect_atoms':result['defect_atoms'],'counts':result['counts'],
+         'fractions':dict(zip(defect_names,fractions)),'loops':result['loops'],'converged':result['converged'],
+         'unidentified':result['unidentified'],'seconds':result['seconds']}
+    with open(filename, 'a') as out:
+      out.write(json.dumps(row,default=lambda value: value.item())+'\n')
+    return
+  new=not os.path.exists(filename) or os.path.getsize(filename) == 0
+  with open(filename, 'a', newline='') as out:
+    rows=csv.writer(out)
+    if new:
+      rows.writerow(['file','atoms','defect_atoms']+defect_names+[name+'_fraction' for name in defect_names]+
+                    ['loops','converged','unidentified','seconds'])
+    rows.writerow([result['file'],result['atoms'],result['defect_atoms']]+[result['counts'][name] for name in defect_names]+
+                  ['%.8g' % fraction for fraction in fractions]+[result['loops'],int(result['converged']),result['unidentified'],'%.3f' % result['seconds']])
+
+##########################################################################################
+# RESULT CACHE
+##########################################################################################
+
+def write_json(filename, content):
+  # Write to a temporary file first, so that readers never see a partial file:
+  tmp=filename + ".%d.tmp" % os.getpid()
+  with open(tmp, 'w') as out:
+    json.dump(content,out,indent=1,default=lambda value: value.item())
+  os.replace(tmp,filename)
+
+def file_digest(file):
+  # blake2b hash of the file content. The hash is remembered together with size and
+  # modification time, so unchanged files are not read again.
+  stat=os.stat(file)
+  memo=os.path.join(cache_dir,'files',hashlib.blake2b(os.path.abspath(file).encode(),digest_size=16).hexdigest()+'.json')
+  try:
+    with open(memo) as inp:
+      known=json.load(inp)
+    if known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+      return known['digest']
+  except (OSError,ValueError,KeyError):
+    pass
+  digest=hashlib.blake2b()
+  with open(file, 'rb') as inp:
+    for chunk in iter(lambda: inp.read(1<<24), b''):
+      digest.update(chunk)
+  os.makedirs(os.path.dirname(memo),exist_ok=True)
+  write_json(memo,{'file':os.path.abspath(file),'size':stat.st_size,'mtime':stat.st_mtime_ns,'digest':digest.hexdigest()})
+  return digest.hexdigest()
+
+def cache_key(file):
+  # Everything that changes the results: the input, the effective parameters and this script.
+  params={'alat':alats[filenames.index(file)],'bc':list(bc),'br':list(br),'include_perfect':include_perfect,
+          'keep_unidentified':keep_unidentified,'engine':engine,'refinement':refinement,'backend':backend,'outputs':cache_outputs(''),
+          'roi':roi,'roi_halo':roi_halo,'out_of_core':out_of_core is not None,'thresholds':thresholds,'sweep':sweep_sets,'sweep_labels':sweep_labels}
+  key=hashlib.blake2b(digest_size=20)
+  key.update(file_digest(file).encode())
+  key.update(json.dumps(params,sort_keys=True).encode())
+  with open(os.path.abspath(__file__), 'rb') as inp:
+    key.update(inp.read())
+  return key.hexdigest()
+
+def cache_outputs(file):
+  # (with --summary-only no per-atom files are written)
+  outputs=[] if summary_file else [compressed_name(file + ".bda"),compressed_name(file + ".ccc")]
+  if binary:
+    outputs.append(file + ".bda." + binary)
+  if report_file:
+    outputs.append(file + ".bda.json")
+  if clusters:
+    outputs.append(file + ".bda.clusters")
+  if descriptors:
+    outputs.append(file + ".bda.desc")
+  if sweep_sets:
+    outputs.append(file + ".bda.sweep")
+  if sweep_labels:
+    outputs.append(file + ".bda.sweep.npz")
+  return outputs
+
+def restore_cached(file, key):
+  # Reuse the outputs next to the configuration if they are still the ones in the cache,
+  # otherwise copy them back. Returns the summary of the analysis or None.
+  entry=os.path.join(cache_dir,key)
+  try:
+    with open(os.path.join(entry,'summary.json')) as inp:
+      summary=json.load(inp)
+  except (OSError,ValueError):
+    return None
+  try:
+    for output in cache_outputs(file):
+      cached=os.path.join(entry,os.path.basename(output))
+      stat=os.stat(cached)
+      if os.path.exists(output) and os.path.getsize(output) == stat.st_size and os.stat(output).st_mtime_ns == stat.st_mtime_ns:
+        continue
+      shutil.copy2(cached,output)
+    os.utime(entry)
+  except OSError:
+    # the entry was evicted in the meantime
+    return None
+  summary['file']=file
+  return summary
+
+def store_cached(file, key, summary):
+  entry=os.path.join(cache_dir,key)
+  tmp=entry + ".%d.tmp" % os.getpid()
+  os.makedirs(tmp,exist_ok=True)
+  for output in cache_outputs(file):
+    shutil.copy2(output,os.path.join(tmp,os.path.basename(output)))
+  write_json(os.path.join(tmp,'summary.json'),summary)
+  shutil.rmtree(entry,ignore_errors=True)
+  os.replace(tmp,entry)
+
+def evict_cache():
+  # Remove the least recently used results until the cache fits into --cache-size.
+  entries=[]
+  for name in os.listdir(cache_dir):
+    entry=os.path.join(cache_dir,name)
+    if name == 'files' or name.endswith('.tmp') or not os.path.isdir(entry):
+      continue
+    size=0
+    for output in os.listdir(entry):
+      size+=os.path.getsize(os.path.join(entry,output))
+    entries.append((os.stat(entry).st_mtime,size,entry))
+  total=0
+  for mtime,size,entry in entries:
+    total+=size
+  for mtime,size,entry in sorted(entries):
+    if total <= cache_size*1024*1024:
+      break
+    shutil.rmtree(entry,ignore_errors=True)
+    total-=size
+
+def analyze_file_cached(file):
+  try:
+    if reclassify:
+      return reclassify_file(file)
+    # Trajectory frames depend on the previous frame and profiles are wanted fresh,
+    # so these are never taken from the cache.
+    if cache_dir is None or trajectory or profile:
+      return analyze_file(file)
+    os.makedirs(cache_dir,exist_ok=True)
+    key=cache_key(file)
+    if not force:
+      summary=restore_cached(file,key)
+      if summary is not None:
+        print("Using cached results for file: ", file)
+        return summary
+    summary=analyze_file(file)
+    store_cached(file,key,summary)
+    evict_cache()
+    return summary
+  finally:
+    # (also if the analysis failed)
+    close_output()
+
+##########################################################################################
+# SERVER MODE
+##########################################################################################
+
+# A server imports OVITO and NumPy only once and then analyzes jobs as they arrive, e.g.
+# every snapshot of a running simulation:
+#
+#   ovitos ovitos_bcc-defect-analysis.py --serve /tmp/bda.sock
+#   echo '{"args": ["-c", "dump.1000", "-a", "2.8665"]}' | nc -U /tmp/bda.sock
+#
+# A job holds the command line arguments of one run (relative paths are relative to the
+# directory of the server). The answer holds the results of analyze_file(), the output
+# files of every configuration and the printed log, or an error. Jobs are analyzed one
+# after the other; with --trajectory a job continues from the last frame of the jobs before.
+
+def job_outputs(file):
+  # The files written for a configuration by the last job:
+  outputs=cache_outputs(file)
+  if trajectory == 'deltas':
+    outputs.append(file + ".bda.delta")
+  return [output for output in outputs if os.path.exists(output)]
+
+def run_job(request):
+  # Analyze one job (a dict with the command line arguments in 'args') and return the answer.
+  global previous_frame
+  log=io.StringIO()
+  try:
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+      try:
+        controller([str(arg) for arg in request['args']])
+      except SystemExit:
+        raise ValueError('invalid arguments')
+      if serve_socket or watch_dir:
+        raise ValueError('--serve and --watch cannot be used in jobs')
+      if ovito is None and backend == 'ovito' and not reclassify:
+        raise RuntimeError('OVITO is required to analyze configurations (use --backend native or --reclassify without it)')
+      if not trajectory:
+        previous_frame=None
+      results=analyze_files()
+    answer={'results':results,'outputs':{file:job_outputs(file) for file in filenames},'log':log.getvalue()}
+    if summary_file:
+      answer['summary']=summary_file
+    return answer
+  except Exception:
+    return {'error':traceback.format_exc().strip().splitlines()[-1],'log':log.getvalue()}
+
+class JobHandler(socketserver.StreamRequestHandler):
+  # One JSON line per job and one JSON line per answer.
+
+  def handle(self):
+    for line in self.rfile:
+      if not line.strip():
+        continue
+      try:
+        request=json.loads(line)
+      except ValueError:
+        answer={'error':'no JSON job: '+line.decode(errors='replace').strip()}
+      else:
+        answer=run_job(request)
+      self.wfile.write((json.dumps(answer,default=lambda value: value.item())+'\n').encode())
+      self.wfile.flush()
+
+def serve(socket_path):
+  # Answer the jobs sent to a Unix socket until the server is interrupted.
+  if os.path.exists(socket_path):
+    os.remove(socket_path)
+  with socketserver.UnixStreamServer(socket_path,JobHandler) as server:
+    print("Waiting for jobs on socket: ", socket_path, flush=True)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      os.remove(socket_path)
+
+def watch(spool, interval=0.2):
+  # Analyze the .job files of a spool directory in the order of their arrival. A job is
+  # renamed to .running while it is analyzed and removed when its .result file is written.
+  # (Write the .job files under another name first and rename them, so that no job is
+  # read before it is complete.)
+  print("Waiting for jobs in directory: ", spool, flush=True)
+  try:
+    while True:
+      pending=[os.path.join(spool,name) for name in os.listdir(spool) if name.endswith('.job')]
+      if not pending:
+        time.sleep(interval)
+        continue
+      for job in sorted(pending,key=lambda job: os.stat(job).st_mtime_ns):
+        running=job[:-4] + '.running'
+        os.replace(job,running)
+        try:
+          with open(running) as inp:
+            request=json.load(inp)
+        except ValueError:
+          answer={'error':'no JSON job: '+job}
+        else:
+          answer=run_job(request)
+        write_json(job[:-4] + '.result',answer)
+        os.remove(running)
+        print("Finished job: ", job, flush=True)
+  except KeyboardInterrupt:
+    pass
+
+##########################################################################################
+# MAIN PART
+##########################################################################################
+
+def analyze_files():
+  # Analyze all configurations of the command line and return their results.
+  if jobs > 1 and len(filenames) > 1:
+    results=analyze_batch(filenames,jobs)
+    print_summary(results)
+    return results
+  results=[]
+  prefetch=None
+  for n,file in enumerate(filenames):
+    if prefetch is not None:
+      prefetch.join()
+      prefetch=None
+    if pipeline and n+1 < len(filenames):
+      prefetch=threading.Thread(target=prefetch_file,args=(filenames[n+1],),daemon=True)
+      prefetch.start()
+    result=analyze_file_cached(file)
+    if summary_file:
+      append_summary(summary_file,result)
+      print("Summary appended to file: ", summary_file)
+    results.append(result)
+  return results
+
+def main():
+  global filenames,jobs,pipeline
+  # Handle arguments passed to the script:
+  controller()
+
+  # checking for current Ovito version:
+  if reclassify:
+    print("This is the BCC Defect Analysis reclassifying descriptor files")
+  elif backend == 'native':
+    print("This is the BCC Defect Analysis working with its native descriptor engine")
+  elif ovito is None:
+    if not (serve_socket or watch_dir):
+      sys.exit('OVITO is required to analyze configurations (use --backend native or --reclassify without it)')
+    print("This is the BCC Defect Analysis without OVITO (jobs need --backend native or --reclassify)")
+  else:
+    print("This is the BCC Defect Analysis working with OVITO", ovito.version_string)
+
+  if serve_socket:
+    serve(serve_socket)
+  elif watch_dir:
+    watch(watch_dir)
+  else:
+    analyze_files()
 
 #This idiom means the below code only runs when executed from command line
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+# A second run with --cache-dir must take the outputs of the first run from the cache and
+# give the same files. Needs no OVITO (--backend native).
+# Run with: python -m pytest tests
+
+import os, sys, subprocess, tempfile, shutil
+
+from test_server import script, alat, write_crystal, outputs
+
+def test_cached_run_matches_fresh_run():
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_crystal(base)
+    cache=os.path.join(base,'cache')
+    args=[sys.executable,script,'-c','crystal.chkpt','-a',str(alat),'-b','0','0','0','-r','0','--backend','native','--cache-dir',cache]
+    for out_of_core in ([],['--out-of-core',base]):
+      first=subprocess.run(args+out_of_core,cwd=base,check=True,capture_output=True,text=True)
+      assert 'Using cached results' not in first.stdout
+      expected=outputs(base,'crystal.chkpt')
+      for name in expected:
+        os.remove(os.path.join(base,name))
+      second=subprocess.run(args+out_of_core,cwd=base,check=True,capture_output=True,text=True)
+      assert 'Using cached results' in second.stdout
+      assert outputs(base,'crystal.chkpt') == expected
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
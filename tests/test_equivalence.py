@@ -0,0 +1,130 @@
+# Options that only change how the results are computed must not change them: the scalar
+# and the vector engine, -d and --refinement batched, --low-memory, --prefilter,
+# --reclassify, the bulk formatting of the .bda lines, the binary output and --sweep.
+# Needs no OVITO (--backend native).
+# Run with: python -m pytest tests
+
+import os, sys, json, subprocess, tempfile, shutil, importlib.util
+from numpy import arange, bincount, column_stack, concatenate, delete, eye, full, indices, random, savetxt, zeros
+
+script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'ovitos_bcc-defect-analysis.py')
+spec=importlib.util.spec_from_file_location('bda',script)
+bda=importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bda)
+alat=2.8665
+
+def write_periodic_crystal(directory):
+  # Periodic bcc crystal with a vacancy cluster, 30 single vacancies and enough thermal
+  # noise that the optimization loops have work to do (and the sequential and the batched
+  # refinement differ).
+  cells=12
+  grid=indices((cells,cells,cells)).reshape(3,-1).T
+  pos=concatenate([grid,grid+0.5])*alat
+  rng=random.default_rng(1)
+  center=((pos-pos.mean(axis=0))**2).sum(axis=1) < (0.9*alat)**2
+  removed=concatenate([center.nonzero()[0],rng.choice(len(pos),30,replace=False)])
+  pos=delete(pos,removed,axis=0)
+  pos=(pos+rng.normal(0,0.15,pos.shape)) % (cells*alat)
+  box=cells*alat
+  with open(os.path.join(directory,'crystal.chkpt'),'w') as out:
+    out.write('#F A 1 1 1 3 0 0\n#C number type mass x y z\n')
+    for d,axis in enumerate('XYZ'):
+      out.write('#%s %12.6f %12.6f %12.6f\n' % (axis,*(box*eye(3)[d])))
+    out.write('#E\n')
+    savetxt(out,column_stack([arange(1,len(pos)+1),zeros(len(pos)),full(len(pos),55.845),pos]),fmt='%d %d %.3f %.6f %.6f %.6f')
+
+def analyze(directory, extra):
+  # The .bda file of a periodic run with the given extra arguments.
+  subprocess.run([sys.executable,script,'-c','crystal.chkpt','-a',str(alat),'-b','1','1','1','--backend','native']+extra,
+                 cwd=directory,check=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+  with open(os.path.join(directory,'crystal.chkpt.bda'),'rb') as inp:
+    return inp.read()
+
+def compare(extra, reference):
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_periodic_crystal(base)
+    assert analyze(base,extra) == analyze(base,reference)
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
+
+def test_scalar_engine_matches_vector_engine():
+  compare(['-e','scalar'],[])
+
+def test_sequential_and_batched_refinement_differ():
+  # (otherwise the tests below could not tell them apart)
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_periodic_crystal(base)
+    assert analyze(base,[]) != analyze(base,['--refinement','batched'])
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
+
+def test_domains_match_batched_refinement():
+  compare(['-d','2'],['--refinement','batched'])
+
+def test_low_memory_matches_default():
+  compare(['--low-memory'],[])
+
+def test_prefilter_matches_default():
+  compare(['--prefilter'],[])
+
+def test_reclassify_matches_analysis():
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_periodic_crystal(base)
+    expected=analyze(base,['--descriptors'])
+    assert analyze(base,['--reclassify']) == expected
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
+
+def test_bulk_formatting_matches_format_atom():
+  # including values that are wider than their columns or need rounding
+  rng=random.default_rng(2)
+  nr_atoms=2000
+  bda.atom_source=None
+  bda.atom_nrs=arange(1,nr_atoms+1)
+  bda.atom_nrs[:3]=[12345678901,0,999999999]
+  bda.atom_types=rng.integers(0,3,nr_atoms)
+  bda.atom_masses=full(nr_atoms,55.845)
+  bda.atom_pos=rng.normal(0,50,(nr_atoms,3))
+  bda.atom_pos[:4,0]=[-0.0000004,123456789.5,-99999.9999995,0.0000005]
+  csp=rng.exponential(3,nr_atoms)
+  csp[:3]=[1234.5678,99.9999996,0]
+  bda.atom_cna,bda.atom_coord,bda.atom_csp,bda.atom_defect=bda.shared_descriptors(rng.integers(0,5,nr_atoms),rng.integers(0,20,nr_atoms),
+                                                                                  csp,rng.integers(0,7,nr_atoms))
+  atoms=rng.permutation(nr_atoms)
+  assert bda.format_atoms(atoms) == ''.join([bda.format_atom(i) for i in atoms])
+
+def test_binary_columns_match_text_columns():
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_periodic_crystal(base)
+    for binary in ('raw','npz'):
+      analyze(base,['-i','--binary',binary])
+      text,cell=bda.read_imd(os.path.join(base,'crystal.chkpt.bda'))
+      binary_cell,columns=bda.read_binary(os.path.join(base,'crystal.chkpt.bda.'+binary))
+      assert abs(binary_cell-cell).max() < 1e-5
+      for name in ('number','type','cna','coord','defect'):
+        assert (columns[name] == text[name]).all(), name
+      for name in ('mass','x','y','z','csp'):
+        assert abs(columns[name]-text[name]).max() < 1e-5, name
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
+
+def test_sweep_with_default_thresholds_matches_analysis():
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    write_periodic_crystal(base)
+    with open(os.path.join(base,'sets.json'),'w') as out:
+      json.dump([{'vote':2},{}],out)
+    for refinement in ('sequential','batched'):
+      analyze(base,['-i','--refinement',refinement,'--sweep','sets.json'])
+      text,cell=bda.read_imd(os.path.join(base,'crystal.chkpt.bda'))
+      with open(os.path.join(base,'crystal.chkpt.bda.sweep')) as inp:
+        names=inp.readline().split()[1:]
+        row=inp.read().splitlines()[1].split()
+      counts=[int(row[names.index(name)]) for name in bda.defect_names]
+      assert counts == bincount(text['defect'].astype(int),minlength=bda.els+1).tolist(), refinement
+  finally:
+    shutil.rmtree(base,ignore_errors=True)
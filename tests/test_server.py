@@ -0,0 +1,77 @@
+# Jobs of a server (--serve) must give the same output files as the same command lines
+# run one by one, whatever jobs came before. Needs no OVITO (--backend native).
+# Run with: python -m pytest tests
+
+import os, sys, json, socket, subprocess, tempfile, time, shutil
+from numpy import arange, argmin, column_stack, concatenate, delete, eye, full, indices, linalg, ones, random, savetxt, zeros
+
+script=os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'ovitos_bcc-defect-analysis.py')
+alat=2.8665
+
+def write_crystal(directory):
+  # bcc crystal with free surfaces, a vacancy and some thermal noise as IMD file and as
+  # LAMMPS dump with an extra column.
+  cells=10
+  grid=indices((cells,cells,cells)).reshape(3,-1).T
+  pos=concatenate([grid,grid+0.5])*alat+alat
+  pos=delete(pos,argmin(linalg.norm(pos-pos.mean(axis=0),axis=1)),axis=0)
+  pos+=random.default_rng(1).normal(0,0.05,pos.shape)
+  box=(cells+2)*alat
+  numbers=arange(1,len(pos)+1)
+  with open(os.path.join(directory,'crystal.chkpt'),'w') as out:
+    out.write('#F A 1 1 1 3 0 0\n#C number type mass x y z\n')
+    for d,axis in enumerate('XYZ'):
+      out.write('#%s %12.6f %12.6f %12.6f\n' % (axis,*(box*eye(3)[d])))
+    out.write('#E\n')
+    savetxt(out,column_stack([numbers,zeros(len(pos)),full(len(pos),55.845),pos]),fmt='%d %d %.3f %.6f %.6f %.6f')
+  with open(os.path.join(directory,'crystal.dump'),'w') as out:
+    out.write('ITEM: TIMESTEP\n0\nITEM: NUMBER OF ATOMS\n%d\nITEM: BOX BOUNDS ff ff ff\n' % len(pos))
+    out.write(('0 %.6f\n' % box)*3)
+    out.write('ITEM: ATOMS id type x y z c_pe\n')
+    savetxt(out,column_stack([numbers,ones(len(pos)),pos,full(len(pos),-4.0)]),fmt='%d %d %.6f %.6f %.6f %.3f')
+  return box
+
+def outputs(directory, file):
+  return {name:open(os.path.join(directory,name),'rb').read() for name in (file + '.bda',file + '.ccc')}
+
+def test_server_jobs_match_standalone_runs():
+  base=tempfile.mkdtemp(prefix='bda-test-')
+  try:
+    alone=os.path.join(base,'alone')
+    served=os.path.join(base,'served')
+    os.makedirs(alone)
+    box=write_crystal(alone)
+    shutil.copytree(alone,served,dirs_exist_ok=True)
+    common=['-a',str(alat),'-b','0','0','0','-r','0','--backend','native']
+    center=['%.3f' % (box/2)]*3
+    # a region of interest, then a job without one; a dump, then an IMD file again:
+    jobs=[(['-c','crystal.chkpt','--roi','sphere']+center+['6']+common,'crystal.chkpt'),
+          (['-c','crystal.chkpt']+common,'crystal.chkpt'),
+          (['-c','crystal.dump']+common,'crystal.dump'),
+          (['-c','crystal.chkpt','-i']+common,'crystal.chkpt')]
+    expected=[]
+    for args,file in jobs:
+      subprocess.run([sys.executable,script]+args,cwd=alone,check=True,stdout=subprocess.DEVNULL)
+      expected.append(outputs(alone,file))
+
+    path=os.path.join(base,'bda.sock')
+    server=subprocess.Popen([sys.executable,script,'--serve',path],cwd=served,stdout=subprocess.DEVNULL)
+    try:
+      for wait in range(600):
+        if os.path.exists(path):
+          break
+        time.sleep(0.1)
+      with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        answers=connection.makefile('rwb')
+        for (args,file),files in zip(jobs,expected):
+          answers.write((json.dumps({'args':args})+'\n').encode())
+          answers.flush()
+          answer=json.loads(answers.readline())
+          assert 'error' not in answer, answer
+          assert outputs(served,file) == files, args
+    finally:
+      server.terminate()
+      server.wait()
+  finally:
+    shutil.rmtree(base,ignore_errors=True)